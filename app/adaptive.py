@@ -0,0 +1,119 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveInterval:
+    """
+    Read interval of one sensor that follows how fast its values change
+
+    A reading in which any measurement moved by at least its threshold
+    since the previous reading halves the interval, down to min_interval.
+    Readings that moved less than half the threshold stretch it by a
+    quarter, up to max_interval. The interval thus settles where one
+    reading changes by about the threshold: stable sensors are read
+    rarely, and a fast transient is caught within a few readings.
+    threshold is one number for every measurement or a {measurement:
+    threshold} dict, measurements without a threshold are ignored.
+    """
+
+    shrink = 0.5
+    stretch = 1.25
+
+    def __init__(self, interval, min_interval, max_interval, threshold=1.0):
+        if not 0 < min_interval <= max_interval:
+            raise ValueError(f"Invalid adaptive interval range {min_interval}..{max_interval} s")
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.threshold = threshold
+        self.interval = min(max(interval, min_interval), max_interval)
+        self._last = {}
+
+    @classmethod
+    def from_config(cls, sensor):
+        """Create the adaptive interval of a sensors[] entry, None when it has no adaptive section"""
+        options = sensor.get('adaptive')
+        if not options:
+            return None
+        interval = sensor.get('update_interval', 60)
+        minimum = options.get('min_interval', interval)
+        return cls(interval, minimum, options.get('max_interval', max(minimum, interval * 10)),
+                   threshold=options.get('threshold', 1.0))
+
+    def reset(self, interval):
+        """Start over from interval, e.g. after update_interval was changed"""
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
+        self._last.clear()
+
+    def _change(self, values):
+        """Largest change since the last reading, relative to the measurement's threshold"""
+        change = 0.0
+        for measurement, value in values.items():
+            if type(value) is bool or not isinstance(value, (int, float)):
+                continue
+            threshold = self.threshold.get(measurement) if isinstance(self.threshold, dict) else self.threshold
+            last = self._last.get(measurement)
+            self._last[measurement] = value
+            if threshold and last is not None:
+                change = max(change, abs(value - last) / threshold)
+        return change
+
+    def update(self, values):
+        """Account for a reading, returns the new interval or None when it stays the same"""
+        change = self._change(values)
+        if change >= 1:
+            interval = max(self.min_interval, self.interval * self.shrink)
+        elif change < 0.5:
+            interval = min(self.max_interval, self.interval * self.stretch)
+        else:
+            return None
+        if interval == self.interval:
+            return None
+        self.interval = interval
+        return interval
+
+
+class LoadMonitor:
+    """
+    Global backoff of every read interval while publishing falls behind
+
+    The load is how far the publish queue is filled beyond queue_threshold
+    (a fraction of its size), or how far the publish latency exceeds
+    latency_threshold seconds, whichever is higher. It scales all
+    intervals by up to max_backoff once the queue is full or the latency
+    twice the threshold, and back to 1 when publishing keeps up again.
+    """
+
+    def __init__(self, queue, max_backoff=4.0, queue_threshold=0.5, latency_threshold=1.0):
+        if max_backoff < 1:
+            raise ValueError(f"max_backoff must be at least 1, got {max_backoff}")
+        self.queue = queue
+        self.max_backoff = max_backoff
+        self.queue_threshold = queue_threshold
+        self.latency_threshold = latency_threshold
+        self.factor = 1.0
+
+    @classmethod
+    def from_config(cls, queue, options):
+        """Create a monitor from the sampling section (a SamplingConfig), None when it is disabled"""
+        if options.max_backoff is None:
+            return None
+        return cls(queue, options.max_backoff, options.queue_threshold, options.latency_threshold)
+
+    def load(self):
+        """0 while publishing keeps up, 1 at full backoff"""
+        fill = self.queue.depth / self.queue.max_size if self.queue.max_size else 0.0
+        queue_load = (fill - self.queue_threshold) / (1 - self.queue_threshold) if self.queue_threshold < 1 else 0.0
+        latency_load = (self.queue.latency - self.latency_threshold) / self.latency_threshold
+        return min(1.0, max(0.0, queue_load, latency_load))
+
+    def update(self):
+        """Recompute the backoff factor, returns it"""
+        factor = round(1 + (self.max_backoff - 1) * self.load(), 2)
+        extra = {'factor': factor, 'depth': self.queue.depth, 'latency': self.queue.latency}
+        if factor > 1 and self.factor == 1:
+            logger.warning("Publishing is falling behind, read intervals scaled by %.2f", factor, extra=extra)
+        elif factor == 1 and self.factor > 1:
+            logger.info("Publishing caught up, read intervals back to normal", extra=extra)
+        self.factor = factor
+        return factor
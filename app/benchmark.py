@@ -0,0 +1,374 @@
+"""
+Load generator and benchmark for the sensor container
+
+Runs the real container (scheduler, read pipeline, publish queue, paho
+client) against an in-process MQTT broker stand-in with N devices of M
+sensors each, and reports throughput, end-to-end latency, CPU and memory:
+
+    python benchmark.py --devices 10 --sensors 5 --rate 2 --duration 30
+
+The broker runs on its own thread in the same process, so the CPU figure
+includes the (small) cost of the stand-in broker.
+"""
+import argparse
+import asyncio
+import json
+import resource
+import sys
+import threading
+import time
+
+from config import LoggingConfig
+from drivers import SensorDriver, register_driver
+from logs import setup_logging
+from sensor_container import run
+
+
+@register_driver('benchmark')
+class BenchmarkDriver(SensorDriver):
+    """Sensor whose reading is the time it was read, so the broker can measure end-to-end latency"""
+
+    measurements = (('timestamp', "s", None),)
+    blocking = False
+
+    def read(self):
+        return {'timestamp': time.perf_counter()}
+
+
+def _encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def _packet(first_byte, body=b''):
+    return bytes([first_byte]) + _encode_length(len(body)) + body
+
+
+def _string(data):
+    return len(data).to_bytes(2, 'big') + data
+
+
+def _read_length(data, offset):
+    """Decode a variable byte integer, returns (value, offset after it)"""
+    value, shift = 0, 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+# Sizes of the MQTT v5 PUBLISH properties paho sends, None for length-prefixed strings or binary data
+_PROPERTY_SIZES = {0x01: 1, 0x02: 4, 0x03: None, 0x08: None, 0x09: None, 0x23: 2}
+
+
+def _read_properties(data, offset):
+    """Parse MQTT v5 properties, returns ({id: value}, offset after them)"""
+    length, offset = _read_length(data, offset)
+    end = offset + length
+    properties = {}
+    while offset < end:
+        identifier = data[offset]
+        offset += 1
+        if identifier == 0x0B:  # Subscription Identifier
+            properties[identifier], offset = _read_length(data, offset)
+        elif identifier == 0x26:  # User Property, a string pair
+            for _ in range(2):
+                offset += 2 + int.from_bytes(data[offset:offset + 2], 'big')
+        elif _PROPERTY_SIZES[identifier] is None:
+            size = int.from_bytes(data[offset:offset + 2], 'big')
+            properties[identifier] = data[offset + 2:offset + 2 + size]
+            offset += 2 + size
+        else:
+            size = _PROPERTY_SIZES[identifier]
+            properties[identifier] = int.from_bytes(data[offset:offset + size], 'big')
+            offset += size
+    return properties, end
+
+
+async def _read_packet(reader):
+    first_byte = (await reader.readexactly(1))[0]
+    length, shift = 0, 0
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    return first_byte, await reader.readexactly(length)
+
+
+class LocalBroker:
+    """
+    Minimal MQTT 3.1.1 and 5 broker stand-in running on its own thread
+
+    Connections, publishes (QoS 0-2), subscriptions and pings are
+    acknowledged. Retained messages are kept and sent to exact topic
+    subscriptions, nothing else is forwarded. Every publish is reported to
+    on_message(topic, payload, received_at) with a perf_counter timestamp.
+    MQTT v5 clients may use up to topic_alias_maximum topic aliases.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, on_message=None, topic_alias_maximum=64):
+        self.host = host
+        self.port = port
+        self.on_message = on_message
+        self.topic_alias_maximum = topic_alias_maximum
+        self.retained = {}
+        self.messages = 0
+        self.bytes = 0
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """Start serving, returns once the port is bound"""
+        started = threading.Event()
+        self._loop = asyncio.new_event_loop()
+
+        def serve():
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(asyncio.start_server(self._client, self.host, self.port))
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=serve, name='broker', daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        async def close():
+            self._server.close()
+            # Finish the connection handlers before the loop is closed
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._loop.stop()
+        asyncio.run_coroutine_threadsafe(close(), self._loop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _client(self, reader, writer):
+        # Protocol level of the connection and its topic aliases
+        session = {'v5': False, 'aliases': {}}
+        try:
+            while True:
+                first_byte, body = await _read_packet(reader)
+                kind = first_byte >> 4
+                if kind == 1:  # CONNECT
+                    session['v5'] = body[6] == 5
+                    if session['v5']:
+                        # Session present 0, success, Topic Alias Maximum property
+                        writer.write(_packet(0x20, b'\x00\x00\x03\x22' + self.topic_alias_maximum.to_bytes(2, 'big')))
+                    else:
+                        writer.write(_packet(0x20, b'\x00\x00'))
+                elif kind == 3:  # PUBLISH
+                    self._publish(first_byte, body, writer, session)
+                elif kind == 6:  # PUBREL
+                    writer.write(_packet(0x70, body[:2]))
+                elif kind == 8:  # SUBSCRIBE
+                    self._subscribe(body, writer, session['v5'])
+                elif kind == 10:  # UNSUBSCRIBE
+                    writer.write(_packet(0xB0, body[:2] + (b'\x00' if session['v5'] else b'')))
+                elif kind == 12:  # PINGREQ
+                    writer.write(_packet(0xD0))
+                elif kind == 14:  # DISCONNECT
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # Ended by stop(), Python 3.11 streams log cancelled connection handlers as errors
+            pass
+        finally:
+            writer.close()
+
+    def _publish(self, first_byte, body, writer, session):
+        received_at = time.perf_counter()
+        qos = (first_byte >> 1) & 3
+        length = int.from_bytes(body[:2], 'big')
+        topic = body[2:2 + length].decode()
+        offset = 2 + length
+        packet_id = body[offset:offset + 2] if qos else b''
+        offset += len(packet_id)
+        if session['v5']:
+            properties, offset = _read_properties(body, offset)
+            alias = properties.get(0x23)
+            if alias is not None:
+                if topic:
+                    session['aliases'][alias] = topic
+                else:
+                    topic = session['aliases'][alias]
+        payload = body[offset:]
+
+        self.messages += 1
+        self.bytes += len(body)
+        if first_byte & 1:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        if qos == 1:
+            writer.write(_packet(0x40, packet_id))
+        elif qos == 2:
+            writer.write(_packet(0x50, packet_id))
+        if self.on_message is not None:
+            self.on_message(topic, payload, received_at)
+
+    def _subscribe(self, body, writer, v5=False):
+        packet_id, offset, topics = body[:2], 2, []
+        if v5:
+            _, offset = _read_properties(body, offset)
+        while offset < len(body):
+            length = int.from_bytes(body[offset:offset + 2], 'big')
+            topics.append(body[offset + 2:offset + 2 + length].decode())
+            offset += length + 3
+        writer.write(_packet(0x90, packet_id + (b'\x00' if v5 else b'') + bytes(len(topics))))
+        for topic in topics:
+            if topic in self.retained:
+                properties = b'\x00' if v5 else b''
+                writer.write(_packet(0x31, _string(topic.encode()) + properties + self.retained[topic]))
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def max_rss_mb():
+    """Peak resident set size of this process"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def benchmark_config(port, devices, sensors, rate, compact=False, publish=None, protocol='3.1.1'):
+    """Configuration of devices x sensors benchmark sensors each read rate times per second"""
+    return {
+        'mqtt': {'broker': '127.0.0.1', 'port': port, 'username': None, 'password': None,
+                 'client_id': 'benchmark_sensor_container', 'protocol': protocol},
+        'publish': publish or {},
+        'devices': [
+            {
+                'name': f"Benchmark {device}",
+                'compact_state': compact,
+                'sensors': [
+                    {'type': 'benchmark', 'name': f"sensor_{sensor}", 'update_interval': 1 / rate}
+                    for sensor in range(sensors)
+                ],
+            }
+            for device in range(devices)
+        ],
+    }
+
+
+async def benchmark(devices=10, sensors=4, rate=1.0, duration=10.0, compact=False, publish=None,
+                    protocol='3.1.1'):
+    """Run the container against a local broker for duration seconds and return the measurements"""
+    latencies = []
+
+    def on_message(topic, payload, received_at):
+        if not topic.endswith('/state'):
+            return
+        value = json.loads(payload)
+        if isinstance(value, dict):
+            value = value['timestamp']
+        latencies.append(received_at - value)
+
+    broker = LocalBroker(on_message=on_message).start()
+    config = benchmark_config(broker.port, devices, sensors, rate, compact=compact, publish=publish,
+                              protocol=protocol)
+    stop_event = asyncio.Event()
+    try:
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        container = asyncio.create_task(run(config, stop_event=stop_event))
+        await asyncio.sleep(duration)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        received = len(latencies)
+        stop_event.set()
+        queue_stats = await container
+    finally:
+        broker.stop()
+
+    # Readings arriving while shutting down are not part of the measured window
+    latencies = sorted(latencies[:received])
+    return {
+        'sensors': devices * sensors,
+        'duration': elapsed,
+        'readings': len(latencies),
+        'expected_per_second': devices * sensors * rate,
+        'messages_per_second': len(latencies) / elapsed,
+        'broker_messages': broker.messages,
+        'broker_bytes': broker.bytes,
+        'latency_ms': {
+            name: None if percentile(latencies, percent) is None else percentile(latencies, percent) * 1000
+            for name, percent in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100))
+        },
+        'cpu_percent': 100 * cpu / elapsed,
+        'max_rss_mb': max_rss_mb(),
+        'queue': queue_stats,
+    }
+
+
+def format_report(result):
+    latency = result['latency_ms']
+    lines = [
+        f"Sensors:      {result['sensors']} over {result['duration']:.1f} s",
+        (f"Throughput:   {result['messages_per_second']:.1f} readings/s "
+         f"(expected {result['expected_per_second']:.1f}), {result['broker_messages']} messages, "
+         f"{result['broker_bytes']} bytes"),
+    ]
+    if latency['p50'] is not None:
+        lines.append(f"Latency:      p50 {latency['p50']:.2f} ms, p90 {latency['p90']:.2f} ms, "
+                     f"p99 {latency['p99']:.2f} ms, max {latency['max']:.2f} ms")
+    lines += [
+        f"CPU:          {result['cpu_percent']:.1f} %",
+        f"Peak RSS:     {result['max_rss_mb']:.1f} MB",
+        f"Queue:        {result['queue']['dropped']} dropped, {result['queue']['failed']} refused",
+    ]
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the sensor container against a local broker")
+    parser.add_argument('--devices', type=int, default=10, help="number of devices")
+    parser.add_argument('--sensors', type=int, default=4, help="sensors per device")
+    parser.add_argument('--rate', type=float, default=1.0, help="readings per second per sensor")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to run")
+    parser.add_argument('--compact', action='store_true', help="publish compact JSON state")
+    parser.add_argument('--mqtt5', action='store_true', help="connect with MQTT v5 and topic aliases")
+    parser.add_argument('--max-queue', type=int, default=1000, help="publish queue size")
+    parser.add_argument('--rate-limit', type=float, default=0, help="publish rate limit in messages per second")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    parser.add_argument('--log-level', default='WARNING', help="level of the container's own log messages")
+    args = parser.parse_args(argv)
+
+    publish = {'max_queue': args.max_queue, 'rate_limit': args.rate_limit}
+    # Container logs go to stderr so they do not mix with the report
+    listener = setup_logging(LoggingConfig(level=args.log_level.upper(), format='text'), stream=sys.stderr)
+    try:
+        result = asyncio.run(benchmark(args.devices, args.sensors, args.rate, args.duration,
+                                       compact=args.compact, publish=publish,
+                                       protocol='5' if args.mqtt5 else '3.1.1'))
+    finally:
+        listener.stop()
+    print(json.dumps(result, indent=2) if args.json else format_report(result))
+
+
+if __name__ == "__main__":
+    main()
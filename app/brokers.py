@@ -0,0 +1,151 @@
+import asyncio
+import logging
+
+import paho.mqtt.client as mqtt
+
+logger = logging.getLogger(__name__)
+
+MODES = ('failover', 'fanout')
+
+
+class BrokerLink:
+    """One broker the container publishes to: its client, connection, publish queue and discovery cache"""
+
+    def __init__(self, name, connection, queue, cache=None, properties=None):
+        self.name = name
+        self.connection = connection
+        self.client = connection.client
+        self.queue = queue
+        self.cache = cache
+        self.properties = properties
+        # Set to (re)publish discovery to this broker
+        self.announce = asyncio.Event()
+
+    def __repr__(self):
+        return f"BrokerLink({self.name})"
+
+    @property
+    def connected(self):
+        return self.connection.connected.is_set()
+
+
+class FanOut:
+    """
+    Publish every message to several brokers
+
+    publish() mirrors client.publish() and hands the same topic and
+    payload objects to the publish queue (or store) of every broker, so a
+    reading is serialized once however many brokers receive it. Each
+    broker has its own queue, a slow or unreachable broker only drops its
+    own oldest messages.
+    """
+
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        for sink in self.sinks:
+            sink.publish(topic, payload, qos=qos, retain=retain)
+        return (0, None)
+
+
+class QueueGroup:
+    """
+    The publish queues of several brokers seen as one, for metrics and the load monitor
+
+    Depth, size and the message counters are summed over the queues, the
+    latency is their mean. With fan-out a single unreachable broker thus
+    fills the group only by its own share.
+    """
+
+    def __init__(self, queues):
+        self.queues = list(queues)
+
+    @property
+    def depth(self):
+        return sum(queue.depth for queue in self.queues)
+
+    @property
+    def max_size(self):
+        return sum(queue.max_size for queue in self.queues)
+
+    @property
+    def inflight(self):
+        return sum(queue.inflight for queue in self.queues)
+
+    @property
+    def sent(self):
+        return sum(queue.sent for queue in self.queues)
+
+    @property
+    def dropped(self):
+        return sum(queue.dropped for queue in self.queues)
+
+    @property
+    def failed(self):
+        return sum(queue.failed for queue in self.queues)
+
+    @property
+    def latency(self):
+        return sum(queue.latency for queue in self.queues) / len(self.queues)
+
+    def __len__(self):
+        return self.depth
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'inflight': self.inflight,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+
+class Failover:
+    """
+    Publish through the first reachable broker of an ordered list
+
+    Every broker stays connected, so when the active broker's connection
+    is lost (a failed keepalive ping counts) the next reachable broker
+    takes over right away instead of after a reconnect, and a recovered
+    broker earlier in the list takes over again. update() re-evaluates the
+    choice and is called on every connect and disconnect.
+
+    publish() mirrors client.publish() on the active broker's client, so
+    the shared publish queue flushes to whichever broker is active;
+    connected is set while it is reachable. on_switch(link) is called when
+    another broker becomes active, e.g. to send it the discovery configs.
+    """
+
+    def __init__(self, links, on_switch=None):
+        self.links = list(links)
+        self.on_switch = on_switch
+        self.active = None
+        self.switches = 0
+        self.connected = asyncio.Event()
+
+    def update(self):
+        """Make the first connected broker the active one, returns True if it changed"""
+        link = next((link for link in self.links if link.connected), None)
+        if link is None:
+            self.connected.clear()
+            return False
+        self.connected.set()
+        if link is self.active:
+            return False
+        previous, self.active = self.active, link
+        if previous is not None:
+            self.switches += 1
+            logger.warning("Switched MQTT broker from %s to %s", previous.name, link.name,
+                           extra={'broker': link.name, 'previous': previous.name})
+        if self.on_switch is not None:
+            self.on_switch(link)
+        return True
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        if self.active is None:
+            return (mqtt.MQTT_ERR_NO_CONN, None)
+        if properties is None:
+            return self.active.client.publish(topic, payload, qos=qos, retain=retain)
+        return self.active.client.publish(topic, payload, qos=qos, retain=retain, properties=properties)
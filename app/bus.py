@@ -0,0 +1,196 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from serialization import dumps
+
+BusRecord = namedtuple('BusRecord', 'sequence time name values')
+
+MAGIC = b'SCBUS001'
+# magic, sequence of the last reading, record size, sensor slots, ring slots
+HEADER = struct.Struct('<8sQIII4x')
+SEQUENCE = struct.Struct('<Q')
+# sequence, Unix time of the reading, name length, payload length
+RECORD = struct.Struct('<QdHH')
+# Sequence of a record that is being written, readers retry
+BUSY = 0xFFFFFFFFFFFFFFFF
+
+
+class SensorBus:
+    """
+    Publish readings to co-located processes through a memory-mapped file
+
+    The file (by default in /dev/shm, i.e. shared memory) holds fixed-size
+    records: one slot per sensor with its latest reading, then a ring of
+    the most recent readings of all sensors. Each record carries the
+    reading's sequence number, which is set to BUSY while the record is
+    rewritten, and the header the sequence of the last reading, so a
+    BusReader can copy records without any locking or system call and
+    detect the ones it raced with. Readings are stored as compact JSON,
+    those that do not fit record_size are counted in oversized and skipped.
+
+    The file is replaced on every start, readers of a previous run keep
+    the old file and should open it again when the container restarts.
+    """
+
+    def __init__(self, path, slots=1024, sensors=64, record_size=256, clock=time.time):
+        if record_size < RECORD.size + 16:
+            raise ValueError(f"Bus record size must be at least {RECORD.size + 16} bytes")
+        self.path = path
+        self.slots = slots
+        self.sensors = sensors
+        self.record_size = record_size
+        self.clock = clock
+        self.sequence = 0
+        self.oversized = 0
+        # Readings arrive from the read pipeline's worker threads
+        self._lock = threading.Lock()
+        # Sensor name -> index of its slot in the latest table
+        self._index = {}
+
+        size = HEADER.size + (sensors + slots) * record_size
+        temporary = f"{path}.tmp"
+        with open(temporary, 'w+b') as file:
+            file.truncate(size)
+            self._map = mmap.mmap(file.fileno(), size)
+        HEADER.pack_into(self._map, 0, MAGIC, 0, record_size, sensors, slots)
+        # Readers only ever see a complete header
+        os.replace(temporary, path)
+
+    @classmethod
+    def from_config(cls, options):
+        """Create a bus from the bus section (a BusConfig), None when it is disabled"""
+        if options.path is None:
+            return None
+        return cls(options.path, slots=options.slots, sensors=options.sensors, record_size=options.record_size)
+
+    def _write(self, offset, sequence, timestamp, name, payload):
+        SEQUENCE.pack_into(self._map, offset, BUSY)
+        end = offset + RECORD.size + len(name)
+        struct.pack_into('<dHH', self._map, offset + SEQUENCE.size, timestamp, len(name), len(payload))
+        self._map[offset + RECORD.size:end] = name
+        self._map[end:end + len(payload)] = payload
+        SEQUENCE.pack_into(self._map, offset, sequence)
+
+    def publish(self, name, values):
+        """Write a reading of sensor (job) name, returns False if it does not fit a record"""
+        encoded = name.encode()
+        payload = dumps(values)
+        if RECORD.size + len(encoded) + len(payload) > self.record_size:
+            self.oversized += 1
+            return False
+        timestamp = self.clock()
+        with self._lock:
+            if self._map.closed:
+                # A read finishing after the container stopped
+                return False
+            sequence = self.sequence + 1
+            slot = (sequence - 1) % self.slots
+            self._write(HEADER.size + (self.sensors + slot) * self.record_size, sequence, timestamp, encoded, payload)
+            index = self._index.get(name)
+            if index is None and len(self._index) < self.sensors:
+                index = self._index[name] = len(self._index)
+            if index is not None:
+                self._write(HEADER.size + index * self.record_size, sequence, timestamp, encoded, payload)
+            self.sequence = sequence
+            SEQUENCE.pack_into(self._map, 8, sequence)
+        return True
+
+    def tap(self, on_result):
+        """Wrap the read pipeline's result callback so every reading is published to the bus first"""
+        def published_result(name, values):
+            self.publish(name, values)
+            on_result(name, values)
+        return published_result
+
+    def close(self):
+        with self._lock:
+            self._map.close()
+
+
+class BusReader:
+    """
+    Read the latest and recent readings from a SensorBus file
+
+    Reads are plain memory copies from the shared mapping, typically a few
+    microseconds. Poll since() with the sequence of the last record seen to
+    follow new readings; readings that were overwritten in the ring before
+    they were read are skipped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < HEADER.size:
+            self._map.close()
+            raise ValueError(f"{path} is not a sensor bus")
+        magic, _, self.record_size, self.sensors, self.slots = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or len(self._map) != HEADER.size + (self.sensors + self.slots) * self.record_size:
+            self._map.close()
+            raise ValueError(f"{path} is not a sensor bus")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def sequence(self):
+        """Sequence number of the last reading written"""
+        return SEQUENCE.unpack_from(self._map, 8)[0]
+
+    def _read(self, offset, retries=3):
+        """The record at offset, None if it is empty or kept changing while it was copied"""
+        for _ in range(retries):
+            record = self._map[offset:offset + self.record_size]
+            sequence, timestamp, name_length, payload_length = RECORD.unpack_from(record)
+            if sequence == 0:
+                return None
+            if sequence == BUSY or SEQUENCE.unpack_from(self._map, offset)[0] != sequence:
+                continue
+            start = RECORD.size + name_length
+            try:
+                return BusRecord(sequence, timestamp, record[RECORD.size:start].decode(),
+                                 json.loads(record[start:start + payload_length]))
+            except ValueError:
+                continue
+        return None
+
+    def latest(self):
+        """{sensor name: BusRecord} of the latest reading of every sensor"""
+        latest = {}
+        for index in range(self.sensors):
+            offset = HEADER.size + index * self.record_size
+            if not SEQUENCE.unpack_from(self._map, offset)[0]:
+                # Sensors take the slots in order, the rest are unused
+                break
+            record = self._read(offset)
+            if record is not None:
+                latest[record.name] = record
+        return latest
+
+    def since(self, sequence=0):
+        """BusRecords newer than sequence that are still in the ring, oldest first"""
+        last = self.sequence
+        first = max(sequence + 1, last - self.slots + 1, 1)
+        records = []
+        for wanted in range(first, last + 1):
+            record = self._read(HEADER.size + (self.sensors + (wanted - 1) % self.slots) * self.record_size)
+            # The slot may already hold a newer reading
+            if record is not None and record.sequence == wanted:
+                records.append(record)
+        return records
+
+    def recent(self, count=None):
+        """The last count readings still in the ring (all of them by default), oldest first"""
+        count = self.slots if count is None else min(count, self.slots)
+        return self.since(max(0, self.sequence - count))
+
+    def close(self):
+        self._map.close()
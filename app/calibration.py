@@ -0,0 +1,175 @@
+import math
+
+from drivers import SensorDriver
+
+# unit -> (quantity, scale, offset) converting a value to the quantity's base unit as value * scale + offset
+UNITS = {
+    '°C': ('temperature', 1.0, 0.0),
+    '°F': ('temperature', 5 / 9, -160 / 9),
+    'K': ('temperature', 1.0, -273.15),
+    '%': ('fraction', 1.0, 0.0),
+    'hPa': ('pressure', 100.0, 0.0),
+    'Pa': ('pressure', 1.0, 0.0),
+    'kPa': ('pressure', 1000.0, 0.0),
+    'mbar': ('pressure', 100.0, 0.0),
+    'inHg': ('pressure', 3386.389, 0.0),
+    'mmHg': ('pressure', 133.322, 0.0),
+    'psi': ('pressure', 6894.757, 0.0),
+    'm': ('length', 1.0, 0.0),
+    'cm': ('length', 0.01, 0.0),
+    'mm': ('length', 0.001, 0.0),
+    'ft': ('length', 0.3048, 0.0),
+    'in': ('length', 0.0254, 0.0),
+}
+
+# name -> (unit, device class, measurements it is computed from)
+DERIVED = {
+    'dew_point': ('°C', 'temperature', ('temperature', 'humidity')),
+    'absolute_humidity': ('g/m³', None, ('temperature', 'humidity')),
+}
+
+
+def conversion(source, target):
+    """(scale, offset) converting values in unit source to unit target"""
+    if source == target:
+        return 1.0, 0.0
+    if source not in UNITS or target not in UNITS:
+        raise ValueError(f"Cannot convert {source} to {target}, known units: {', '.join(UNITS)}")
+    quantity, source_scale, source_offset = UNITS[source]
+    target_quantity, target_scale, target_offset = UNITS[target]
+    if quantity != target_quantity:
+        raise ValueError(f"Cannot convert {source} to {target}")
+    return source_scale / target_scale, (source_offset - target_offset) / target_scale
+
+
+def dew_point(temperature, humidity):
+    """Dew point in °C from °C and % relative humidity (Magnus formula)"""
+    gamma = math.log(humidity / 100) + 17.62 * temperature / (243.12 + temperature)
+    return 243.12 * gamma / (17.62 - gamma)
+
+
+def absolute_humidity(temperature, humidity):
+    """Water vapour density in g/m³ from °C and % relative humidity"""
+    saturation = 6.112 * math.exp(17.67 * temperature / (temperature + 243.5))
+    return saturation * humidity * 2.1674 / (273.15 + temperature)
+
+
+_FORMULAS = {'dew_point': dew_point, 'absolute_humidity': absolute_humidity}
+
+
+class Calibration:
+    """
+    Correct, convert and extend the readings of one sensor
+
+    Every measurement listed in options is first corrected in the driver's
+    unit, either linearly (value * scale + offset) or with a polynomial
+    [c0, c1, c2, ...] = c0 + c1 * value + c2 * value ** 2 + ..., then
+    converted to unit and rounded to precision decimals. Derived values
+    such as the dew point are computed from the corrected readings and
+    can be converted like any other measurement. Everything is resolved
+    into coefficients once, so a reading only costs a few multiply-adds.
+    """
+
+    def __init__(self, measurements, options=None, derived=(), precision=2):
+        options = options or {}
+        units = {name: (unit, device_class) for name, unit, device_class in measurements}
+        for name in derived:
+            if name not in DERIVED:
+                raise ValueError(f"Unknown derived value '{name}', use any of {', '.join(DERIVED)}")
+            unit, device_class, sources = DERIVED[name]
+            missing = [source for source in sources if source not in units]
+            if missing:
+                raise ValueError(f"Derived value '{name}' needs the {missing[0]} measurement")
+        unknown = sorted(set(options) - set(units) - set(derived))
+        if unknown:
+            raise ValueError(f"Cannot calibrate '{unknown[0]}', the sensor has no such measurement")
+
+        # (measurement, polynomial, scale, offset) applied in the driver's unit
+        self._corrections = []
+        for name, unit_options in options.items():
+            if name not in units:
+                continue
+            polynomial = unit_options.get('polynomial')
+            scale, offset = unit_options.get('scale', 1.0), unit_options.get('offset', 0.0)
+            if polynomial is not None and (scale != 1.0 or offset != 0.0):
+                raise ValueError(f"Calibration of '{name}' uses a polynomial, it cannot also have scale or offset")
+            if polynomial is not None or scale != 1.0 or offset != 0.0:
+                # Horner's scheme wants the highest coefficient first
+                self._corrections.append((name, tuple(reversed(polynomial)) if polynomial else None, scale, offset))
+
+        # (name, formula, (scale, offset) of the temperature to °C), the formulas take °C and %
+        self._derived = []
+        for name in derived:
+            self._derived.append((name, _FORMULAS[name], conversion(units['temperature'][0], '°C')))
+            units[name] = DERIVED[name][:2]
+
+        # (measurement, scale, offset, precision) converting to the configured unit and rounding
+        self._conversions = []
+        result = []
+        for name, (unit, device_class) in units.items():
+            unit_options = options.get(name, {})
+            target = unit_options.get('unit', unit)
+            scale, offset = conversion(unit, target)
+            digits = unit_options.get('precision', precision)
+            if name in options or name in derived:
+                self._conversions.append((name, scale, offset, digits))
+            result.append((name, target, device_class))
+        self.measurements = tuple(result)
+
+    @classmethod
+    def from_config(cls, sensor, measurements):
+        """Calibration of a sensors[] entry, None when it has neither calibration nor derived values"""
+        options = sensor.get('calibration') or {}
+        derived = sensor.get('derived') or ()
+        if not options and not derived:
+            return None
+        return cls(measurements, options, derived)
+
+    def apply(self, values):
+        """Return the calibrated copy of a reading, non-numeric values are passed through"""
+        values = dict(values)
+        for name, polynomial, scale, offset in self._corrections:
+            value = values.get(name)
+            if type(value) is bool or not isinstance(value, (int, float)):
+                continue
+            if polynomial is not None:
+                result = 0.0
+                for coefficient in polynomial:
+                    result = result * value + coefficient
+                values[name] = result
+            else:
+                values[name] = value * scale + offset
+
+        if self._derived:
+            temperature, humidity = values.get('temperature'), values.get('humidity')
+            if isinstance(temperature, (int, float)) and isinstance(humidity, (int, float)) and humidity > 0:
+                for name, formula, (scale, offset) in self._derived:
+                    values[name] = formula(temperature * scale + offset, humidity)
+
+        for name, scale, offset, digits in self._conversions:
+            value = values.get(name)
+            if type(value) is not bool and isinstance(value, (int, float)):
+                values[name] = round(value * scale + offset, digits)
+        return values
+
+
+class CalibratedDriver(SensorDriver):
+    """Driver wrapper applying a Calibration to every reading of the wrapped driver"""
+
+    def __init__(self, driver, calibration):
+        self.driver = driver
+        self.sensor = driver.sensor
+        self.calibration = calibration
+        self.measurements = calibration.measurements
+        self.timeout = driver.timeout
+        self.blocking = driver.blocking
+
+    @property
+    def retries(self):
+        return self.driver.retries
+
+    def read(self):
+        return self.calibration.apply(self.driver.read())
+
+    def close(self):
+        self.driver.close()
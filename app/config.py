@@ -0,0 +1,546 @@
+import os
+import socket
+from dataclasses import dataclass, field
+
+from brokers import MODES
+from calibration import DERIVED, UNITS
+from filters import SMOOTHING
+from logs import FORMATS
+from publisher import POLICIES
+from rollup import AGGREGATES
+
+# SENSOR_CONTAINER_MQTT__PASSWORD overrides mqtt.password, SENSOR_CONTAINER_READ_WORKERS read_workers
+ENV_PREFIX = 'SENSOR_CONTAINER_'
+
+PROTOCOLS = ('3.1.1', '5')
+LOG_LEVELS = ('CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG', 'NOTSET')
+
+_REQUIRED = object()
+
+
+class ConfigError(ValueError):
+    """Invalid configuration, the message names the offending option"""
+
+
+@dataclass(slots=True)
+class BrokerConfig:
+    broker: str
+    port: int = 1883
+    username: str = None
+    password: str = field(default=None, repr=False)
+
+
+@dataclass(slots=True)
+class MqttConfig:
+    broker: str
+    port: int = 1883
+    username: str = None
+    password: str = field(default=None, repr=False)
+    client_id: str = None
+    keepalive: int = 60
+    # False keeps subscriptions and queued QoS 1/2 messages on the broker across reconnects
+    clean_session: bool = True
+    reconnect_delay: float = 1.0
+    reconnect_max_delay: float = 120.0
+    # Retained online/offline topic (birth message and last will), None disables it
+    availability_topic: str = None
+    protocol: str = '3.1.1'
+    # MQTT v5 only: seconds the broker keeps a persistent session after disconnecting
+    session_expiry: int = 3600
+    # MQTT v5 only: topic aliases to use, limited by the broker's Topic Alias Maximum
+    topic_aliases: int = 16
+    # MQTT v5 only: seconds after which the broker drops undelivered readings, None keeps them
+    message_expiry: int = None
+    # MQTT v5 only: add the queue time as a 'timestamp' user property
+    timestamps: bool = False
+    # Further brokers (BrokerConfig) after broker, used as standbys (failover) or published to as well (fanout)
+    brokers: tuple = ()
+    mode: str = 'failover'
+
+
+@dataclass(slots=True)
+class PublishConfig:
+    max_queue: int = 1000
+    policy: str = 'drop_oldest'
+    max_inflight: int = 20
+    rate_limit: float = 0
+    batch_size: int = 50
+
+
+@dataclass(slots=True)
+class SpoolConfig:
+    # None disables spooling
+    path: str = None
+    max_size_mb: float = 4
+    sync_interval: float = 5.0
+    replay_rate: float = 10
+
+
+@dataclass(slots=True)
+class DiscoveryConfig:
+    # None disables the discovery cache
+    cache_file: str = None
+    verify_retained: bool = True
+
+
+@dataclass(slots=True)
+class MetricsConfig:
+    # None disables the metrics endpoint
+    port: int = None
+    host: str = '0.0.0.0'
+
+
+@dataclass(slots=True)
+class BusConfig:
+    # None disables the local shared memory bus
+    path: str = None
+    # Recent readings kept in the ring, and sensors with a latest reading slot
+    slots: int = 1024
+    sensors: int = 64
+    record_size: int = 256
+
+
+@dataclass(slots=True)
+class SamplingConfig:
+    # None disables the global backoff of read intervals
+    max_backoff: float = None
+    # Fraction of publish.max_queue, and seconds of publish latency, above which intervals back off
+    queue_threshold: float = 0.5
+    latency_threshold: float = 1.0
+
+
+@dataclass(slots=True)
+class LoggingConfig:
+    level: str = 'INFO'
+    format: str = 'json'
+    levels: dict = field(default_factory=dict)
+    rate_limit: float = 60
+    queue_size: int = 10000
+
+
+@dataclass(slots=True)
+class SensorConfig:
+    """
+    One enabled sensors[] entry
+
+    options is the entry as written in the configuration, drivers read
+    their own settings (GPIO_pin_RPI, seed, ...) from it.
+    """
+
+    type: str
+    name: str
+    update_interval: float = 60
+    options: dict = field(default_factory=dict)
+
+
+@dataclass(slots=True)
+class DeviceConfig:
+    name: str
+    id: str
+    compact_state: bool = False
+    sensors: tuple = ()
+
+
+@dataclass(slots=True)
+class Config:
+    mqtt: MqttConfig
+    devices: tuple
+    publish: PublishConfig = field(default_factory=PublishConfig)
+    spool: SpoolConfig = field(default_factory=SpoolConfig)
+    discovery: DiscoveryConfig = field(default_factory=DiscoveryConfig)
+    metrics: MetricsConfig = field(default_factory=MetricsConfig)
+    sampling: SamplingConfig = field(default_factory=SamplingConfig)
+    bus: BusConfig = field(default_factory=BusConfig)
+    logging: LoggingConfig = field(default_factory=LoggingConfig)
+    # None uses one worker per sensor
+    read_workers: int = None
+    reload_interval: float = 2.0
+
+
+def device_id(name):
+    """Home Assistant object id of a device name"""
+    return name.lower().replace(' ', '_')
+
+
+def _mapping(value, path):
+    if value is None:
+        return {}
+    if not isinstance(value, dict):
+        raise ConfigError(f"{path}: expected a mapping, got {type(value).__name__}")
+    return value
+
+
+def _check_keys(options, path, known):
+    unknown = sorted(set(options) - set(known))
+    if unknown:
+        raise ConfigError(f"{path}: unknown option{'s' if len(unknown) > 1 else ''} {', '.join(unknown)}")
+
+
+class _EnvironmentValue(str):
+    """A value from an environment variable, converted to the type the option expects"""
+
+    def convert(self, kind, name):
+        if kind is str:
+            return str(self)
+        if kind is bool:
+            lowered = self.strip().lower()
+            if lowered in ('true', 'yes', 'on', '1'):
+                return True
+            if lowered in ('false', 'no', 'off', '0'):
+                return False
+        else:
+            try:
+                return kind(self)
+            except ValueError:
+                pass
+        raise ConfigError(f"{name}: expected {kind.__name__}, got {str(self)!r}")
+
+
+def _value(options, path, key, kind, default=_REQUIRED, choices=None, minimum=None, positive=False):
+    """Read and check one option, ints are accepted where floats are expected and numbers where strings are"""
+    name = f"{path}.{key}" if path else key
+    value = options.get(key)
+    if value is None:
+        if default is _REQUIRED:
+            raise ConfigError(f"{name}: required")
+        return default
+    if isinstance(value, _EnvironmentValue):
+        value = value.convert(kind, name)
+    if kind is float and isinstance(value, int) and not isinstance(value, bool):
+        value = float(value)
+    if kind is str and isinstance(value, (int, float)) and not isinstance(value, bool):
+        # YAML reads unquoted digits as numbers, e.g. password: 123456
+        value = str(value)
+    if not isinstance(value, kind) or (kind is not bool and isinstance(value, bool)):
+        raise ConfigError(f"{name}: expected {kind.__name__}, got {value!r}")
+    if choices is not None and value not in choices:
+        raise ConfigError(f"{name}: must be one of {', '.join(choices)}, got {value!r}")
+    if minimum is not None and value < minimum:
+        raise ConfigError(f"{name}: must be at least {minimum}, got {value!r}")
+    if positive and value <= 0:
+        raise ConfigError(f"{name}: must be positive, got {value!r}")
+    return value
+
+
+def _number(options, path, key, default=_REQUIRED, **checks):
+    return _value(options, path, key, float, default, **checks)
+
+
+def parse_filter(options, path):
+    options = _mapping(options, path)
+    _check_keys(options, path, ('deadband', 'deadband_percent', 'min_interval', 'max_interval', 'smoothing',
+                                'window', 'precision'))
+    for key in ('deadband', 'deadband_percent', 'min_interval'):
+        _number(options, path, key, 0.0, minimum=0)
+    _number(options, path, 'max_interval', None, positive=True)
+    _value(options, path, 'smoothing', str, None, choices=SMOOTHING)
+    _value(options, path, 'window', int, 5, minimum=1)
+    _value(options, path, 'precision', int, 2, minimum=0)
+
+
+def parse_rollup(options, path):
+    options = _mapping(options, path)
+    _check_keys(options, path, ('interval', 'aggregates', 'raw', 'precision'))
+    _number(options, path, 'interval', 300.0, positive=True)
+    aggregates = options.get('aggregates', AGGREGATES)
+    if not isinstance(aggregates, (list, tuple)) or not aggregates:
+        raise ConfigError(f"{path}.aggregates: expected a list of {', '.join(AGGREGATES)}")
+    for aggregate in aggregates:
+        if aggregate not in AGGREGATES:
+            raise ConfigError(f"{path}.aggregates: must be one of {', '.join(AGGREGATES)}, got {aggregate!r}")
+    _value(options, path, 'raw', bool, True)
+    _value(options, path, 'precision', int, 2, minimum=0)
+
+
+def parse_calibration(options, path):
+    options = _mapping(options, path)
+    for measurement, correction in options.items():
+        correction_path = f"{path}.{measurement}"
+        correction = _mapping(correction, correction_path)
+        _check_keys(correction, correction_path, ('offset', 'scale', 'polynomial', 'unit', 'precision'))
+        _number(correction, correction_path, 'offset', 0.0)
+        _number(correction, correction_path, 'scale', 1.0)
+        polynomial = correction.get('polynomial')
+        if polynomial is not None:
+            if (not isinstance(polynomial, list) or not polynomial
+                    or not all(isinstance(c, (int, float)) and not isinstance(c, bool) for c in polynomial)):
+                raise ConfigError(f"{correction_path}.polynomial: expected a list of coefficients, got {polynomial!r}")
+            if 'offset' in correction or 'scale' in correction:
+                raise ConfigError(f"{correction_path}: use either polynomial or offset and scale")
+        _value(correction, correction_path, 'unit', str, None, choices=tuple(UNITS))
+        _value(correction, correction_path, 'precision', int, 2, minimum=0)
+
+
+def parse_adaptive(options, path, update_interval):
+    options = _mapping(options, path)
+    _check_keys(options, path, ('min_interval', 'max_interval', 'threshold'))
+    minimum = _number(options, path, 'min_interval', update_interval, positive=True)
+    _number(options, path, 'max_interval', max(minimum, update_interval * 10), minimum=minimum)
+    threshold = options.get('threshold', 1.0)
+    if isinstance(threshold, dict):
+        for measurement in threshold:
+            _number(threshold, f"{path}.threshold", measurement, positive=True)
+    else:
+        _number(options, path, 'threshold', 1.0, positive=True)
+
+
+def parse_brokers(options, primary, username, password):
+    """The mqtt.brokers list, entries without credentials use mqtt.username and mqtt.password"""
+    entries = options.get('brokers') or []
+    if not isinstance(entries, list):
+        raise ConfigError(f"mqtt.brokers: expected a list, got {type(entries).__name__}")
+    brokers, seen = [], {primary}
+    for index, entry in enumerate(entries):
+        path = f"mqtt.brokers[{index}]"
+        entry = _mapping(entry, path)
+        _check_keys(entry, path, BrokerConfig.__slots__)
+        broker = BrokerConfig(
+            broker=_value(entry, path, 'broker', str),
+            port=_value(entry, path, 'port', int, 1883, minimum=1),
+            username=_value(entry, path, 'username', str, username),
+            password=_value(entry, path, 'password', str, password),
+        )
+        if (broker.broker, broker.port) in seen:
+            raise ConfigError(f"{path}: duplicate broker {broker.broker}:{broker.port}")
+        seen.add((broker.broker, broker.port))
+        brokers.append(broker)
+    return tuple(brokers)
+
+
+def parse_isolation(options, path):
+    if isinstance(options, bool):
+        return
+    options = _mapping(options, path)
+    _check_keys(options, path, ('cpu_time', 'restart_delay', 'restart_max_delay'))
+    _number(options, path, 'cpu_time', None, positive=True)
+    delay = _number(options, path, 'restart_delay', 1.0, positive=True)
+    _number(options, path, 'restart_max_delay', max(delay, 60.0), minimum=delay)
+
+
+def parse_sensor(options, path):
+    """Check a sensors[] entry, returns None for disabled sensors"""
+    options = _mapping(options, path)
+    if not _value(options, path, 'enabled', bool, True):
+        return None
+    sensor_type = _value(options, path, 'type', str)
+    _number(options, path, 'read_timeout', None, positive=True)
+    if 'filter' in options:
+        parse_filter(options['filter'], f"{path}.filter")
+    if 'rollup' in options:
+        parse_rollup(options['rollup'], f"{path}.rollup")
+    if 'calibration' in options:
+        parse_calibration(options['calibration'], f"{path}.calibration")
+    if 'isolation' in options:
+        parse_isolation(options['isolation'], f"{path}.isolation")
+    if 'adaptive' in options:
+        parse_adaptive(options['adaptive'], f"{path}.adaptive",
+                       _number(options, path, 'update_interval', 60.0, positive=True))
+    derived = options.get('derived') or []
+    if not isinstance(derived, list) or any(name not in DERIVED for name in derived):
+        raise ConfigError(f"{path}.derived: expected a list of {', '.join(DERIVED)}, got {derived!r}")
+    return SensorConfig(
+        type=sensor_type,
+        name=_value(options, path, 'name', str, sensor_type),
+        update_interval=_number(options, path, 'update_interval', 60.0, positive=True),
+        options=options,
+    )
+
+
+def parse_device(options, path='device'):
+    """Check a device with its sensors"""
+    options = _mapping(options, path)
+    name = _value(options, path, 'name', str)
+    sensors_path = f"{path}.sensors" if path != 'device' else 'sensors'
+    entries = options.get('sensors') or []
+    if not isinstance(entries, list):
+        raise ConfigError(f"{sensors_path}: expected a list, got {type(entries).__name__}")
+
+    sensors, names = [], set()
+    for index, entry in enumerate(entries):
+        sensor = parse_sensor(entry, f"{sensors_path}[{index}]")
+        if sensor is None:
+            continue
+        if sensor.name in names:
+            raise ConfigError(f"{sensors_path}[{index}]: duplicate sensor name '{sensor.name}', "
+                              f"give each sensor a unique 'name'")
+        names.add(sensor.name)
+        sensors.append(sensor)
+    return DeviceConfig(
+        name=name,
+        id=device_id(name),
+        compact_state=_value(options, path, 'compact_state', bool, False),
+        sensors=tuple(sensors),
+    )
+
+
+def parse_devices(raw):
+    """The devices of a configuration, from a devices: list or the single device: and sensors: form"""
+    if raw.get('devices'):
+        if not isinstance(raw['devices'], list):
+            raise ConfigError(f"devices: expected a list, got {type(raw['devices']).__name__}")
+        devices = [parse_device(device, f"devices[{index}]") for index, device in enumerate(raw['devices'])]
+    else:
+        device = dict(_mapping(raw.get('device'), 'device'))
+        device['sensors'] = raw.get('sensors')
+        devices = [parse_device(device)]
+
+    ids = set()
+    for device in devices:
+        if device.id in ids:
+            raise ConfigError(f"devices: duplicate device name '{device.name}'")
+        ids.add(device.id)
+    return tuple(devices)
+
+
+def apply_environment(raw, environ):
+    """Return a copy of raw with SENSOR_CONTAINER_<SECTION>__<OPTION> variables applied"""
+    raw = dict(raw)
+    for variable, value in environ.items():
+        if not variable.startswith(ENV_PREFIX):
+            continue
+        path = variable[len(ENV_PREFIX):].lower().split('__')
+        if len(path) == 1:
+            raw[path[0]] = _EnvironmentValue(value)
+        elif len(path) == 2:
+            section = dict(_mapping(raw.get(path[0]), path[0]))
+            section[path[1]] = _EnvironmentValue(value)
+            raw[path[0]] = section
+    return raw
+
+
+def parse_config(raw, environ=None):
+    """
+    Validate a configuration loaded from config.yml
+
+    Environment variables override file values, defaults are filled in and
+    every error names the offending option. Raises ConfigError.
+    """
+    raw = apply_environment(_mapping(raw, 'config'), os.environ if environ is None else environ)
+    devices = parse_devices(raw)
+
+    options = _mapping(raw.get('mqtt'), 'mqtt')
+    _check_keys(options, 'mqtt', MqttConfig.__slots__ + ('availability',))
+    default_client_id = socket.gethostname() if raw.get('devices') else devices[0].name
+    client_id = _value(options, 'mqtt', 'client_id', str, f"{default_client_id}_sensor_container")
+    availability_topic = None
+    if _value(options, 'mqtt', 'availability', bool, True):
+        availability_topic = _value(options, 'mqtt', 'availability_topic', str,
+                                    f"homeassistant/sensor/{device_id(client_id)}/availability")
+    reconnect_delay = _number(options, 'mqtt', 'reconnect_delay', 1.0, positive=True)
+    protocol = _value({'protocol': str(options.get('protocol', '3.1.1'))}, 'mqtt', 'protocol', str,
+                      choices=PROTOCOLS)
+    if protocol != '5':
+        v5_only = sorted(set(options) & {'session_expiry', 'topic_aliases', 'message_expiry', 'timestamps'})
+        if v5_only:
+            raise ConfigError(f"mqtt.{v5_only[0]}: needs mqtt.protocol 5")
+    broker = _value(options, 'mqtt', 'broker', str)
+    port = _value(options, 'mqtt', 'port', int, 1883, minimum=1)
+    username = _value(options, 'mqtt', 'username', str, None)
+    password = _value(options, 'mqtt', 'password', str, None)
+    mqtt = MqttConfig(
+        broker=broker,
+        port=port,
+        username=username,
+        password=password,
+        client_id=client_id,
+        keepalive=_value(options, 'mqtt', 'keepalive', int, 60, minimum=1),
+        clean_session=_value(options, 'mqtt', 'clean_session', bool, True),
+        reconnect_delay=reconnect_delay,
+        reconnect_max_delay=_number(options, 'mqtt', 'reconnect_max_delay', 120.0, minimum=reconnect_delay),
+        availability_topic=availability_topic,
+        protocol=protocol,
+        session_expiry=_value(options, 'mqtt', 'session_expiry', int, 3600, minimum=0),
+        topic_aliases=_value(options, 'mqtt', 'topic_aliases', int, 16, minimum=0),
+        message_expiry=_value(options, 'mqtt', 'message_expiry', int, None, minimum=1),
+        timestamps=_value(options, 'mqtt', 'timestamps', bool, False),
+        brokers=parse_brokers(options, (broker, port), username, password),
+        mode=_value(options, 'mqtt', 'mode', str, 'failover', choices=MODES),
+    )
+
+    options = _mapping(raw.get('publish'), 'publish')
+    _check_keys(options, 'publish', PublishConfig.__slots__)
+    publish = PublishConfig(
+        max_queue=_value(options, 'publish', 'max_queue', int, 1000, minimum=1),
+        policy=_value(options, 'publish', 'policy', str, 'drop_oldest', choices=POLICIES),
+        max_inflight=_value(options, 'publish', 'max_inflight', int, 20, minimum=0),
+        rate_limit=_number(options, 'publish', 'rate_limit', 0.0, minimum=0),
+        batch_size=_value(options, 'publish', 'batch_size', int, 50, minimum=1),
+    )
+
+    spool = SpoolConfig()
+    if 'spool' in raw:
+        options = _mapping(raw['spool'], 'spool')
+        _check_keys(options, 'spool', SpoolConfig.__slots__)
+        spool = SpoolConfig(
+            path=_value(options, 'spool', 'path', str, 'spool.bin'),
+            max_size_mb=_number(options, 'spool', 'max_size_mb', 4.0, positive=True),
+            sync_interval=_number(options, 'spool', 'sync_interval', 5.0, minimum=0),
+            replay_rate=_number(options, 'spool', 'replay_rate', 10.0, positive=True),
+        )
+
+    options = _mapping(raw.get('discovery'), 'discovery')
+    _check_keys(options, 'discovery', DiscoveryConfig.__slots__)
+    discovery = DiscoveryConfig(
+        cache_file=_value(options, 'discovery', 'cache_file', str, None),
+        verify_retained=_value(options, 'discovery', 'verify_retained', bool, True),
+    )
+
+    metrics = MetricsConfig()
+    if 'metrics' in raw:
+        options = _mapping(raw['metrics'], 'metrics')
+        _check_keys(options, 'metrics', MetricsConfig.__slots__)
+        metrics = MetricsConfig(
+            port=_value(options, 'metrics', 'port', int, 9100, minimum=0),
+            host=_value(options, 'metrics', 'host', str, '0.0.0.0'),
+        )
+
+    sampling = SamplingConfig()
+    if 'sampling' in raw:
+        options = _mapping(raw['sampling'], 'sampling')
+        _check_keys(options, 'sampling', SamplingConfig.__slots__)
+        sampling = SamplingConfig(
+            max_backoff=_number(options, 'sampling', 'max_backoff', 4.0, minimum=1),
+            queue_threshold=_number(options, 'sampling', 'queue_threshold', 0.5, minimum=0),
+            latency_threshold=_number(options, 'sampling', 'latency_threshold', 1.0, positive=True),
+        )
+        if sampling.queue_threshold >= 1:
+            raise ConfigError(f"sampling.queue_threshold: must be below 1, got {sampling.queue_threshold!r}")
+
+    bus = BusConfig()
+    if 'bus' in raw:
+        options = _mapping(raw['bus'], 'bus')
+        _check_keys(options, 'bus', BusConfig.__slots__)
+        bus = BusConfig(
+            path=_value(options, 'bus', 'path', str, '/dev/shm/sensor_container.bus'),
+            slots=_value(options, 'bus', 'slots', int, 1024, minimum=1),
+            sensors=_value(options, 'bus', 'sensors', int, 64, minimum=1),
+            record_size=_value(options, 'bus', 'record_size', int, 256, minimum=64),
+        )
+
+    options = _mapping(raw.get('logging'), 'logging')
+    _check_keys(options, 'logging', LoggingConfig.__slots__)
+    levels = _mapping(options.get('levels'), 'logging.levels')
+    for module, level in levels.items():
+        _value({module: str(level).upper()}, 'logging.levels', module, str, choices=LOG_LEVELS)
+    logging = LoggingConfig(
+        level=_value({'level': str(options.get('level', 'INFO')).upper()}, 'logging', 'level', str,
+                     choices=LOG_LEVELS),
+        format=_value(options, 'logging', 'format', str, 'json', choices=FORMATS),
+        levels={module: str(level).upper() for module, level in levels.items()},
+        rate_limit=_number(options, 'logging', 'rate_limit', 60.0, minimum=0),
+        queue_size=_value(options, 'logging', 'queue_size', int, 10000, minimum=1),
+    )
+
+    return Config(
+        mqtt=mqtt,
+        devices=devices,
+        publish=publish,
+        spool=spool,
+        discovery=discovery,
+        metrics=metrics,
+        sampling=sampling,
+        bus=bus,
+        logging=logging,
+        read_workers=_value(raw, '', 'read_workers', int, None, minimum=1),
+        reload_interval=_number(raw, '', 'reload_interval', 2.0, minimum=0),
+    )
@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def digest(payload):
+    """Content hash of a discovery payload"""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return hashlib.sha256(payload).hexdigest()
+
+
+class DiscoveryCache:
+    """
+    Hashes of the discovery configs already published to the broker
+
+    Configs whose hash matches the cache are not published again, so a
+    restart or reconnect only sends new or changed configs. The cache is
+    stored as JSON and belongs to one broker (scope); a cache written for
+    another broker is ignored.
+    """
+
+    def __init__(self, path=None, scope='', verify_retained=True):
+        self.path = path
+        self.scope = scope
+        self.verify_retained = verify_retained
+        self.hashes = {}
+        self._dirty = False
+        if path is not None:
+            self._load()
+
+    @classmethod
+    def from_config(cls, options, scope='', suffix=''):
+        """
+        Create a cache from the discovery section (a DiscoveryConfig), None when caching is disabled
+        suffix is appended to the file name, e.g. to keep one cache per broker
+        """
+        if not options.cache_file:
+            return None
+        return cls(options.cache_file + suffix, scope=scope, verify_retained=options.verify_retained)
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logger.warning("Ignoring unreadable discovery cache %s", self.path)
+            return
+        if data.get('scope') == self.scope:
+            self.hashes = data.get('hashes', {})
+
+    def save(self):
+        """Write the cache if it changed, replacing the file atomically"""
+        if self.path is None or not self._dirty:
+            return
+        temporary = f"{self.path}.tmp"
+        with open(temporary, 'w') as file:
+            json.dump({'scope': self.scope, 'hashes': self.hashes}, file)
+        os.replace(temporary, self.path)
+        self._dirty = False
+
+    def is_current(self, topic, payload):
+        """True if exactly this payload was already published to topic"""
+        return self.hashes.get(topic) == digest(payload)
+
+    def update(self, topic, payload):
+        value = digest(payload)
+        if self.hashes.get(topic) != value:
+            self.hashes[topic] = value
+            self._dirty = True
+
+    def forget(self, topic):
+        if self.hashes.pop(topic, None) is not None:
+            self._dirty = True
+
+    def reconcile(self, retained):
+        """
+        Drop cached hashes that do not match the retained messages on the broker
+        retained maps topics to the retained payloads read back from the broker
+        """
+        for topic in list(self.hashes):
+            payload = retained.get(topic)
+            if payload is None or digest(payload) != self.hashes[topic]:
+                self.forget(topic)
+
+
+async def fetch_retained(client, topics, settle=1.0):
+    """
+    Read back the retained messages of topics from the broker
+
+    The broker sends retained messages right after the subscription is
+    acknowledged; whatever arrived within settle seconds is returned as a
+    {topic: payload} dict.
+    """
+    retained = {}
+    if not topics:
+        return retained
+
+    def on_message(client, userdata, message):
+        if message.retain:
+            retained[message.topic] = message.payload
+
+    for topic in topics:
+        client.message_callback_add(topic, on_message)
+    client.subscribe([(topic, 0) for topic in topics])
+    try:
+        await asyncio.sleep(settle)
+    finally:
+        client.unsubscribe(list(topics))
+        for topic in topics:
+            client.message_callback_remove(topic)
+    return retained
@@ -0,0 +1,306 @@
+import logging
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Third-party packages register drivers under this entry point group, e.g.
+# [project.entry-points."sensor_container.drivers"] bme280 = "mypkg:BME280Driver"
+ENTRY_POINT_GROUP = 'sensor_container.drivers'
+
+logger = logging.getLogger(__name__)
+
+DRIVERS = {}
+_entry_points_loaded = False
+
+
+def register_driver(name):
+    """Class decorator registering a driver for sensors[].type == name"""
+    def decorator(cls):
+        DRIVERS[name] = cls
+        return cls
+    return decorator
+
+
+def entry_points(group):
+    # importlib.metadata adds noticeably to startup and is only needed for unknown sensor types
+    from importlib.metadata import entry_points
+    return entry_points(group=group)
+
+
+def load_entry_point_drivers():
+    """Register drivers published by installed packages, built-in names win"""
+    global _entry_points_loaded
+    _entry_points_loaded = True
+    for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+        if entry_point.name in DRIVERS:
+            continue
+        try:
+            DRIVERS[entry_point.name] = entry_point.load()
+        # Importing a third-party package can raise anything, one broken plugin must not stop the others
+        except Exception as e:  # noqa: BLE001
+            logger.error("Failed to load sensor driver %s: %s", entry_point.name, e)
+
+
+def create_driver(sensor):
+    """
+    Instantiate the driver for a sensors[] entry, wrapped in its calibration if it has one
+    With an isolation option the driver runs in a worker process instead
+    """
+    sensor_type = sensor['type']
+    if sensor_type not in DRIVERS and not _entry_points_loaded:
+        load_entry_point_drivers()
+    if sensor_type not in DRIVERS:
+        raise ValueError(f"Unknown sensor type '{sensor_type}', available: {', '.join(sorted(DRIVERS))}")
+    if sensor.get('isolation'):
+        # isolation imports this module too, the worker process creates the driver itself
+        from isolation import IsolatedDriver
+        return IsolatedDriver.from_config(sensor)
+    driver = DRIVERS[sensor_type](sensor)
+    if sensor.get('calibration') or sensor.get('derived'):
+        # calibration imports this module for SensorDriver
+        from calibration import CalibratedDriver, Calibration
+        try:
+            driver = CalibratedDriver(driver, Calibration.from_config(sensor, driver.measurements))
+        except Exception:
+            driver.close()
+            raise
+    return driver
+
+
+class SensorDriver:
+    """
+    Base class for sensor drivers
+
+    Subclasses list the measurements they provide as (measurement, unit,
+    device class) tuples and implement read(), which may block and returns
+    a {measurement: value} dict. Reads run on the ReadPipeline thread pool
+    and are abandoned once they exceed timeout seconds. Drivers that never
+    block set blocking = False and are read directly on the event loop.
+    Drivers that retry failed attempts inside read() count them in retries.
+    """
+
+    measurements = ()
+    timeout = 5.0
+    blocking = True
+
+    def __init__(self, sensor):
+        self.sensor = sensor
+        self.timeout = sensor.get('read_timeout', self.timeout)
+        self.retries = 0
+
+    def read(self):
+        raise NotImplementedError
+
+    def close(self):
+        """Release hardware resources"""
+
+
+@register_driver('dht11')
+class DHT11Driver(SensorDriver):
+    """DHT11 temperature and humidity sensor on a Raspberry Pi GPIO pin"""
+
+    measurements = (('temperature', "°C", 'temperature'), ('humidity', "%", 'humidity'))
+    timeout = 10.0
+    model = 'DHT11'
+    # Minimum time between two reads of the sensor
+    retry_delay = 1.0
+
+    def __init__(self, sensor):
+        super().__init__(sensor)
+        self.pin = sensor.get('GPIO_pin_RPI', 4)
+        self._device = None
+
+    def _open(self):
+        try:
+            import adafruit_dht
+            import board
+        except ImportError as e:
+            raise RuntimeError(f"{self.model} support requires adafruit-circuitpython-dht: {e}") from e
+        return getattr(adafruit_dht, self.model)(getattr(board, f"D{self.pin}"))
+
+    def read(self):
+        """Read the sensor, retrying checksum and timing errors until the timeout is used up"""
+        if self._device is None:
+            self._device = self._open()
+
+        deadline = time.monotonic() + self.timeout - self.retry_delay
+        while True:
+            try:
+                temperature = self._device.temperature
+                humidity = self._device.humidity
+                if temperature is not None and humidity is not None:
+                    return {'temperature': temperature, 'humidity': humidity}
+                error = RuntimeError("Incomplete reading")
+            except RuntimeError as e:
+                # Bit-banged DHT reads fail regularly, the next attempt usually succeeds
+                error = e
+            if time.monotonic() + self.retry_delay > deadline:
+                raise error
+            self.retries += 1
+            time.sleep(self.retry_delay)
+
+    def close(self):
+        if self._device is not None:
+            self._device.exit()
+            self._device = None
+
+
+@register_driver('dht22')
+class DHT22Driver(DHT11Driver):
+    """DHT22 / AM2302 temperature and humidity sensor"""
+
+    model = 'DHT22'
+    retry_delay = 2.0
+
+
+@register_driver('simulated')
+class SimulatedDriver(SensorDriver):
+    """
+    Deterministic test sensor
+
+    Values follow a sine wave plus seeded noise, so two runs with the same
+    seed produce the same readings. An optional read_delay simulates slow
+    hardware.
+    """
+
+    measurements = (('temperature', "°C", 'temperature'), ('humidity', "%", 'humidity'))
+
+    def __init__(self, sensor):
+        super().__init__(sensor)
+        self.read_delay = sensor.get('read_delay', 0.0)
+        self.blocking = self.read_delay > 0
+        self.period = sensor.get('period', 60)
+        self._random = random.Random(sensor.get('seed', 0))
+        self._count = 0
+
+    def read(self):
+        if self.read_delay:
+            time.sleep(self.read_delay)
+        phase = math.sin(2 * math.pi * self._count / self.period)
+        self._count += 1
+        return {
+            'temperature': round(21.0 + 3.0 * phase + self._random.gauss(0, 0.2), 2),
+            'humidity': round(50.0 - 10.0 * phase + self._random.gauss(0, 1.0), 2),
+        }
+
+
+class ReadPipeline:
+    """
+    Run sensor reads on a bounded thread pool with per-driver timeouts
+
+    The pipeline is used as the scheduler's dispatch function; scheduled jobs
+    are drivers. Results are handed to on_result(name, values) and failures
+    to on_error(name, exception), called from worker threads for blocking
+    drivers and directly from dispatch for non-blocking ones.
+
+    Python threads cannot be killed, so a read that exceeds its driver's
+    timeout is reported as failed and its sensor stays busy until the read
+    returns. A hung sensor therefore ties up at most one worker and never
+    queues further reads behind itself.
+    """
+
+    def __init__(self, on_result, on_error, max_workers=4, clock=time.monotonic, metrics=None):
+        self.on_result = on_result
+        self.on_error = on_error
+        self.clock = clock
+        self.metrics = metrics
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sensor')
+        # name -> [deadline, timed_out, start]
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, batch):
+        self.check_timeouts()
+        for name, driver in batch:
+            self.submit(name, driver)
+
+    def submit(self, name, driver):
+        """Start a read unless the previous read of this sensor is still running"""
+        if not driver.blocking:
+            start = self.clock()
+            try:
+                values = driver.read()
+            # Same as a failed blocking read, any driver error is reported and the sensor read again next interval
+            except Exception as e:  # noqa: BLE001
+                self._failed(name, e)
+            else:
+                self._observe(name, start)
+                self._handle(name, values)
+            return True
+
+        with self._lock:
+            if name in self._in_flight:
+                logger.warning("%s is still being read, skipping this interval", name, extra={'sensor': name})
+                return False
+            start = self.clock()
+            self._in_flight[name] = [start + driver.timeout, False, start]
+
+        future = self._executor.submit(driver.read)
+        future.add_done_callback(lambda f, name=name: self._done(name, f))
+        return True
+
+    def check_timeouts(self):
+        """Report reads running past their deadline as failed"""
+        now = self.clock()
+        expired = []
+        with self._lock:
+            for name, state in self._in_flight.items():
+                if not state[1] and now >= state[0]:
+                    state[1] = True
+                    expired.append(name)
+        for name in expired:
+            self._failed(name, TimeoutError(f"Read of {name} timed out"), reason='timeout')
+
+    def busy(self):
+        """Names of sensors with a read in progress"""
+        with self._lock:
+            return set(self._in_flight)
+
+    def _observe(self, name, start):
+        if self.metrics is not None:
+            self.metrics.read_duration.labels(name).observe(self.clock() - start)
+
+    def _failed(self, name, error, reason='error'):
+        if self.metrics is not None:
+            self.metrics.read_failures.labels(name, reason).inc()
+        self.on_error(name, error)
+
+    def _done(self, name, future):
+        with self._lock:
+            _, timed_out, start = self._in_flight.pop(name)
+        if future.cancelled():
+            return
+        # Late reads are measured too, they show how long a hung sensor really takes
+        self._observe(name, start)
+        if timed_out:
+            # Late results are dropped, the read was already reported as failed
+            return
+        if future.exception() is not None:
+            self._failed(name, future.exception())
+        else:
+            self._handle(name, future.result())
+
+    def _handle(self, name, values):
+        try:
+            self.on_result(name, values)
+        # A reading that cannot be filtered, serialized or queued is reported like a failed read, non-blocking
+        # drivers are handled on the scheduler's task, which must keep running
+        except Exception as e:  # noqa: BLE001
+            self._failed(name, e)
+
+    def resize(self, max_workers):
+        """
+        Read on a pool of max_workers threads from now on, e.g. after sensors were added
+        Reads already running or waiting finish on the old pool, whose threads exit afterwards
+        """
+        if max_workers == self.max_workers:
+            return
+        old, self._executor = self._executor, ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sensor')
+        self.max_workers = max_workers
+        old.shutdown(wait=False)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,148 @@
+import math
+import time
+
+SMOOTHING = ('mean', 'median')
+
+
+def _median(values):
+    # statistics.median without importing statistics (and with it fractions and decimal) at startup
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+class RingBuffer:
+    """Fixed-size buffer keeping the last size values"""
+
+    __slots__ = ('_count', '_index', '_values')
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError(f"Window size must be at least 1, got {size}")
+        self._values = [0.0] * size
+        self._index = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, value):
+        self._values[self._index] = value
+        self._index = (self._index + 1) % len(self._values)
+        self._count = min(self._count + 1, len(self._values))
+
+    def values(self):
+        if self._count < len(self._values):
+            return self._values[:self._count]
+        return self._values
+
+
+class MeasurementFilter:
+    """
+    Report-by-exception filter for one measurement
+
+    A value is published when it is the first one, when max_interval
+    seconds passed since the last publish (heartbeat), or when it moved
+    beyond the deadband and at least min_interval seconds passed. When both
+    an absolute and a percent deadband are set, a change has to exceed both.
+    Numeric values can first be smoothed with a moving mean or median.
+    """
+
+    def __init__(self, deadband=0.0, deadband_percent=0.0, min_interval=0.0, max_interval=None,
+                 smoothing=None, window=5, precision=2):
+        if smoothing is not None and smoothing not in SMOOTHING:
+            raise ValueError(f"Unknown smoothing '{smoothing}', use one of {', '.join(SMOOTHING)}")
+        self.deadband = deadband
+        self.deadband_percent = deadband_percent
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.smoothing = smoothing
+        self.precision = precision
+        self._window = RingBuffer(window) if smoothing else None
+        self.last_value = None
+        self._last_time = None
+
+    def _smooth(self, value):
+        self._window.append(value)
+        values = self._window.values()
+        result = math.fsum(values) / len(values) if self.smoothing == 'mean' else _median(values)
+        return round(result, self.precision)
+
+    def _changed(self, value):
+        last = self.last_value
+        if not isinstance(value, (int, float)) or not isinstance(last, (int, float)):
+            return value != last
+        change = abs(value - last)
+        if change == 0:
+            return False
+        if self.deadband and change < self.deadband:
+            return False
+        return not self.deadband_percent or change >= abs(last) * self.deadband_percent / 100
+
+    def update(self, value, now):
+        """Return the value to publish, or None to suppress it"""
+        if self._window is not None and isinstance(value, (int, float)):
+            value = self._smooth(value)
+
+        if self._last_time is not None:
+            elapsed = now - self._last_time
+            heartbeat = self.max_interval is not None and elapsed >= self.max_interval
+            if not heartbeat and (elapsed < self.min_interval or not self._changed(value)):
+                return None
+
+        self.last_value = value
+        self._last_time = now
+        return value
+
+
+class SensorFilter:
+    """Filters for every measurement of one sensor, configured by its filter: section"""
+
+    def __init__(self, options, clock=time.monotonic):
+        self.options = options
+        self.clock = clock
+        self._filters = {}
+        # Raise configuration errors at startup rather than on the first reading
+        self._create()
+
+    @classmethod
+    def from_config(cls, sensor, clock=time.monotonic):
+        """Create the filter of a sensors[] entry, None when it has no filter section"""
+        options = sensor.get('filter')
+        if not options:
+            return None
+        return cls(options, clock=clock)
+
+    def _create(self):
+        return MeasurementFilter(
+            deadband=self.options.get('deadband', 0.0),
+            deadband_percent=self.options.get('deadband_percent', 0.0),
+            min_interval=self.options.get('min_interval', 0.0),
+            max_interval=self.options.get('max_interval'),
+            smoothing=self.options.get('smoothing'),
+            window=self.options.get('window', 5),
+            precision=self.options.get('precision', 2),
+        )
+
+    def latest(self):
+        """Last published value of every measurement"""
+        return {
+            measurement: measurement_filter.last_value
+            for measurement, measurement_filter in self._filters.items()
+            if measurement_filter.last_value is not None
+        }
+
+    def apply(self, values):
+        """Return the subset of a reading that should be published"""
+        now = self.clock()
+        published = {}
+        for measurement, value in values.items():
+            measurement_filter = self._filters.get(measurement)
+            if measurement_filter is None:
+                measurement_filter = self._filters[measurement] = self._create()
+            result = measurement_filter.update(value, now)
+            if result is not None:
+                published[measurement] = result
+        return published
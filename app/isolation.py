@@ -0,0 +1,184 @@
+import logging
+import math
+import multiprocessing
+import pickle
+import signal
+import sys
+import threading
+import time
+
+from drivers import DRIVERS, SensorDriver, create_driver
+from runtime import Backoff
+
+logger = logging.getLogger(__name__)
+
+# Worker processes start from a fresh interpreter, forking a process with running threads is unsafe
+_context = multiprocessing.get_context('spawn')
+
+
+def _exit_reason(exitcode):
+    if exitcode == -signal.SIGXCPU:
+        return "exceeded its CPU time budget"
+    if exitcode is not None and exitcode < 0:
+        return f"was killed by {signal.Signals(-exitcode).name}"
+    return f"exited with code {exitcode}"
+
+
+def _picklable(error):
+    try:
+        pickle.dumps(error)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return RuntimeError(f"{type(error).__name__}: {error}")
+    return error
+
+
+def _serve(sensor, connection, cpu_time):
+    """Worker process: create the driver and answer read requests until told to stop"""
+    # Ctrl+C reaches the whole process group, the container stops its workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # terminate() still closes the driver
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    driver = None
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    try:
+        driver = create_driver(sensor)
+        while connection.recv():
+            if cpu_time and resource is not None:
+                # The kernel sends SIGXCPU, which ends the process, once the read used up its budget
+                used = time.process_time()
+                _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+                soft = math.ceil(used + cpu_time)
+                resource.setrlimit(resource.RLIMIT_CPU, (soft if hard == resource.RLIM_INFINITY else min(soft, hard),
+                                                         hard))
+            try:
+                connection.send((True, driver.read(), driver.retries))
+            # Any driver error is sent to the container, which reports it like a failed read in its own process
+            except Exception as e:  # noqa: BLE001
+                connection.send((False, _picklable(e), driver.retries))
+    except EOFError:
+        pass
+    finally:
+        if driver is not None:
+            driver.close()
+
+
+class IsolatedDriver(SensorDriver):
+    """
+    Run a sensor's driver in a worker process of its own
+
+    A driver that crashes the interpreter (e.g. a segfault in a C
+    extension), hangs or burns CPU only takes down its worker, never the
+    container. read() sends a request over the worker's pipe and waits at
+    most timeout seconds for the reading; a worker that does not answer in
+    time is killed, which frees the hung read that a thread could never
+    abandon. With cpu_time, a read using more than that many CPU seconds
+    is ended by the kernel (RLIMIT_CPU). A dead worker is restarted on the
+    first read after a jittered, growing delay from backoff; reads before
+    that fail right away. measurements come from the driver class and the
+    calibration, so the driver itself is only ever created in the worker.
+    """
+
+    def __init__(self, sensor, measurements, timeout=None, cpu_time=None, backoff=None):
+        super().__init__(sensor)
+        self.name = sensor.get('name', sensor['type'])
+        self.measurements = measurements
+        if timeout is not None:
+            self.timeout = timeout
+        self.cpu_time = cpu_time
+        self.backoff = backoff if backoff is not None else Backoff(1.0, 60.0)
+        self.restarts = 0
+        self._sensor = {key: value for key, value in sensor.items() if key != 'isolation'}
+        # One request at a time on the pipe
+        self._lock = threading.Lock()
+        self._process = None
+        self._connection = None
+        self._restart_at = 0.0
+        self._closed = False
+        self._start()
+
+    @classmethod
+    def from_config(cls, sensor):
+        """Isolated driver of a sensors[] entry with an isolation option (true or a mapping)"""
+        options = sensor['isolation'] if isinstance(sensor['isolation'], dict) else {}
+        driver_class = DRIVERS[sensor['type']]
+        measurements = driver_class.measurements
+        if sensor.get('calibration') or sensor.get('derived'):
+            from calibration import Calibration
+            measurements = Calibration.from_config(sensor, measurements).measurements
+        delay = options.get('restart_delay', 1.0)
+        return cls(sensor, measurements, timeout=sensor.get('read_timeout', driver_class.timeout),
+                   cpu_time=options.get('cpu_time'),
+                   backoff=Backoff(delay, max(delay, options.get('restart_max_delay', 60.0))))
+
+    @property
+    def pid(self):
+        """Process id of the running worker, None while it is down"""
+        return self._process.pid if self._process is not None else None
+
+    def _start(self):
+        self._connection, child = _context.Pipe()
+        self._process = _context.Process(target=_serve, args=(self._sensor, child, self.cpu_time),
+                                         name=f"sensor-{self.name}", daemon=True)
+        self._process.start()
+        child.close()
+
+    def _stop(self, timeout=1.0):
+        """End the worker, returns its exit code"""
+        process, self._process = self._process, None
+        self._connection.close()
+        process.join(timeout)
+        if process.exitcode is None:
+            process.kill()
+            process.join()
+        return process.exitcode
+
+    def _failed(self, reason):
+        """Stop the worker and schedule its restart, returns the error to raise"""
+        delay = self.backoff.next()
+        self._restart_at = time.monotonic() + delay
+        self.restarts += 1
+        logger.warning("Worker of %s %s, restarting it in %.1f s", self.name, reason, delay,
+                       extra={'sensor': self.name, 'restarts': self.restarts})
+        return RuntimeError(f"Worker of {self.name} {reason}")
+
+    def read(self):
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(f"{self.name} was closed")
+            if self._process is None:
+                wait = self._restart_at - time.monotonic()
+                if wait > 0:
+                    raise RuntimeError(f"Worker of {self.name} is restarting in {wait:.1f} s")
+                self._start()
+            try:
+                self._connection.send(True)
+                answered = self._connection.poll(self.timeout)
+                if answered:
+                    ok, value, self.retries = self._connection.recv()
+            except (EOFError, OSError):
+                exitcode = self._stop()
+                if self._closed:
+                    raise RuntimeError(f"{self.name} was closed") from None
+                raise self._failed(_exit_reason(exitcode)) from None
+            if not answered:
+                self._process.kill()
+                self._stop()
+                self._failed(f"did not answer within {self.timeout} s")
+                raise TimeoutError(f"Read of {self.name} timed out, its worker was killed")
+            self.backoff.reset()
+        if not ok:
+            raise value
+        return value
+
+    def close(self):
+        self._closed = True
+        process = self._process
+        if process is not None and process.is_alive():
+            # SIGTERM makes the worker close its driver, even in the middle of a read
+            process.terminate()
+            process.join(1.0)
+            if process.exitcode is None:
+                process.kill()
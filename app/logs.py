@@ -0,0 +1,149 @@
+import copy
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from datetime import UTC, datetime
+from logging.handlers import QueueHandler, QueueListener
+
+FORMATS = ('json', 'text')
+
+# Attributes every LogRecord has, anything else was passed with extra={...}
+_RECORD_ATTRIBUTES = set(logging.makeLogRecord({}).__dict__) | {'message', 'asctime'}
+
+
+def _extra(record):
+    return {key: value for key, value in record.__dict__.items() if key not in _RECORD_ATTRIBUTES}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, fields passed with extra= (device, sensor, ...) are included"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, UTC).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in _extra(record).items():
+            entry[key] = value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """Human readable lines with extra fields appended as key=value"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def formatMessage(self, record):
+        line = super().formatMessage(record)
+        extra = _extra(record)
+        if extra:
+            line += ' ' + ' '.join(f"{key}={value}" for key, value in extra.items())
+        return line
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let identical messages through at most once per interval seconds
+
+    A failing sensor read every second would otherwise log the same error
+    every second. The first message let through after suppressing repeats
+    carries their number in its suppressed field.
+    """
+
+    def __init__(self, interval=60.0, max_keys=1000, clock=time.monotonic):
+        super().__init__()
+        self.interval = interval
+        self.max_keys = max_keys
+        self.clock = clock
+        # (logger, level, message, extra fields) -> [time last let through, suppressed since]
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.interval:
+            return True
+        # Fields such as sensor and device are part of the identity, the same error of two sensors is not a repeat
+        key = (record.name, record.levelno, record.getMessage(), repr(sorted(_extra(record).items())))
+        now = self.clock()
+        with self._lock:
+            state = self._seen.get(key)
+            if state is not None and now - state[0] < self.interval:
+                state[1] += 1
+                return False
+            if state is not None and state[1]:
+                record.suppressed = state[1]
+            if len(self._seen) >= self.max_keys:
+                self._prune(now)
+            self._seen[key] = [now, 0]
+        return True
+
+    def _prune(self, now):
+        for key, state in list(self._seen.items()):
+            if now - state[0] >= self.interval:
+                del self._seen[key]
+        if len(self._seen) >= self.max_keys:
+            self._seen.clear()
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler for a bounded queue that drops records instead of blocking or raising when it is full"""
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        """Merge the arguments in the calling thread, keeping extra fields and the traceback separate"""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(options, stream=None):
+    """
+    Configure logging from the logging section (a LoggingConfig)
+
+    Records are queued by the calling thread and written to stream (stdout)
+    by a QueueListener thread, so logging never blocks on slow output.
+    Returns the listener, stop() it on shutdown to flush the queue.
+    """
+    if options.format not in FORMATS:
+        raise ValueError(f"Unknown log format '{options.format}', use one of {', '.join(FORMATS)}")
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if options.format == 'json' else TextFormatter())
+    handler = DroppingQueueHandler(queue.Queue(options.queue_size))
+    handler.addFilter(RateLimitFilter(options.rate_limit))
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        if isinstance(existing, DroppingQueueHandler):
+            root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(options.level)
+    for name, level in options.levels.items():
+        logging.getLogger(name).setLevel(level)
+
+    listener = QueueListener(handler.queue, output)
+    listener.start()
+    return listener
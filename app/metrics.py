@@ -0,0 +1,291 @@
+import asyncio
+import bisect
+import logging
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+READ_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0)
+PUBLISH_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Value:
+    __slots__ = ('_lock', 'value')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _Buckets:
+    __slots__ = ('_lock', 'bounds', 'count', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Metric:
+    """
+    A metric family with optional labels
+
+    Metrics without labels are updated directly (counter.inc()), labelled
+    ones through their children (counter.labels('dht11').inc()).
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def _new(self):
+        return _Value()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new())
+        return child
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            yield self.name, _labels(self.label_names, values), child.value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {_number(value)}" for name, labels, value in self._samples()]
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=READ_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket
+                yield (f"{self.name}_bucket", _labels(self.label_names, values, f'le="{_number(bound)}"'),
+                       cumulative)
+            yield f"{self.name}_sum", _labels(self.label_names, values), total
+            yield f"{self.name}_count", _labels(self.label_names, values), count
+
+
+class CallbackMetric(Metric):
+    """Metric read from existing state when scraped, callback returns a value or a {label values: value} dict"""
+
+    def __init__(self, name, documentation, kind, callback, labels=()):
+        super().__init__(name, documentation, labels)
+        self.kind = kind
+        self.callback = callback
+
+    def _samples(self):
+        result = self.callback()
+        if not isinstance(result, dict):
+            result = {(): result}
+        for values, value in result.items():
+            yield self.name, _labels(self.label_names, values), value
+
+
+class Registry:
+    """Collection of metrics rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Duplicate metric '{metric.name}'")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=READ_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def callback(self, name, documentation, kind, callback, labels=()):
+        return self.register(CallbackMetric(name, documentation, kind, callback, labels))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                lines += metric.render()
+            # Callback metrics read the state of other components, one failing must not break the whole scrape
+            except Exception as e:  # noqa: BLE001
+                logger.error("Failed to collect metric %s: %s", metric.name, e)
+        return '\n'.join(lines) + '\n'
+
+
+class Metrics:
+    """
+    The sensor container's metrics and the HTTP endpoint serving them
+
+    Hot path metrics (read and publish latency, failures, bytes) are
+    updated as they happen; queue depth, totals kept by the publish queue
+    and driver retries are read from their owners when scraped.
+    """
+
+    def __init__(self, host='0.0.0.0', port=9100, clock=time.monotonic):
+        self.host = host
+        self.port = port
+        self.clock = clock
+        self.registry = registry = Registry()
+        self.read_duration = registry.histogram(
+            'sensor_container_read_duration_seconds', 'Duration of sensor reads', ('sensor',), READ_BUCKETS)
+        self.read_failures = registry.counter(
+            'sensor_container_read_failures_total', 'Failed sensor reads', ('sensor', 'reason'))
+        self.publish_duration = registry.histogram(
+            'sensor_container_publish_duration_seconds',
+            'Time from queueing a message until the MQTT client confirmed it', buckets=PUBLISH_BUCKETS)
+        self.bytes_sent = registry.counter(
+            'sensor_container_bytes_sent_total', 'Topic and payload bytes handed to the MQTT client')
+        self.reconnects = registry.counter(
+            'sensor_container_reconnects_total', 'Connections to the MQTT broker after the first one')
+        self.loop_lag = registry.histogram(
+            'sensor_container_loop_lag_seconds', 'Delay of event loop callbacks', buckets=LAG_BUCKETS)
+        self._server = None
+
+    @classmethod
+    def from_config(cls, options):
+        """Create the metrics from the metrics section (a MetricsConfig), None when the endpoint is disabled"""
+        if options.port is None:
+            return None
+        return cls(host=options.host, port=options.port)
+
+    def watch_queue(self, queue):
+        registry = self.registry
+        registry.callback('sensor_container_queue_depth', 'Messages waiting in the publish queue', 'gauge',
+                          lambda: queue.depth)
+        registry.callback('sensor_container_messages_inflight', 'Messages handed to the MQTT client, not yet sent',
+                          'gauge', lambda: queue.inflight)
+        registry.callback('sensor_container_messages_sent_total', 'Messages handed to the MQTT client', 'counter',
+                          lambda: queue.sent)
+        registry.callback('sensor_container_messages_dropped_total', 'Messages dropped by the publish queue',
+                          'counter', lambda: queue.dropped)
+        registry.callback('sensor_container_publish_refused_total', 'Publishes refused by the MQTT client',
+                          'counter', lambda: queue.failed)
+
+    def watch_drivers(self, drivers):
+        """drivers maps the scheduler job name of each sensor to its driver"""
+        self.registry.callback(
+            'sensor_container_read_retries_total', 'Sensor read attempts retried inside the driver', 'counter',
+            lambda: {(name,): driver.retries for name, driver in drivers.items()}, ('sensor',))
+
+    def watch_spool(self, spool):
+        self.registry.callback('sensor_container_spool_bytes', 'Bytes of readings waiting in the spool', 'gauge',
+                               lambda: spool.used)
+
+    def render(self):
+        return self.registry.render()
+
+    async def monitor_loop(self, interval=1.0):
+        """Measure how late the event loop wakes up a sleeping task, until cancelled"""
+        while True:
+            start = self.clock()
+            await asyncio.sleep(interval)
+            self.loop_lag.observe(max(0.0, self.clock() - start - interval))
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("Serving metrics on http://%s:%s/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+            method, path = request.split(b' ', 2)[:2]
+            if method != b'GET':
+                status, body = '405 Method Not Allowed', b''
+            elif path.split(b'?')[0] in (b'/metrics', b'/'):
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b''
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,86 @@
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+
+def session_properties(session_expiry):
+    """CONNECT properties asking the broker to keep the session for session_expiry seconds"""
+    properties = Properties(PacketTypes.CONNECT)
+    properties.SessionExpiryInterval = session_expiry
+    return properties
+
+
+class PublishProperties:
+    """
+    MQTT v5 properties of the messages handed to the client by the publish queue
+
+    Topic aliases: the first message to a topic carries the topic and a new
+    alias, later messages only the two byte alias. Aliases belong to one
+    connection, so reset() them with the broker's Topic Alias Maximum on
+    every connect. Only non-retained QoS 0 messages (readings) are aliased:
+    retained discovery configs are sent once per connection and would only
+    use up aliases, and paho would resend QoS 1/2 messages with their alias
+    on a new connection where it means nothing. Topics beyond the alias
+    limit are sent in full.
+
+    Message expiry: non-retained messages (readings) tell the broker to
+    drop them after message_expiry seconds instead of delivering stale
+    values to clients that were offline. Retained discovery configs never
+    expire.
+
+    Timestamps: every message carries a 'timestamp' user property with the
+    Unix time it was queued, or the time of the reading for one replayed
+    from the spool.
+    """
+
+    def __init__(self, topic_aliases=16, message_expiry=None, timestamps=False):
+        self.topic_aliases = topic_aliases
+        self.message_expiry = message_expiry
+        self.timestamps = timestamps
+        # Aliases usable on the current connection, 0 until reset() by a connect
+        self.limit = 0
+        self._aliases = {}
+        # topic -> properties of aliased messages, when they do not change per message
+        self._cached = {}
+
+    def reset(self, broker_maximum=0):
+        """Forget all aliases, called on every connect with the broker's Topic Alias Maximum"""
+        self.limit = min(self.topic_aliases, broker_maximum or 0)
+        self._aliases.clear()
+        self._cached.clear()
+
+    def _build(self, alias, expires, created):
+        properties = Properties(PacketTypes.PUBLISH)
+        if alias is not None:
+            properties.TopicAlias = alias
+        if expires:
+            properties.MessageExpiryInterval = self.message_expiry
+        if created is not None:
+            properties.UserProperty = ('timestamp', f"{created:.3f}")
+        return properties
+
+    def publish(self, client, message, created=None):
+        """client.publish() of a queued Message, created is its Unix queue time (needed with timestamps)"""
+        topic = message.topic
+        expires = bool(self.message_expiry) and not message.retain
+        created = created if self.timestamps else None
+
+        aliased = message.qos == 0 and not message.retain
+        alias = self._aliases.get(topic) if aliased else None
+        if alias is not None:
+            properties = self._cached.get(topic)
+            if properties is None or created is not None:
+                properties = self._build(alias, expires, created)
+                if created is None:
+                    self._cached[topic] = properties
+            return client.publish('', message.payload, qos=0, retain=False, properties=properties)
+
+        if aliased and len(self._aliases) < self.limit:
+            alias = len(self._aliases) + 1
+        if alias is None and not expires and created is None:
+            return client.publish(topic, message.payload, qos=message.qos, retain=message.retain)
+        result = client.publish(topic, message.payload, qos=message.qos, retain=message.retain,
+                                properties=self._build(alias, expires, created))
+        if alias is not None and result[0] == 0:
+            # Only a message that was actually sent registers the alias with the broker
+            self._aliases[topic] = alias
+        return result
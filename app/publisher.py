@@ -0,0 +1,257 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+
+POLICIES = ('drop_oldest', 'coalesce')
+
+
+class Message:
+    """A message waiting to be handed to the MQTT client"""
+
+    __slots__ = ('payload', 'qos', 'queued', 'retain', 'timestamp', 'topic')
+
+    def __init__(self, topic, payload, qos=0, retain=False, queued=0.0, timestamp=None):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.queued = queued
+        # Unix time of a replayed reading, None for one taken just now
+        self.timestamp = timestamp
+
+
+class PublishQueue:
+    """
+    Bounded, rate limited queue between sensor reads and the MQTT client
+
+    Messages are queued from any thread with publish(), which mirrors
+    client.publish() so the queue can be passed wherever a client is
+    expected. flush() hands at most one batch to the client per network
+    loop tick, limited by max_inflight (messages the client has not yet
+    confirmed) and by a token bucket of rate messages per second.
+
+    When the queue is full the drop_oldest policy discards the oldest
+    message, while coalesce keeps only the latest message per topic and
+    drops the oldest topic once max_size topics are waiting.
+
+    With MQTT v5, properties (a mqtt5.PublishProperties) adds topic
+    aliases, message expiry and timestamps to the messages handed over.
+
+    With metrics or track_latency, latency is a moving average of the
+    seconds from queueing a message until the client finished with it.
+    """
+
+    def __init__(self, max_size=1000, policy='drop_oldest', max_inflight=20, rate=0, batch_size=50,
+                 interval=0.05, clock=time.monotonic, metrics=None, properties=None, track_latency=False):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown publish queue policy '{policy}', use one of {', '.join(POLICIES)}")
+        self.max_size = max_size
+        self.policy = policy
+        self.max_inflight = max_inflight
+        self.rate = rate
+        self.batch_size = batch_size
+        self.interval = interval
+        self.clock = clock
+        self.metrics = metrics
+        self.properties = properties
+        # Queue times are only needed for latencies and timestamp properties
+        self._timed = metrics is not None or track_latency
+        self._stamp = self._timed or (properties is not None and properties.timestamps)
+
+        self._queue = OrderedDict() if policy == 'coalesce' else deque()
+        self._lock = threading.Lock()
+        # Called when the queue stops being empty, set while run() is active
+        self.notify = None
+        self._tokens = float(batch_size)
+        self._last_refill = clock()
+        self.inflight = 0
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        # mid -> queue time of messages awaiting on_publish, only kept when timed
+        self._pending = {}
+        self.latency = 0.0
+
+    @classmethod
+    def from_config(cls, options, metrics=None, properties=None, track_latency=False):
+        """Create a queue from the publish section (a PublishConfig) of the configuration"""
+        return cls(
+            max_size=options.max_queue,
+            policy=options.policy,
+            max_inflight=options.max_inflight,
+            rate=options.rate_limit,
+            batch_size=options.batch_size,
+            metrics=metrics,
+            properties=properties,
+            track_latency=track_latency,
+        )
+
+    @property
+    def depth(self):
+        """Number of messages waiting to be published"""
+        return len(self._queue)
+
+    def __len__(self):
+        return self.depth
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'inflight': self.inflight,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    def publish(self, topic, payload=None, qos=0, retain=False, timestamp=None):
+        """
+        Queue a message, returns a (result code, mid) pair like client.publish()
+        timestamp is the Unix time of a reading taken earlier, sent as its MQTT 5 timestamp property
+        """
+        message = Message(topic, payload, qos, retain, self.clock() if self._stamp else 0.0, timestamp)
+        with self._lock:
+            was_empty = not self._queue
+            if self.policy == 'coalesce':
+                if topic in self._queue:
+                    self._queue[topic] = message
+                    self._queue.move_to_end(topic)
+                    self.dropped += 1
+                else:
+                    if len(self._queue) >= self.max_size:
+                        self._queue.popitem(last=False)
+                        self.dropped += 1
+                    self._queue[topic] = message
+            else:
+                if len(self._queue) >= self.max_size:
+                    self._queue.popleft()
+                    self.dropped += 1
+                self._queue.append(message)
+        notify = self.notify
+        if was_empty and notify is not None:
+            notify()
+        return (0, None)
+
+    def _budget(self):
+        budget = self.batch_size
+        if self.max_inflight:
+            budget = min(budget, self.max_inflight - self.inflight)
+        if self.rate:
+            now = self.clock()
+            self._tokens = min(float(self.batch_size), self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            budget = min(budget, int(self._tokens))
+        return max(0, budget)
+
+    def _take(self, count):
+        if self.policy == 'coalesce':
+            return [self._queue.popitem(last=False)[1] for _ in range(count)]
+        return [self._queue.popleft() for _ in range(count)]
+
+    def _requeue(self, messages):
+        """Put unsent messages back in front of the queue, unless newer ones replaced them"""
+        for message in reversed(messages):
+            if self.policy == 'coalesce':
+                if message.topic not in self._queue:
+                    self._queue[message.topic] = message
+                    self._queue.move_to_end(message.topic, last=False)
+            else:
+                self._queue.appendleft(message)
+
+    def flush(self, client):
+        """Hand the next batch to the client, returns the number of messages sent"""
+        with self._lock:
+            batch = self._take(min(self._budget(), len(self._queue)))
+            if self.rate:
+                self._tokens -= len(batch)
+            self.inflight += len(batch)
+
+        properties = self.properties
+        if properties is not None and properties.timestamps:
+            # Wall clock time of the monotonic queue times
+            offset = time.time() - self.clock()
+        for index, message in enumerate(batch):
+            if properties is None:
+                result = client.publish(message.topic, message.payload, qos=message.qos, retain=message.retain)
+            elif properties.timestamps:
+                created = message.timestamp if message.timestamp is not None else message.queued + offset
+                result = properties.publish(client, message, created)
+            else:
+                result = properties.publish(client, message)
+            if result[0] != 0:
+                # The client refused the message (e.g. not connected), keep it and everything after it
+                unsent = batch[index:]
+                with self._lock:
+                    self.inflight -= len(unsent)
+                    self.failed += 1
+                    self._requeue(unsent)
+                    while len(self._queue) > self.max_size:
+                        self._take(1)
+                        self.dropped += 1
+                self._count(batch[:index])
+                return index
+            if self._timed:
+                self._pending[result[1]] = message.queued
+
+        self._count(batch)
+        return len(batch)
+
+    def _count(self, messages):
+        with self._lock:
+            self.sent += len(messages)
+        if self.metrics is not None and messages:
+            size = 0
+            for message in messages:
+                payload = message.payload
+                size += len(message.topic) + (len(payload) if payload is not None else 0)
+            self.metrics.bytes_sent.inc(size)
+
+    def on_publish(self, client, userdata, mid, *args):
+        """paho on_publish callback, the client has finished with one message"""
+        with self._lock:
+            blocked = self.max_inflight and self.inflight >= self.max_inflight and self._queue
+            self.inflight = max(0, self.inflight - 1)
+        if self._timed:
+            queued = self._pending.pop(mid, None)
+            if queued is not None:
+                elapsed = self.clock() - queued
+                self.latency += 0.2 * (elapsed - self.latency)
+                if self.metrics is not None:
+                    self.metrics.publish_duration.observe(elapsed)
+        notify = self.notify
+        if blocked and notify is not None:
+            # Messages are waiting for in-flight room, flush now instead of on the next tick
+            notify()
+
+    def reset_inflight(self):
+        """Forget unconfirmed messages, call on (re)connect since their callbacks never arrive"""
+        with self._lock:
+            self.inflight = 0
+        self._pending.clear()
+
+    async def run(self, client, ready=None):
+        """
+        Flush one batch per tick while messages are waiting, until cancelled
+        ready is an optional asyncio.Event, e.g. the connected event, awaited before each flush
+        """
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        self.notify = lambda: loop.call_soon_threadsafe(wakeup.set)
+        try:
+            while True:
+                if not self.depth:
+                    await wakeup.wait()
+                wakeup.clear()
+                if ready is not None:
+                    await ready.wait()
+                self.flush(client)
+                if self.depth:
+                    # Out of budget or refused, try again next tick or once in-flight room frees up
+                    # asyncio.timeout rather than wait_for, which on 3.11 drops a cancel arriving with a wakeup
+                    try:
+                        async with asyncio.timeout(self.interval):
+                            await wakeup.wait()
+                    except TimeoutError:
+                        pass
+        finally:
+            self.notify = None
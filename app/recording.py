@@ -0,0 +1,212 @@
+import asyncio
+import builtins
+import contextlib
+import json
+import mmap
+import struct
+import threading
+import time
+from collections import namedtuple
+
+TraceRecord = namedtuple('TraceRecord', 'time name values error')
+
+MAGIC = b'SCTRACE1'
+# magic, Unix time the recording started
+HEADER = struct.Struct('<8sd')
+# kind, layout id, seconds since the recording started
+RECORD = struct.Struct('<BHd')
+LENGTH = struct.Struct('<H')
+JSON_LENGTH = struct.Struct('<I')
+
+# Record kinds: a layout names a sensor and the keys and types of its readings, a reading
+# then only carries the packed values; other readings are stored as JSON, errors as text
+LAYOUT, READING, JSON_READING, ERROR = range(4)
+
+
+def _string(text):
+    data = text.encode()
+    return LENGTH.pack(len(data)) + data
+
+
+def _value_format(values):
+    """struct format of a reading of only ints and floats, None when it needs JSON"""
+    codes = []
+    for value in values.values():
+        if type(value) is float:
+            codes.append('d')
+        elif type(value) is int and -2 ** 63 <= value < 2 ** 63:
+            codes.append('q')
+        else:
+            return None
+    return ''.join(codes)
+
+
+class TraceWriter:
+    """
+    Record sensor readings and read errors to a compact binary trace
+
+    Each record carries the seconds since the recording started. The first
+    reading of a sensor with a given set of measurements writes a layout
+    record with the sensor name, measurement names and value types; later
+    readings refer to it and only store the packed values, e.g. 27 bytes
+    for a temperature and humidity reading. Readings with other values are
+    stored as JSON. Writes are buffered, a crash loses at most the last
+    few records and read_trace() ignores a truncated last record.
+    """
+
+    def __init__(self, path, clock=time.monotonic, wall_clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.records = 0
+        # Readings arrive from the read pipeline's worker threads
+        self._lock = threading.Lock()
+        # (name, keys, value format) -> (layout id, Struct of the values)
+        self._layouts = {}
+        with contextlib.ExitStack() as stack:
+            self._file = stack.enter_context(open(path, 'wb'))
+            self._file.write(HEADER.pack(MAGIC, wall_clock()))
+            # The writer owns the file from here on, until close()
+            self._resources = stack.pop_all()
+        self._start = clock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _layout(self, name, keys=(), value_format=''):
+        key = (name, keys, value_format)
+        layout = self._layouts.get(key)
+        if layout is None:
+            if len(self._layouts) == 0x10000:
+                raise ValueError(f"Too many sensor layouts in {self.path}")
+            layout = self._layouts[key] = (len(self._layouts), struct.Struct('<' + value_format))
+            self._file.write(RECORD.pack(LAYOUT, layout[0], 0.0) + _string(name) + _string(value_format)
+                             + bytes([len(keys)]) + b''.join(_string(key) for key in keys))
+        return layout
+
+    def reading(self, name, values):
+        """Record a reading of sensor (job) name"""
+        elapsed = self.clock() - self._start
+        value_format = _value_format(values) if len(values) < 256 else None
+        with self._lock:
+            if value_format is not None:
+                layout, packer = self._layout(name, tuple(values), value_format)
+                self._file.write(RECORD.pack(READING, layout, elapsed) + packer.pack(*values.values()))
+            else:
+                layout, _ = self._layout(name)
+                data = json.dumps(values, separators=(',', ':')).encode()
+                self._file.write(RECORD.pack(JSON_READING, layout, elapsed) + JSON_LENGTH.pack(len(data)) + data)
+            self.records += 1
+
+    def error(self, name, error):
+        """Record a failed read of sensor (job) name"""
+        elapsed = self.clock() - self._start
+        with self._lock:
+            layout, _ = self._layout(name)
+            self._file.write(RECORD.pack(ERROR, layout, elapsed) + _string(type(error).__name__)
+                             + _string(str(error)))
+            self.records += 1
+
+    def tap(self, on_result, on_error):
+        """Wrap read pipeline callbacks so every reading and error is recorded before it is handled"""
+        def recorded_result(name, values):
+            self.reading(name, values)
+            on_result(name, values)
+
+        def recorded_error(name, error):
+            self.error(name, error)
+            on_error(name, error)
+        return recorded_result, recorded_error
+
+    def close(self):
+        with self._lock:
+            self._resources.close()
+
+
+def _replayed_error(type_name, message):
+    """The recorded exception type if it is a built-in one, RuntimeError otherwise"""
+    kind = getattr(builtins, type_name, None)
+    if not (isinstance(kind, type) and issubclass(kind, Exception)):
+        return RuntimeError(f"{type_name}: {message}")
+    return kind(message)
+
+
+def read_trace(path):
+    """Yield the TraceRecords of a trace file, stopping at a truncated last record"""
+    with open(path, 'rb') as file:
+        if file.seek(0, 2) < HEADER.size:
+            raise ValueError(f"{path} is not a sensor trace")
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, _ = HEADER.unpack_from(data, 0)
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a sensor trace")
+            yield from _records(data, HEADER.size)
+
+
+def _strings(data, offset, count):
+    strings = []
+    for _ in range(count):
+        length, = LENGTH.unpack_from(data, offset)
+        end = offset + LENGTH.size + length
+        if end > len(data):
+            raise struct.error("truncated string")
+        strings.append(bytes(data[offset + LENGTH.size:end]).decode())
+        offset = end
+    return strings, offset
+
+
+def _records(data, offset):
+    # layout id -> (name, keys, Struct of the values)
+    layouts = {}
+    size = len(data)
+    while offset + RECORD.size <= size:
+        try:
+            kind, layout, elapsed = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            if kind == LAYOUT:
+                (name, value_format), offset = _strings(data, offset, 2)
+                keys, offset = _strings(data, offset + 1, data[offset])
+                layouts[layout] = (name, tuple(keys), struct.Struct('<' + value_format))
+            elif kind == READING:
+                name, keys, unpacker = layouts[layout]
+                values = unpacker.unpack_from(data, offset)
+                offset += unpacker.size
+                yield TraceRecord(elapsed, name, dict(zip(keys, values)), None)
+            elif kind == JSON_READING:
+                length, = JSON_LENGTH.unpack_from(data, offset)
+                start = offset + JSON_LENGTH.size
+                if start + length > size:
+                    return
+                offset = start + length
+                yield TraceRecord(elapsed, layouts[layout][0], json.loads(bytes(data[start:offset])), None)
+            elif kind == ERROR:
+                (type_name, message), offset = _strings(data, offset, 2)
+                yield TraceRecord(elapsed, layouts[layout][0], None, _replayed_error(type_name, message))
+            else:
+                raise ValueError(f"Unknown trace record kind {kind} at byte {offset - RECORD.size}")
+        except (struct.error, IndexError):
+            # The recording was cut off in the middle of this record
+            return
+
+
+async def replay_trace(path, on_result, on_error, speed=1.0, clock=time.monotonic):
+    """
+    Feed a recorded trace to read pipeline callbacks, returns the number of records
+
+    speed 1 keeps the recorded timing, 10 replays ten times faster and 0 as
+    fast as possible, only yielding to the event loop between records so
+    the publish queue keeps running.
+    """
+    start = clock()
+    count = 0
+    for record in read_trace(path):
+        delay = record.time / speed - (clock() - start) if speed else 0
+        await asyncio.sleep(max(delay, 0))
+        if record.error is not None:
+            on_error(record.name, record.error)
+        else:
+            on_result(record.name, record.values)
+        count += 1
+    return count
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import os
+import signal
+
+import yaml
+
+from config import ConfigError
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigWatcher:
+    """
+    Reload the configuration file when it changes or on SIGHUP
+
+    The file is polled every interval seconds for a new modification time
+    or size; SIGHUP forces a reload. The new configuration is read with
+    load(path) and handed to apply(config). Errors in either are logged and
+    the running configuration stays in place.
+    """
+
+    def __init__(self, path, load, apply, interval=2.0):
+        self.path = path
+        self.load = load
+        self.apply = apply
+        self.interval = interval
+        self._signature = self._stat()
+        self._trigger = None
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def changed(self):
+        """True if the file was modified since the last check"""
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            return False
+        self._signature = signature
+        return True
+
+    def reload(self):
+        """Load and apply the file, returns True if the new configuration is in use"""
+        try:
+            config = self.load(self.path)
+        except (OSError, yaml.YAMLError, ConfigError) as e:
+            logger.error("Failed to read %s, keeping the current configuration: %s", self.path, e)
+            return False
+        try:
+            self.apply(config)
+        # Driver options are only checked by the drivers themselves, which raise whatever they like (e.g. a
+        # TypeError for read_delay: "fast"), and an error here must not end the watcher
+        except Exception as e:  # noqa: BLE001
+            logger.error("Failed to apply %s, keeping the current configuration: %s", self.path, e)
+            return False
+        return True
+
+    def request(self):
+        """Reload on the next wakeup, safe to call from signal handlers"""
+        if self._trigger is not None:
+            self._trigger.set()
+
+    async def run(self):
+        """Watch the file until cancelled"""
+        loop = asyncio.get_running_loop()
+        self._trigger = asyncio.Event()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, self.request)
+            handles_signal = True
+        except (AttributeError, NotImplementedError, RuntimeError):
+            # No SIGHUP on Windows, and signal handlers only work on the main thread
+            handles_signal = False
+        try:
+            while True:
+                try:
+                    async with asyncio.timeout(self.interval if self.interval else None):
+                        await self._trigger.wait()
+                except TimeoutError:
+                    pass
+                forced = self._trigger.is_set()
+                self._trigger.clear()
+                if self.changed() or forced:
+                    logger.info("Reloading configuration from %s", self.path)
+                    self.reload()
+        finally:
+            if handles_signal:
+                loop.remove_signal_handler(signal.SIGHUP)
@@ -0,0 +1,134 @@
+import math
+import time
+from array import array
+
+AGGREGATES = ('min', 'max', 'mean', 'count')
+
+# Samples kept per measurement before they are folded into running aggregates
+MAX_WINDOW = 4096
+
+
+class RollupWindow:
+    """
+    Samples of one measurement during one rollup interval
+
+    Samples are stored in a fixed-size array of doubles that is allocated
+    once and reused for every interval. When more samples arrive than it
+    holds (e.g. after update_interval was lowered), the full array is
+    folded into running min, max, sum and count and filled again.
+    """
+
+    __slots__ = ('_count', '_length', '_max', '_min', '_samples', '_sum')
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError(f"Window size must be at least 1, got {size}")
+        self._samples = array('d', bytes(8 * size))
+        self._length = 0
+        self._clear()
+
+    def _clear(self):
+        self._min = math.inf
+        self._max = -math.inf
+        self._sum = 0.0
+        self._count = 0
+
+    def __len__(self):
+        return self._count + self._length
+
+    def append(self, value):
+        if self._length == len(self._samples):
+            self._fold()
+        self._samples[self._length] = value
+        self._length += 1
+
+    def _fold(self):
+        if not self._length:
+            return
+        samples = memoryview(self._samples)[:self._length]
+        self._min = min(self._min, min(samples))
+        self._max = max(self._max, max(samples))
+        self._sum += math.fsum(samples)
+        self._count += self._length
+        self._length = 0
+
+    def aggregate(self, precision=2):
+        """{aggregate: value} of the samples since the last call, None when there were none"""
+        self._fold()
+        if not self._count:
+            return None
+        result = {
+            'min': self._min,
+            'max': self._max,
+            'mean': round(self._sum / self._count, precision),
+            'count': self._count,
+        }
+        self._clear()
+        return result
+
+
+class SensorRollup:
+    """
+    Downsample the readings of one sensor into min/max/mean/count aggregates
+
+    Every numeric measurement is collected in a RollupWindow. Windows are
+    aligned to multiples of interval seconds of wall clock time, so the
+    aggregates of all sensors cover the same periods. The first reading
+    after the end of a window closes it, add() then returns its aggregates.
+    With raw disabled only the aggregates are published, not the readings.
+    """
+
+    def __init__(self, interval, aggregates=AGGREGATES, size=64, raw=True, precision=2, clock=time.time):
+        if interval <= 0:
+            raise ValueError(f"Rollup interval must be positive, got {interval}")
+        unknown = [aggregate for aggregate in aggregates if aggregate not in AGGREGATES]
+        if unknown:
+            raise ValueError(f"Unknown aggregate '{unknown[0]}', use any of {', '.join(AGGREGATES)}")
+        self.interval = interval
+        self.aggregates = tuple(aggregates)
+        self.size = size
+        self.raw = raw
+        self.precision = precision
+        self.clock = clock
+        self._windows = {}
+        self._end = None
+
+    @classmethod
+    def from_config(cls, sensor, clock=time.time):
+        """Create the rollup of a sensors[] entry, None when it has no rollup section"""
+        options = sensor.get('rollup')
+        if not options:
+            return None
+        interval = options.get('interval', 300)
+        # One slot per expected reading, a late reading must not force a fold
+        size = min(MAX_WINDOW, math.ceil(interval / sensor.get('update_interval', 60)) + 1)
+        return cls(interval, aggregates=options.get('aggregates', AGGREGATES), size=size,
+                   raw=options.get('raw', True), precision=options.get('precision', 2), clock=clock)
+
+    def add(self, values):
+        """Collect a reading, returns the aggregates of the window it closed or None"""
+        now = self.clock()
+        closed = None
+        if self._end is not None and now >= self._end:
+            closed = self.aggregate()
+            self._end = None
+        if self._end is None:
+            self._end = (now // self.interval + 1) * self.interval
+
+        for measurement, value in values.items():
+            if type(value) is bool or not isinstance(value, (int, float)):
+                continue
+            window = self._windows.get(measurement)
+            if window is None:
+                window = self._windows[measurement] = RollupWindow(self.size)
+            window.append(value)
+        return closed
+
+    def aggregate(self):
+        """{measurement: {aggregate: value}} of the current windows, which start over empty"""
+        result = {}
+        for measurement, window in self._windows.items():
+            values = window.aggregate(self.precision)
+            if values is not None:
+                result[measurement] = {aggregate: values[aggregate] for aggregate in self.aggregates}
+        return result or None
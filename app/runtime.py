@@ -0,0 +1,255 @@
+import asyncio
+import functools
+import logging
+import random
+
+import paho.mqtt.client as mqtt
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncioMqttHelper:
+    """
+    Drive a paho client from the asyncio event loop instead of a network thread
+
+    The client's socket is watched with add_reader/add_writer and
+    loop_misc() (keepalive pings, timeouts) runs as a task once a second.
+    The socket callbacks may fire from an executor thread while connecting,
+    in which case loop registrations are scheduled thread-safely.
+    """
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.closed = asyncio.Event()
+        self.closed.set()
+        self._misc = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def _call(self, callback, *args):
+        """Run callback right away on the loop thread, schedule it from any other thread"""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            # paho closes the socket right after on_socket_close, a deferred call would see a dead fd
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self._call(self._open, sock)
+
+    def _open(self, sock):
+        self.closed.clear()
+        self.loop.add_reader(sock, self.client.loop_read)
+        if self._misc is None or self._misc.done():
+            self._misc = self.loop.create_task(self._loop_misc())
+
+    def on_socket_close(self, client, userdata, sock):
+        self._call(self._close, sock)
+
+    def _close(self, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+        if self._misc is not None:
+            self._misc.cancel()
+            self._misc = None
+        self.closed.set()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._call(self.loop.add_writer, sock, self.client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self.loop.remove_writer, sock)
+
+    async def _loop_misc(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+class Backoff:
+    """
+    Exponential backoff with full jitter
+
+    The n-th delay is drawn uniformly between 0 and min(maximum, initial *
+    factor ** n). Nodes that lost the same broker at the same moment thus
+    spread their reconnects out instead of arriving together when it comes
+    back. reset() after a successful connection.
+    """
+
+    def __init__(self, initial=1.0, maximum=120.0, factor=2.0, random=random.random):
+        if initial <= 0 or maximum < initial:
+            raise ValueError(f"Invalid backoff {initial}..{maximum} s")
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.random = random
+        self.attempts = 0
+
+    def ceiling(self):
+        """Upper bound of the next delay"""
+        # Capping the exponent keeps factor ** attempts from overflowing after days of outage
+        return min(self.maximum, self.initial * self.factor ** min(self.attempts, 64))
+
+    def next(self):
+        """Delay before the next attempt"""
+        delay = self.ceiling() * self.random()
+        self.attempts += 1
+        return delay
+
+    def reset(self):
+        self.attempts = 0
+
+
+class MqttConnection:
+    """
+    Connect a paho client on the event loop and keep it connected
+
+    connected is an asyncio.Event that is set while the broker has accepted
+    the connection. The blocking TCP connect runs in an executor; after a
+    refused or lost connection the client reconnects after delays from
+    backoff until stop() is called.
+
+    With an availability_topic, 'offline' is registered as the last will
+    and 'online' is published (retained) on every connect, before any
+    connect hook runs. Topics passed to subscribe() are subscribed again
+    after reconnecting unless the broker kept the session, and connect
+    hooks (e.g. republishing discovery) run on the event loop after every
+    successful connect with the broker's session present flag; with MQTT
+    v5 the CONNACK properties are available as connack_properties.
+    connect_options are passed on to client.connect(), e.g. clean_start.
+    """
+
+    def __init__(self, client, host, port=1883, keepalive=60, backoff=None, availability_topic=None,
+                 on_connect=None, on_disconnect=None, connect_options=None):
+        self.client = client
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.backoff = backoff if backoff is not None else Backoff()
+        self.availability_topic = availability_topic
+        self.connect_options = connect_options or {}
+        self.connack_properties = None
+        self.user_on_connect = on_connect
+        self.user_on_disconnect = on_disconnect
+        self.connected = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        self.helper = AsyncioMqttHelper(self.loop, client)
+        # topic -> qos of subscriptions to restore after reconnecting
+        self.subscriptions = {}
+        # Topics subscribed in the broker's current session
+        self._subscribed = set()
+        self._connect_hooks = []
+        self._reconnect_task = None
+        self._stopping = False
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        if availability_topic:
+            client.will_set(availability_topic, 'offline', qos=1, retain=True)
+
+    def add_connect_hook(self, hook):
+        """Call hook(session_present) on the event loop after every successful connect"""
+        self._connect_hooks.append(hook)
+
+    def subscribe(self, topic, qos=0):
+        """Subscribe now if connected, and again after every reconnect without a kept session"""
+        self.subscriptions[topic] = qos
+        if self.connected.is_set():
+            self.client.subscribe(topic, qos)
+            self._subscribed.add(topic)
+
+    def unsubscribe(self, topic):
+        self._subscribed.discard(topic)
+        if self.subscriptions.pop(topic, None) is not None and self.connected.is_set():
+            self.client.unsubscribe(topic)
+
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
+        self.connack_properties = properties
+        if rc == 0 and self.availability_topic:
+            client.publish(self.availability_topic, 'online', qos=1, retain=True)
+        if self.user_on_connect is not None:
+            self.user_on_connect(client, userdata, flags, rc)
+        if rc == 0:
+            session_present = bool(flags.get('session present')) if isinstance(flags, dict) else False
+            self.loop.call_soon_threadsafe(self._connected, session_present)
+
+    def _connected(self, session_present):
+        self.backoff.reset()
+        self.connected.set()
+        if not session_present:
+            self._subscribed.clear()
+        missing = [(topic, qos) for topic, qos in self.subscriptions.items() if topic not in self._subscribed]
+        if missing:
+            self.client.subscribe(missing)
+            self._subscribed.update(topic for topic, _ in missing)
+        for hook in self._connect_hooks:
+            try:
+                hook(session_present)
+            except Exception:
+                logger.exception("Connect hook %r failed", hook)
+
+    def _on_disconnect(self, client, userdata, rc, properties=None):
+        self.loop.call_soon_threadsafe(self.connected.clear)
+        if self.user_on_disconnect is not None:
+            self.user_on_disconnect(client, userdata, rc)
+        if not self._stopping:
+            self.loop.call_soon_threadsafe(self._schedule_reconnect)
+
+    def _schedule_reconnect(self):
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = self.loop.create_task(self._reconnect())
+
+    async def _attempt(self, first):
+        try:
+            if first:
+                await self.loop.run_in_executor(
+                    None, functools.partial(self.client.connect, self.host, self.port, self.keepalive,
+                                            **self.connect_options))
+            else:
+                await self.loop.run_in_executor(None, self.client.reconnect)
+            return True
+        except OSError as e:
+            logger.warning("Connection to MQTT broker at %s:%s failed: %s", self.host, self.port, e)
+            return False
+
+    async def _reconnect(self):
+        while not self._stopping and not self.connected.is_set():
+            delay = self.backoff.next()
+            logger.info("Reconnecting to MQTT broker in %.1f s", delay, extra={'attempt': self.backoff.attempts})
+            await asyncio.sleep(delay)
+            if self._stopping or await self._attempt(first=False):
+                return
+
+    async def start(self):
+        """Open the connection, retrying in the background if the broker is unreachable"""
+        if not await self._attempt(first=True):
+            self._schedule_reconnect()
+
+    async def wait_connected(self, timeout=None):
+        """Wait until the broker accepted the connection, returns False on timeout"""
+        try:
+            await asyncio.wait_for(self.connected.wait(), timeout)
+            return True
+        except TimeoutError:
+            return False
+
+    async def stop(self, timeout=1.0):
+        """Disconnect cleanly and stop reconnecting"""
+        self._stopping = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        if self.helper.closed.is_set():
+            return
+        if self.availability_topic and self.connected.is_set():
+            # The broker only sends the last will when the connection is lost, not on a clean disconnect
+            self.client.publish(self.availability_topic, 'offline', qos=1, retain=True)
+        self.client.disconnect()
+        try:
+            await asyncio.wait_for(self.helper.closed.wait(), timeout)
+        except TimeoutError:
+            pass
@@ -0,0 +1,161 @@
+import asyncio
+import heapq
+import itertools
+import math
+import threading
+import time
+
+
+class Scheduler:
+    """
+    Heap based interval scheduler on the monotonic clock
+
+    Every job keeps its own interval. The next due time is always computed
+    from the previous due time rather than from when the job actually ran,
+    so a schedule never drifts. Jobs falling due within the same tick are
+    handed out together as one batch. scale stretches every interval, e.g.
+    2 reads every job half as often.
+    """
+
+    def __init__(self, tick=0.05, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+        self.scale = 1.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def add(self, name, interval, job, delay=0.0):
+        """Schedule job every interval seconds, first run after delay seconds"""
+        if interval <= 0:
+            raise ValueError(f"Interval for {name} must be positive, got {interval}")
+
+        with self._lock:
+            self._discard(name)
+            entry = [self.clock() + delay, next(self._counter), name, interval, job, True]
+            self._entries[name] = entry
+            heapq.heappush(self._heap, entry)
+        self.wake()
+
+    def set_interval(self, name, interval):
+        """Change the interval of a scheduled job, its next run moves by the difference"""
+        if interval <= 0:
+            raise ValueError(f"Interval for {name} must be positive, got {interval}")
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry[3] == interval:
+                return
+            due = entry[0] + (interval - entry[3]) * self.scale
+            self._discard(name)
+            entry = [due, next(self._counter), name, interval, entry[4], True]
+            self._entries[name] = entry
+            heapq.heappush(self._heap, entry)
+        self.wake()
+
+    def remove(self, name):
+        """Remove a job, returns True if it was scheduled"""
+        with self._lock:
+            removed = self._discard(name)
+        self.wake()
+        return removed
+
+    def _discard(self, name):
+        entry = self._entries.pop(name, None)
+        if entry is None:
+            return False
+        # Lazy deletion, the heap entry is dropped once it reaches the top
+        entry[-1] = False
+        return True
+
+    def time_until_next(self, now=None):
+        """Seconds until the next job is due, None when nothing is scheduled"""
+        now = self.clock() if now is None else now
+        with self._lock:
+            self._drop_cancelled()
+            if not self._heap:
+                return None
+            return max(0.0, self._heap[0][0] - now)
+
+    def _drop_cancelled(self):
+        while self._heap and not self._heap[0][-1]:
+            heapq.heappop(self._heap)
+
+    def pop_due(self, now=None):
+        """
+        Return (name, job) pairs due at now, coalescing everything due within one tick
+
+        Each returned job is rescheduled on its own grid. If a job fell behind
+        by more than one interval the missed slots are skipped instead of
+        being replayed back to back.
+        """
+        now = self.clock() if now is None else now
+        horizon = now + self.tick
+        batch = []
+
+        with self._lock:
+            while self._heap:
+                entry = self._heap[0]
+                if not entry[-1]:
+                    heapq.heappop(self._heap)
+                    continue
+                if entry[0] > horizon:
+                    break
+
+                heapq.heappop(self._heap)
+                due, _, name, interval, job, _ = entry
+                batch.append((name, job))
+
+                interval *= self.scale
+                due += interval
+                if due <= now:
+                    due += math.ceil((now - due) / interval + 1e-9) * interval
+                entry[0] = due
+                entry[1] = next(self._counter)
+                heapq.heappush(self._heap, entry)
+
+        return batch
+
+    async def run(self, dispatch, housekeeping=None):
+        """
+        Hand each batch of due jobs to dispatch until cancelled
+        housekeeping, if given, is called on every wake-up and at least once a second
+        """
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        try:
+            while True:
+                self._wakeup.clear()
+                if housekeeping is not None:
+                    housekeeping()
+                wait = self.time_until_next()
+                if wait is None or wait > self.tick:
+                    # Sleep until the next job is due or the schedule changes
+                    if housekeeping is not None:
+                        wait = 1.0 if wait is None else min(wait, 1.0)
+                    try:
+                        async with asyncio.timeout(wait):
+                            await self._wakeup.wait()
+                    except TimeoutError:
+                        pass
+                    continue
+
+                batch = self.pop_due()
+                if batch:
+                    dispatch(batch)
+        finally:
+            self._loop = self._wakeup = None
+
+    def wake(self):
+        """Interrupt a sleeping run() loop, safe to call from any thread"""
+        loop, wakeup = self._loop, self._wakeup
+        if loop is not None and wakeup is not None:
+            loop.call_soon_threadsafe(wakeup.set)
@@ -1,104 +1,868 @@
-import yaml
+import argparse
+import asyncio
+import logging
+import signal
+import sys
+
 import paho.mqtt.client as mqtt
-import time
-import json
+import yaml
+
+from adaptive import AdaptiveInterval, LoadMonitor
+from brokers import BrokerLink, Failover, FanOut, QueueGroup
+from config import BrokerConfig, ConfigError, device_id, parse_config
+from discovery import DiscoveryCache, fetch_retained
+from drivers import ReadPipeline, create_driver
+from filters import SensorFilter
+from logs import setup_logging
+from publisher import PublishQueue
+from rollup import SensorRollup
+from runtime import Backoff, MqttConnection
+from scheduler import Scheduler
+from serialization import StateSerializer, dumps
+from spool import Spool, StoreAndForward
+
+# Named explicitly, __name__ is __main__ when run as a script
+logger = logging.getLogger('sensor_container')
+
+# The C loader is several times faster when PyYAML was built with libyaml
+_Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 
 def load_config(config_file='config.yml'):
     """Load configuration from YAML file"""
     with open(config_file, 'r') as file:
-        config = yaml.safe_load(file)
+        config = yaml.load(file, Loader=_Loader)
     return config
 
+
+def read_config(config_file='config.yml'):
+    """Load and validate the configuration file, returns a Config"""
+    return parse_config(load_config(config_file))
+
 def on_connect(client, userdata, flags, rc):
     """Callback for when the client connects to the broker"""
     if rc == 0:
-        print("Connected to MQTT Broker successfully!")
+        logger.info("Connected to MQTT Broker successfully!")
     else:
-        print(f"Failed to connect, return code {rc}")
+        logger.error("Failed to connect, return code %s", rc, extra={'rc': rc})
 
-def publish_discovery_config(client, device_name, sensor_type, unitOfMeasurement=None, device_class=None):
+def publish_discovery_config(client, device_name, sensor_type, unitOfMeasurement=None, device_class=None, name=None,
+                             cache=None, state_topic=None, value_template=None, availability_topic=None):
     """
     Publish Home Assistant MQTT Discovery configuration
     This allows Home Assistant to auto-discover the sensor
+    With a DiscoveryCache, configs that were already published unchanged are skipped
+    state_topic and value_template point the entity into a shared JSON state message
+    availability_topic marks the entity unavailable while the container is offline
     """
-    device_id = device_name.lower().replace(' ', '_')
+    object_id = device_id(device_name)
     
     # Discovery topic
-    topic = f"homeassistant/sensor/{device_id}_{sensor_type}/config"
+    topic = discovery_topic(device_name, sensor_type)
     
     # Configuration payload
     config_payload = {
-        "name": f"{device_name} {sensor_type.capitalize()}",
-        "state_topic": f"homeassistant/sensor/{device_id}/{sensor_type}/state",
-        "unique_id": f"{device_id}_{sensor_type}",
+        "name": name or f"{device_name} {sensor_type.capitalize()}",
+        "state_topic": state_topic or f"homeassistant/sensor/{object_id}/{sensor_type}/state",
+        "unique_id": f"{object_id}_{sensor_type}",
         "device": {
-            "identifiers": [device_id],
+            "identifiers": [object_id],
             "name": device_name,
             "model": f"{sensor_type} Sensor",
-            "manufacturer": "Custom",
-            "unit_of_measurement": unitOfMeasurement,
-            "device_class": device_class
+            "manufacturer": "Custom"
         }
     }
+    # Entity settings rather than device info, left out when the entity has none
+    if unitOfMeasurement is not None:
+        config_payload["unit_of_measurement"] = unitOfMeasurement
+    if device_class is not None:
+        config_payload["device_class"] = device_class
+    if value_template is not None:
+        config_payload["value_template"] = value_template
+    if availability_topic is not None:
+        config_payload["availability_topic"] = availability_topic
     
+    payload = dumps(config_payload)
+    if cache is not None and cache.is_current(topic, payload):
+        return None
+
     # Publish discovery config
-    result = client.publish(topic, json.dumps(config_payload), retain=True)
+    result = client.publish(topic, payload, retain=True)
     
     if result[0] == 0:
-        print(f"Published discovery config for {sensor_type}")
+        logger.info("Published discovery config for %s", sensor_type,
+                    extra={'device': device_name, 'sensor': sensor_type})
+        if cache is not None:
+            cache.update(topic, payload)
     else:
-        print(f"Failed to publish discovery config for {sensor_type}")
+        logger.warning("Failed to publish discovery config for %s", sensor_type,
+                       extra={'device': device_name, 'sensor': sensor_type})
+    return result
 
 
-def main():
-    """Main function"""
-    # Load configuration
-    print("Loading configuration from config.yml...")
-    config = load_config('config.yml')
-    
-    # set up mQTT client
-    broker = config['mqtt']['broker']
-    port = config['mqtt']['port']
-    username = config['mqtt']['username']
-    password = config['mqtt']['password']
-    device_name = config['device']['name']
-    sensor_type = config['sensors'][0]['type']  # assuming first sensor for simplicity
-    update_interval = config['sensors'][0]['update_interval']
+def discovery_topic(device_name, sensor_type):
+    """Topic of the discovery config published by publish_discovery_config"""
+    return f"homeassistant/sensor/{device_id(device_name)}_{sensor_type}/config"
+
+
+def state_topic(device_name, sensor_type):
+    """State topic of a single measurement"""
+    return f"homeassistant/sensor/{device_id(device_name)}/{sensor_type}/state"
+
+
+def sensor_state_topic(device_name, name):
+    """Topic of the compact state message carrying every measurement of a sensor"""
+    return f"homeassistant/sensor/{device_id(device_name)}/{name}/state"
+
+
+def sensor_state_topics(device_name, name, driver, compact=False):
+    """
+    State topics of a sensor as used by make_result_handler
+    The compact state topic, or a {measurement: topic} dict
+    """
+    if compact:
+        return sensor_state_topic(device_name, name)
+    return {measurement: state_topic(device_name, f"{name}_{measurement}") for measurement, _, _ in driver.measurements}
+
+
+def rollup_state_name(name):
+    """Name under which the aggregates of a sensor are published"""
+    return f"{name}_rollup"
+
+
+def publish_rollup(client, device_name, name, aggregates, compact=False):
+    """Publish the {measurement: {aggregate: value}} of a closed rollup window"""
+    if compact:
+        values = {f"{measurement}_{aggregate}": value
+                  for measurement, results in aggregates.items() for aggregate, value in results.items()}
+        client.publish(sensor_state_topic(device_name, rollup_state_name(name)), dumps(values))
+        return
+    for measurement, results in aggregates.items():
+        for aggregate, value in results.items():
+            client.publish(state_topic(device_name, f"{name}_{measurement}_{aggregate}"), str(value))
+
+
+def make_result_handler(client, device_name, filters=None, compact=False, topics=None, rollups=None):
+    """
+    Build the pipeline callback that publishes every value of a reading
+    filters maps sensor names to the SensorFilter deciding which values are worth publishing
+    In compact mode a reading is published as one JSON message per sensor instead of one message per value
+    topics maps sensor names to their precomputed sensor_state_topics, missing ones are built on first use
+    rollups maps sensor names to the SensorRollup aggregating their unfiltered readings
+    """
+    if filters is None:
+        filters = {}
+    if topics is None:
+        topics = {}
+    if rollups is None:
+        rollups = {}
+    serializer = StateSerializer()
+
+    def on_result(name, values):
+        if name in rollups:
+            rollup = rollups[name]
+            aggregates = rollup.add(values)
+            if aggregates:
+                publish_rollup(client, device_name, name, aggregates, compact=compact)
+            if not rollup.raw:
+                return
+        if name in filters:
+            sensor_filter = filters[name]
+            values = sensor_filter.apply(values)
+            if compact and values:
+                # Every entity reads its value from the same message, so send all of them
+                values = sensor_filter.latest()
+        if not compact:
+            measurement_topics = topics.get(name)
+            if measurement_topics is None:
+                measurement_topics = topics[name] = {}
+            for measurement, value in values.items():
+                topic = measurement_topics.get(measurement)
+                if topic is None:
+                    topic = measurement_topics[measurement] = state_topic(device_name, f"{name}_{measurement}")
+                client.publish(topic, str(value))
+        elif values:
+            topic = topics.get(name)
+            if topic is None:
+                topic = topics[name] = sensor_state_topic(device_name, name)
+            client.publish(topic, serializer.render(name, values))
+    return on_result
+
+
+def on_read_error(name, error):
+    """Pipeline callback for failed or timed out sensor reads"""
+    device, _, sensor = name.rpartition('/')
+    logger.warning("Error reading sensor %s: %s", name, error, extra={'device': device, 'sensor': sensor})
+
+
+def sensor_entities(name, driver, rollup=None):
+    """
+    The Home Assistant entities of a sensor as (sensor_type, state name, value key, unit, device_class, label)
+    Raw measurements are published under the sensor's name, rollup aggregates under rollup_state_name()
+    value key is the entity's key in compact state messages
+    """
+    entities = []
+    if rollup is None or rollup.raw:
+        entities += [(f"{name}_{measurement}", name, measurement, unit, device_class, measurement.capitalize())
+                     for measurement, unit, device_class in driver.measurements]
+    if rollup is not None:
+        for measurement, unit, device_class in driver.measurements:
+            for aggregate in rollup.aggregates:
+                # A count has no unit, and Home Assistant rejects a device class without one
+                counted = aggregate == 'count'
+                entities.append((f"{name}_{measurement}_{aggregate}", rollup_state_name(name),
+                                 f"{measurement}_{aggregate}", None if counted else unit,
+                                 None if counted else device_class, f"{measurement.capitalize()} {aggregate}"))
+    return entities
+
+
+def publish_sensor_discovery(client, device_name, name, driver, cache=None, compact=False, availability_topic=None,
+                             rollup=None):
+    """Publish discovery configs for every measurement a sensor provides, returns how many were published"""
+    published = 0
+    for sensor_type, state_name, key, unit, device_class, label in sensor_entities(name, driver, rollup):
+        result = publish_discovery_config(
+            client,
+            device_name,
+            sensor_type,
+            unitOfMeasurement=unit,
+            device_class=device_class,
+            name=f"{device_name} {name} {label}",
+            cache=cache,
+            state_topic=sensor_state_topic(device_name, state_name) if compact else None,
+            value_template=f"{{{{ value_json.{key} }}}}" if compact else None,
+            availability_topic=availability_topic,
+        )
+        if result is not None and result[0] == 0:
+            published += 1
+    return published
+
+
+def sensor_discovery_topics(device_name, drivers, rollups=None):
+    """Discovery topics of every measurement of every sensor"""
+    rollups = rollups or {}
+    return [topic for name, driver in drivers.items() for topic in sensor_topics(device_name, name, driver,
+                                                                                  rollups.get(name))]
+
+
+async def publish_all_discovery(client, queue, devices, cache=None, availability_topic=None):
+    """
+    Publish discovery for all sensors of all devices, called on every (re)connect
+    With verify_retained the cache is first checked against the retained configs on the broker
+    """
+    if cache is not None and cache.verify_retained:
+        topics = [topic for device in devices
+                  for topic in sensor_discovery_topics(device.name, device.drivers, device.rollups)]
+        cache.reconcile(await fetch_retained(client, topics))
+
+    published = 0
+    for device in devices:
+        for name, driver in device.drivers.items():
+            published += publish_sensor_discovery(queue, device.name, name, driver, cache=cache,
+                                                  compact=device.compact, availability_topic=availability_topic,
+                                                  rollup=device.rollups.get(name))
+    if cache is not None:
+        cache.save()
+        if not published:
+            logger.info("Discovery configs unchanged, nothing to publish")
+    return published
+
+
+def device_settings(config):
+    """Device level settings, everything but the sensors"""
+    return (config.name, config.compact_state)
+
+
+def sensor_topics(device_name, name, driver, rollup=None):
+    """Discovery topics of every entity of one sensor"""
+    return [discovery_topic(device_name, entity[0]) for entity in sensor_entities(name, driver, rollup)]
+
+
+class Device:
+    """A logical Home Assistant device: its sensors, their drivers and the handler publishing readings"""
+
+    def __init__(self, config, client):
+        self.config = config
+        self.name = config.name
+        self.id = config.id
+        self.compact = config.compact_state
+        # Sensor name -> SensorConfig
+        self.sensors = {}
+        self.drivers = {}
+        self.filters = {}
+        self.rollups = {}
+        # Sensor name -> AdaptiveInterval of sensors read at a varying interval
+        self.adaptive = {}
+        # Sensor name -> state topics, computed once instead of for every reading
+        self.topics = {}
+        self.on_result = make_result_handler(client, self.name, self.filters, compact=self.compact,
+                                             topics=self.topics, rollups=self.rollups)
+        try:
+            for sensor in config.sensors:
+                self.add_sensor(sensor.name, sensor)
+        except Exception:
+            self.close()
+            raise
+
+    def job(self, name):
+        """Scheduler job name of a sensor, unique across devices"""
+        return f"{self.id}/{name}"
+
+    def add_sensor(self, name, sensor, driver=None):
+        sensor_filter = SensorFilter.from_config(sensor.options)
+        rollup = SensorRollup.from_config(sensor.options)
+        adaptive = AdaptiveInterval.from_config(sensor.options)
+        self.sensors[name] = sensor
+        self.drivers[name] = driver = driver if driver is not None else create_driver(sensor.options)
+        self.topics[name] = sensor_state_topics(self.name, name, driver, compact=self.compact)
+        if sensor_filter is not None:
+            self.filters[name] = sensor_filter
+        if rollup is not None:
+            self.rollups[name] = rollup
+        if adaptive is not None:
+            self.adaptive[name] = adaptive
+
+    def discovery_topics(self, name):
+        """Discovery topics of every entity of a sensor"""
+        return sensor_topics(self.name, name, self.drivers[name], self.rollups.get(name))
+
+    def remove_sensor(self, name):
+        """Forget a sensor and release its driver, returns the driver"""
+        del self.sensors[name]
+        self.filters.pop(name, None)
+        self.rollups.pop(name, None)
+        self.adaptive.pop(name, None)
+        self.topics.pop(name, None)
+        driver = self.drivers.pop(name)
+        driver.close()
+        return driver
+
+    def close(self):
+        for driver in self.drivers.values():
+            driver.close()
+
+
+class Fleet:
+    """
+    The devices served by this container, kept in step with the scheduler
+
+    Every sensor is scheduled as a '<device id>/<sensor name>' job and
+    on_result() routes readings back to the owning device, then reschedules
+    sensors with an adaptive interval. update() applies a changed
+    configuration while running.
+    """
+
+    def __init__(self, client, scheduler, availability_topic=None):
+        self.client = client
+        self.scheduler = scheduler
+        self.availability_topic = availability_topic
+        self.devices = {}
+        # Job name -> driver of every scheduled sensor
+        self.drivers = {}
+        self._routes = {}
+
+    def __iter__(self):
+        return iter(list(self.devices.values()))
+
+    def __len__(self):
+        return len(self.devices)
+
+    @property
+    def sensor_count(self):
+        return len(self.drivers)
+
+    def add_device(self, device):
+        self.devices[device.id] = device
+        for name in device.drivers:
+            self._schedule(device, name)
+        return device
+
+    def remove_device(self, device_id):
+        device = self.devices.pop(device_id)
+        for name in device.drivers:
+            self._unschedule(device, name)
+        device.close()
+        return device
+
+    def _schedule(self, device, name):
+        job = device.job(name)
+        self._routes[job] = (device, name)
+        self.drivers[job] = device.drivers[name]
+        interval = device.sensors[name].update_interval
+        adaptive = device.adaptive.get(name)
+        if adaptive is not None:
+            adaptive.reset(interval)
+            interval = adaptive.interval
+        self.scheduler.add(job, interval, device.drivers[name])
+
+    def _unschedule(self, device, name):
+        job = device.job(name)
+        self.scheduler.remove(job)
+        self._routes.pop(job, None)
+        self.drivers.pop(job, None)
+
+    def on_result(self, job, values):
+        """Pipeline callback, readings of sensors removed while being read are dropped"""
+        route = self._routes.get(job)
+        if route is not None:
+            device, name = route
+            device.on_result(name, values)
+            adaptive = device.adaptive.get(name)
+            if adaptive is not None:
+                interval = adaptive.update(values)
+                if interval is not None:
+                    self.scheduler.set_interval(job, interval)
+
+    def close(self):
+        for device in self.devices.values():
+            device.close()
+
+    def update(self, device_configs, queue, cache=None, targets=None, standby_caches=()):
+        """
+        Apply a changed list of device configs without touching unchanged sensors
+
+        Sensors are added, removed, rescheduled (only update_interval
+        changed) or replaced (anything else changed). Devices whose own
+        settings changed are replaced as a whole. Discovery configs are
+        published for new and replaced sensors and cleared for sensors that
+        no longer exist, to queue or to every (queue, cache) pair of
+        targets when publishing to several brokers. standby_caches are the
+        discovery caches of brokers that do not get the changes now (failover
+        standbys), they forget every changed topic so its config is sent when
+        the broker becomes active. Everything new is created before anything
+        is changed, so an invalid configuration leaves the running one intact.
+        Returns {'added': n, 'removed': n, 'changed': n} sensor counts.
+        """
+        configs = {device.id: device for device in device_configs}
+
+        # Create new devices and drivers first, any error aborts the update here
+        new_devices, new_drivers = {}, {}
+        try:
+            for device_id, config in configs.items():
+                device = self.devices.get(device_id)
+                if device is None or device_settings(device.config) != device_settings(config):
+                    new_devices[device_id] = Device(config, self.client)
+                    continue
+                for sensor in config.sensors:
+                    old = device.sensors.get(sensor.name)
+                    if old is None or _without_interval(old) != _without_interval(sensor):
+                        SensorFilter.from_config(sensor.options)
+                        SensorRollup.from_config(sensor.options)
+                        AdaptiveInterval.from_config(sensor.options)
+                        new_drivers[(device_id, sensor.name)] = create_driver(sensor.options)
+        except Exception:
+            for device in new_devices.values():
+                device.close()
+            for driver in new_drivers.values():
+                driver.close()
+            raise
+
+        summary = {'added': 0, 'removed': 0, 'changed': 0}
+        stale, announce = set(), []
+
+        existing = set(self.devices)
+        for device_id in existing:
+            if device_id in configs and device_id not in new_devices:
+                continue
+            device = self.remove_device(device_id)
+            replacement = new_devices[device_id].drivers if device_id in new_devices else {}
+            for name in device.drivers:
+                stale.update(device.discovery_topics(name))
+                summary['changed' if name in replacement else 'removed'] += 1
+            summary['added'] += len(set(replacement) - set(device.drivers))
+
+        for device_id, device in new_devices.items():
+            self.add_device(device)
+            announce += [(device, name) for name in device.drivers]
+            if device_id not in existing:
+                summary['added'] += len(device.drivers)
+
+        for device_id, config in configs.items():
+            if device_id in new_devices:
+                continue
+            device = self.devices[device_id]
+            sensors = {sensor.name: sensor for sensor in config.sensors}
+            for name in list(device.sensors):
+                if name not in sensors:
+                    self._unschedule(device, name)
+                    stale.update(device.discovery_topics(name))
+                    device.remove_sensor(name)
+                    summary['removed'] += 1
+            for name, sensor in sensors.items():
+                old = device.sensors.get(name)
+                if old == sensor:
+                    continue
+                driver = new_drivers.get((device_id, name))
+                if driver is None:
+                    # Only the interval changed, keep the driver and its filter state
+                    device.sensors[name] = sensor
+                    if name in device.adaptive:
+                        # Bounds not set explicitly follow update_interval
+                        device.adaptive[name] = AdaptiveInterval.from_config(sensor.options)
+                    self._schedule(device, name)
+                    summary['changed'] += 1
+                    continue
+                if old is not None:
+                    self._unschedule(device, name)
+                    stale.update(device.discovery_topics(name))
+                    device.remove_sensor(name)
+                device.add_sensor(name, sensor, driver)
+                self._schedule(device, name)
+                announce.append((device, name))
+                summary['changed' if old is not None else 'added'] += 1
+            device.config = config
+
+        fresh = {topic for device, name in announce for topic in device.discovery_topics(name)}
+        for target_queue, target_cache in targets or [(queue, cache)]:
+            for topic in sorted(stale - fresh):
+                # An empty retained config removes the entity from Home Assistant
+                target_queue.publish(topic, b'', retain=True)
+                if target_cache is not None:
+                    target_cache.forget(topic)
+            for device, name in announce:
+                publish_sensor_discovery(target_queue, device.name, name, device.drivers[name], cache=target_cache,
+                                         compact=device.compact, availability_topic=self.availability_topic,
+                                         rollup=device.rollups.get(name))
+            if target_cache is not None:
+                target_cache.save()
+        for standby_cache in standby_caches:
+            for topic in stale | fresh:
+                standby_cache.forget(topic)
+            standby_cache.save()
+        return summary
+
+
+
+def _without_interval(sensor):
+    return {key: value for key, value in sensor.options.items() if key != 'update_interval'}
+
+
+# Config fields that need a restart to take effect, devices and their sensors are reloaded while running
+RESTART_REQUIRED = ('mqtt', 'publish', 'spool', 'discovery', 'metrics', 'sampling', 'bus', 'logging')
+
+
+async def run(config, stop_event=None, config_path=None, record=None, replay=None, replay_speed=1.0):
+    """
+    Run the sensor container on the asyncio event loop until SIGINT or SIGTERM
+    config is a Config from parse_config(), or a raw configuration dict that is validated first
+    A stop_event passed in replaces the signal handlers, returns the publish queue statistics
+    With config_path, changes to that file (or SIGHUP) are applied without reconnecting
+    record is a file every reading and read error is written to as a binary trace
+    replay is a trace whose readings are published instead of reading the sensors, at replay_speed times the
+    recorded pace (0 as fast as possible); the container stops once the trace is published
+    Raises RuntimeError after stopping when one of the container's tasks ended by itself, e.g. with an error
+    """
+    if isinstance(config, dict):
+        config = parse_config(config)
+    # The configured broker first, then any further brokers in order
+    endpoints = [BrokerConfig(config.mqtt.broker, config.mqtt.port, config.mqtt.username, config.mqtt.password),
+                 *config.mqtt.brokers]
+    fanout = config.mqtt.mode == 'fanout' and len(endpoints) > 1
+
+    loop = asyncio.get_running_loop()
+    # Optional Prometheus endpoint
+    metrics = None
+    if config.metrics.port is not None:
+        from metrics import Metrics
+        metrics = Metrics.from_config(config.metrics)
+    v5 = config.mqtt.protocol == '5'
+
+    def publish_properties():
+        if not v5:
+            return None
+        from mqtt5 import PublishProperties
+        return PublishProperties(config.mqtt.topic_aliases, config.mqtt.message_expiry, config.mqtt.timestamps)
+
+    def publish_queue(properties):
+        # Readings and discovery configs are queued and handed to paho in rate limited batches
+        return PublishQueue.from_config(config.publish, metrics=metrics, properties=properties,
+                                        track_latency=config.sampling.max_backoff is not None)
+
+    def broker_connection(index, endpoint, link_queue):
+        """Client and connection of the index-th broker, the client's messages come from link_queue"""
+        connects = 0
+
+        def handle_connect(client, userdata, flags, rc):
+            nonlocal connects
+            on_connect(client, userdata, flags, rc)
+            if rc == 0:
+                connects += 1
+                if metrics is not None and connects > 1:
+                    metrics.reconnects.inc()
+
+        def handle_disconnect(client, userdata, rc):
+            # rc 0 is a disconnect we asked for
+            logger.log(logging.WARNING if rc != 0 else logging.INFO,
+                       "Disconnected from MQTT broker %s:%s, return code %s", endpoint.broker, endpoint.port, rc,
+                       extra={'rc': rc, 'broker': f"{endpoint.broker}:{endpoint.port}"})
+            loop.call_soon_threadsafe(link_disconnected, links[index])
+
+        # With clean_session false the broker keeps the session (subscriptions, QoS 1/2 messages) across reconnects
+        connect_options = {}
+        if v5:
+            client = mqtt.Client(client_id=config.mqtt.client_id, protocol=mqtt.MQTTv5)
+            connect_options['clean_start'] = config.mqtt.clean_session
+            if not config.mqtt.clean_session:
+                from mqtt5 import session_properties
+                connect_options['properties'] = session_properties(config.mqtt.session_expiry)
+        else:
+            client = mqtt.Client(client_id=config.mqtt.client_id, clean_session=config.mqtt.clean_session)
+        client.username_pw_set(endpoint.username, endpoint.password)
+        # paho's own messages, e.g. logging: levels: paho: DEBUG
+        client.enable_logger(logging.getLogger('paho'))
+        client.on_publish = link_queue.on_publish
+        # Keep paho's own buffers bounded, the publish queue decides what to drop
+        client.max_inflight_messages_set(link_queue.max_inflight or 20)
+        client.max_queued_messages_set(link_queue.max_inflight or 20)
+        return MqttConnection(
+            client, endpoint.broker, endpoint.port, config.mqtt.keepalive,
+            # Jittered so a fleet of nodes does not reconnect in lockstep after a broker restart
+            backoff=Backoff(config.mqtt.reconnect_delay, config.mqtt.reconnect_max_delay),
+            availability_topic=config.mqtt.availability_topic,
+            on_connect=handle_connect,
+            on_disconnect=handle_disconnect,
+            connect_options=connect_options,
+        )
+
+    # Fan-out gives every broker its own queue, failover shares one queue among all brokers
+    shared_properties = None if fanout else publish_properties()
+    shared_queue = None if fanout else publish_queue(shared_properties)
+    links = []
+    for index, endpoint in enumerate(endpoints):
+        properties = publish_properties() if fanout else shared_properties
+        link_queue = publish_queue(properties) if fanout else shared_queue
+        name = f"{endpoint.broker}:{endpoint.port}"
+        links.append(BrokerLink(
+            name, broker_connection(index, endpoint, link_queue), link_queue,
+            # Optionally skip discovery configs the broker already has, one cache file per broker
+            cache=DiscoveryCache.from_config(config.discovery, scope=name, suffix=f".{index}" if index else ''),
+            properties=properties,
+        ))
+    queue = links[0].queue
+    # Metrics, the load monitor and the returned statistics cover the queues of every broker
+    queues = QueueGroup([link.queue for link in links]) if fanout else queue
+    # Optionally read every sensor less often while publishing falls behind
+    load_monitor = LoadMonitor.from_config(queues, config.sampling)
+    # Optionally spool readings to disk while the broker is unreachable
+    spool = Spool.from_config(config.spool)
+    store = None
+    if spool is not None:
+        store = StoreAndForward(queue, spool, replay_rate=config.spool.replay_rate)
+
+    def activate(link):
+        """Start publishing to a (re)connected broker"""
+        link.queue.reset_inflight()
+        if link.properties is not None:
+            # Topic aliases start over on every connection, limited by what the broker accepts
+            link.properties.reset(getattr(link.connection.connack_properties, 'TopicAliasMaximum', 0))
+        if store is not None and link.queue is queue:
+            store.set_connected(True)
+        # Discovery is (re)published after every connect, the broker may have lost the retained configs
+        link.announce.set()
+
+    # Without fan-out the first reachable broker is the active one, the others are hot standbys
+    failover = None if fanout else Failover(links, on_switch=activate)
+
+    def link_connected(link):
+        if failover is None or (not failover.update() and link is failover.active):
+            activate(link)
+
+    def link_disconnected(link):
+        if failover is not None:
+            failover.update()
+            offline = not failover.connected.is_set()
+        else:
+            offline = link is links[0]
+        if store is not None and offline:
+            store.set_connected(False)
+
+    for link in links:
+        link.connection.add_connect_hook(lambda session_present, link=link: link_connected(link))
+
+    # All devices share one scheduler and publish path, fan-out hands each message to every broker's queue
+    sink = store or queue
+    if fanout:
+        sink = FanOut([sink] + [link.queue for link in links[1:]])
+    scheduler = Scheduler()
+    fleet = Fleet(sink, scheduler, availability_topic=config.mqtt.availability_topic)
+    for device_config in config.devices:
+        fleet.add_device(Device(device_config, sink))
 
+    on_result, on_error = fleet.on_result, on_read_error
+    # Optionally share every reading with local processes through shared memory
+    bus = None
+    if config.bus.path is not None:
+        from bus import SensorBus
+        bus = SensorBus.from_config(config.bus)
+        on_result = bus.tap(on_result)
+    recorder = None
+    if record is not None:
+        from recording import TraceWriter
+        recorder = TraceWriter(record)
+        on_result, on_error = recorder.tap(on_result, on_error)
 
-    client = mqtt.Client(client_id=f"{device_name}_sensor_container")
-    client.username_pw_set(username, password)
-    client.on_connect = on_connect
+    def read_workers(config):
+        # One worker per sensor by default, so even hung reads cannot starve the others
+        return config.read_workers or max(1, fleet.sensor_count)
 
-    print(f"Connecting to MQTT broker at {broker}:{port}...")
+    pipeline = ReadPipeline(on_result, on_error, max_workers=read_workers(config), metrics=metrics)
+
+    async def announce_discovery(link):
+        while True:
+            await link.announce.wait()
+            link.announce.clear()
+            logger.info("Publishing MQTT Discovery configurations to %s...", link.name, extra={'broker': link.name})
+            await publish_all_discovery(link.client, link.queue, fleet, cache=link.cache,
+                                        availability_topic=config.mqtt.availability_topic)
+
+    current = config
+
+    def apply_config(raw):
+        nonlocal current
+        new_config = parse_config(raw)
+        for section in RESTART_REQUIRED:
+            if getattr(current, section) != getattr(new_config, section):
+                logger.warning("Changes to the %s section take effect after a restart", section)
+        if failover is not None:
+            active = failover.active or links[0]
+            summary = fleet.update(new_config.devices, queue, cache=active.cache,
+                                   standby_caches=[link.cache for link in links
+                                                   if link is not active and link.cache is not None])
+        else:
+            summary = fleet.update(new_config.devices, queue, targets=[(link.queue, link.cache) for link in links])
+        pipeline.resize(read_workers(new_config))
+        current = new_config
+        logger.info("Configuration reloaded: %d sensor(s) added, %d removed, %d changed",
+                    summary['added'], summary['removed'], summary['changed'], extra=summary)
+
+    if stop_event is None:
+        stop_event = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop_event.set)
+
+    if metrics is not None:
+        metrics.watch_queue(queues)
+        metrics.watch_drivers(fleet.drivers)
+        if spool is not None:
+            metrics.watch_spool(spool)
+        await metrics.start()
+
+    for link in links:
+        logger.info("Connecting to MQTT broker at %s...", link.name, extra={'broker': link.name})
+    await asyncio.gather(*(link.connection.start() for link in links))
+    # Publishing starts once the active broker (failover) or the first broker (fan-out) is connected
+    ready = failover.connected if failover is not None else links[0].connection.connected
     try:
-        client.connect(broker, port, 60)
-        client.loop_start()
+        await asyncio.wait_for(ready.wait(), 5)
+    except TimeoutError:
+        logger.warning("MQTT broker not reachable yet, readings are buffered until it is")
+
+    logger.info("Starting continuous publish loop for %d sensor(s) on %d device(s)", fleet.sensor_count, len(fleet))
 
-        time.sleep(2)  # wait for connection to establish
+    async def monitor_load():
+        while True:
+            await asyncio.sleep(1.0)
+            scheduler.scale = load_monitor.update()
 
-        print("\nPublishing MQTT Discovery configurations...")
-        publish_discovery_config(client, device_name, sensor_type=sensor_type, unitOfMeasurement="°C", device_class="temperature")
-        publish_discovery_config(client, device_name, sensor_type=sensor_type, unitOfMeasurement="%", device_class="humidity")
-        
+    async def replay_and_stop():
+        from recording import replay_trace
+        start = loop.time()
+        count = await replay_trace(replay, on_result, on_error, speed=replay_speed)
+        # Give the queue a chance to publish the last readings
+        while any(link.queue.depth and link.connected for link in links):
+            await asyncio.sleep(0.05)
+        elapsed = loop.time() - start
+        logger.info("Replayed %d records from %s in %.1f s", count, replay, elapsed,
+                    extra={'records': count, 'elapsed': elapsed, **queues.stats()})
+        stop_event.set()
 
-        print(f"\nStarting continuous publish loop (every {update_interval} seconds)...")
-        print("Press Ctrl+C to stop\n")
+    tasks = [asyncio.create_task(announce_discovery(link), name=f"discovery {link.name}") for link in links]
+    if failover is not None:
+        # The shared queue publishes through whichever broker is active
+        tasks.append(asyncio.create_task(queue.run(failover, ready=failover.connected), name='publish queue'))
+    else:
+        tasks += [asyncio.create_task(link.queue.run(link.client, ready=link.connection.connected),
+                                      name=f"publish queue {link.name}") for link in links]
+    if replay is not None:
+        logger.info("Replaying readings from %s instead of reading sensors", replay)
+        tasks.append(asyncio.create_task(replay_and_stop(), name='replay'))
+    else:
+        tasks.append(asyncio.create_task(scheduler.run(pipeline, housekeeping=pipeline.check_timeouts),
+                                         name='scheduler'))
+    if store is not None:
+        tasks.append(asyncio.create_task(store.run(), name='spool replay'))
+    if load_monitor is not None:
+        tasks.append(asyncio.create_task(monitor_load(), name='load monitor'))
+    if metrics is not None:
+        tasks.append(asyncio.create_task(metrics.monitor_loop(), name='metrics'))
+    if config_path is not None:
+        from reload import ConfigWatcher
+        watcher = ConfigWatcher(config_path, load_config, apply_config, interval=config.reload_interval)
+        tasks.append(asyncio.create_task(watcher.run(), name='config watcher'))
 
-        ## Continuous publish loop; read sensor and publish data
+    stopping = asyncio.create_task(stop_event.wait())
+    ended = None
+    try:
+        # Every task runs until cancelled, one that ends by itself would leave the container half working
+        done, _ = await asyncio.wait([stopping, *tasks], return_when=asyncio.FIRST_COMPLETED)
+        if not stop_event.is_set():
+            ended = next(task for task in tasks if task in done)
+            error = None if ended.cancelled() else ended.exception()
+            logger.error("The %s task ended: %s, stopping", ended.get_name(), error or "no error",
+                         extra={'task': ended.get_name()})
+        logger.info("Stopping publisher...")
+    finally:
+        stopping.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        pipeline.shutdown()
+        fleet.close()
+        if recorder is not None:
+            recorder.close()
+            logger.info("Recorded %d readings to %s", recorder.records, record)
+        if bus is not None:
+            bus.close()
+            if bus.oversized:
+                logger.warning("%d readings did not fit a bus record, raise bus.record_size", bus.oversized)
+        await asyncio.gather(*(link.connection.stop() for link in links))
+        if spool is not None:
+            spool.close()
+        if metrics is not None:
+            await metrics.stop()
+        logger.info("Disconnected from MQTT broker")
+    if ended is not None:
+        raise RuntimeError(f"The {ended.get_name()} task ended") from error
+    return queues.stats()
 
-    except KeyboardInterrupt:
-        print("\n\nStopping publisher...")
-        client.loop_stop()
-        client.disconnect()
-        print("Disconnected from MQTT broker")
 
-    except Exception as e:
-        print(f"Error: {e}")
-        client.loop_stop()
-        client.disconnect()
+def main(argv=None):
+    """Main function"""
+    parser = argparse.ArgumentParser(description="Publish sensor readings to Home Assistant over MQTT")
+    parser.add_argument('--record', metavar='FILE', help="write every reading to a binary trace file")
+    parser.add_argument('--replay', metavar='FILE', help="publish the readings of a trace instead of reading sensors")
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help="replay pace relative to the recording, 0 for as fast as possible")
+    args = parser.parse_args(argv)
 
+    # Load and validate the configuration before anything else, errors are reported without a traceback
+    try:
+        config = read_config('config.yml')
+    except (OSError, yaml.YAMLError, ConfigError) as e:
+        sys.exit(f"Invalid configuration in config.yml: {e}")
+    listener = setup_logging(config.logging)
+    logger.info("Loaded configuration from config.yml")
+
+    try:
+        asyncio.run(run(config, config_path='config.yml', record=args.record, replay=args.replay,
+                        replay_speed=args.replay_speed))
+    except Exception:
+        logger.exception("Error")
+        return 1
+    finally:
+        listener.stop()
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
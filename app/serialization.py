@@ -0,0 +1,59 @@
+import json
+import math
+
+try:
+    import orjson
+except ImportError:  # optional, the standard library is used instead
+    orjson = None
+
+
+def dumps(obj):
+    """Serialize obj to compact JSON bytes, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def _is_plain_number(value):
+    return (type(value) is int) or (type(value) is float and math.isfinite(value))
+
+
+class StateTemplate:
+    """
+    Pre-built JSON template for readings with a fixed set of measurements
+
+    Readings consisting only of finite numbers are rendered by filling the
+    template, anything else falls back to dumps().
+    """
+
+    __slots__ = ('_format', 'keys')
+
+    def __init__(self, keys):
+        self.keys = tuple(keys)
+        self._format = '{' + ','.join(json.dumps(key).replace('%', '%%') + ':%s' for key in self.keys) + '}'
+
+    def render(self, values):
+        if len(values) != len(self.keys):
+            return dumps(values)
+        try:
+            items = tuple(values[key] for key in self.keys)
+        except KeyError:
+            return dumps(values)
+        if not all(_is_plain_number(item) for item in items):
+            return dumps(values)
+        # repr() of ints and finite floats is valid JSON
+        return (self._format % tuple(map(repr, items))).encode()
+
+
+class StateSerializer:
+    """Render compact state payloads, keeping one template per sensor and set of measurements"""
+
+    def __init__(self):
+        self._templates = {}
+
+    def render(self, name, values):
+        key = (name, tuple(values))
+        template = self._templates.get(key)
+        if template is None:
+            template = self._templates[key] = StateTemplate(values)
+        return template.render(values)
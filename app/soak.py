@@ -0,0 +1,268 @@
+"""
+Soak test of the sensor container with memory, thread and jitter gates
+
+Runs the real container (scheduler, read pipeline with simulated blocking
+sensors, rollups, publish queue, paho client) against the benchmark's
+in-process broker stand-in for a simulated duration, and samples resident
+memory, memory traced by tracemalloc, the number of live objects and
+threads. Time is compressed: every simulated interval (sensor reads,
+rollup windows, the duration itself) is divided by speed, so six hours of
+one-minute readings take one minute at speed 360:
+
+    python soak.py --devices 10 --sensors 4 --duration 21600 --speed 360
+
+The first warmup fraction of the run fills pools, caches and buffers and
+is not measured. Growth over the rest of the run is taken from a least
+squares fit of the samples, so a single noisy sample does not fail the
+run. Publish jitter is how far each state message arrives from the grid
+of its sensor's read interval. The exit status is 1 when growth or the p99
+jitter exceeds a threshold.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark import LocalBroker, max_rss_mb
+from config import LoggingConfig
+from logs import setup_logging
+from sensor_container import run, sensor_state_topic, state_topic
+
+# Upper bounds of the growth after warm-up and of the publish jitter
+THRESHOLDS = {
+    'rss_mb': 5.0,
+    'traced_kb': 1024.0,
+    'objects': 5000,
+    'threads': 0,
+    'p99_jitter_ms': 250.0,
+}
+
+# Sampled values, in the order of the sample tuples after the elapsed time
+METRICS = ('rss_mb', 'traced_kb', 'objects', 'threads')
+
+
+def rss_mb():
+    """Current resident set size of this process, the peak where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as file:
+            pages = int(file.read().split()[1])
+    except OSError:
+        return max_rss_mb()
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+def sample(start):
+    """(elapsed seconds, RSS in MB, traced KB, live objects, threads)"""
+    return (time.perf_counter() - start, rss_mb(), tracemalloc.get_traced_memory()[0] / 1024,
+            len(gc.get_objects()), threading.active_count())
+
+
+def growth(samples, index):
+    """Growth of a sampled value over the samples, from a least squares line through them"""
+    if len(samples) < 2:
+        return 0.0
+    times = [entry[0] for entry in samples]
+    values = [entry[index] for entry in samples]
+    mean_time = sum(times) / len(times)
+    mean_value = sum(values) / len(values)
+    variance = sum((t - mean_time) ** 2 for t in times)
+    if not variance:
+        return 0.0
+    slope = sum((t - mean_time) * (v - mean_value) for t, v in zip(times, values)) / variance
+    return slope * (times[-1] - times[0])
+
+
+def jitter(gap, interval):
+    """Distance in seconds of the gap between two arrivals from the grid of interval, missed readings are skipped"""
+    return abs(gap - max(1, round(gap / interval)) * interval)
+
+
+def histogram_percentile(histogram, percent):
+    """Nearest-rank percentile of a {value: count} histogram"""
+    total = sum(histogram.values())
+    if not total:
+        return None
+    rank = max(1, min(total, round(percent / 100 * total)))
+    for value in sorted(histogram):
+        rank -= histogram[value]
+        if rank <= 0:
+            return value
+
+
+def soak_config(port, devices, sensors, interval, speed, read_delay=0.002, rollup=300.0, compact=False):
+    """Configuration of devices x sensors simulated sensors with intervals compressed by speed"""
+    def sensor(index):
+        options = {'type': 'simulated', 'name': f"sensor_{index}", 'update_interval': interval / speed,
+                   'read_delay': read_delay, 'seed': index}
+        if rollup:
+            options['rollup'] = {'interval': rollup / speed}
+        return options
+
+    return {
+        'mqtt': {'broker': '127.0.0.1', 'port': port, 'username': None, 'password': None,
+                 'client_id': 'soak_sensor_container'},
+        'devices': [
+            {'name': f"Soak {device}", 'compact_state': compact,
+             'sensors': [sensor(index) for index in range(sensors)]}
+            for device in range(devices)
+        ],
+    }
+
+
+def state_topics(config):
+    """State topics of the readings in a soak configuration"""
+    topics = set()
+    for device in config['devices']:
+        for sensor in device['sensors']:
+            if device['compact_state']:
+                topics.add(sensor_state_topic(device['name'], sensor['name']))
+            else:
+                topics.update(state_topic(device['name'], f"{sensor['name']}_{measurement}")
+                              for measurement in ('temperature', 'humidity'))
+    return topics
+
+
+async def soak(devices=10, sensors=4, interval=60.0, duration=3600.0, speed=60.0, warmup=0.2, samples=60,
+               read_delay=0.002, rollup=300.0, compact=False):
+    """Run the container for duration simulated seconds and return the samples, growth and jitter"""
+    real_duration = duration / speed
+    topics = set()
+    # Last arrival per state topic and jitter in 1 ms buckets, the harness must not grow itself
+    last = {}
+    histogram = Counter()
+    readings = 0
+
+    def on_message(topic, payload, received_at):
+        nonlocal readings
+        if topic not in topics:
+            return
+        readings += 1
+        previous, last[topic] = last.get(topic), received_at
+        if previous is not None and previous - start >= warmup * real_duration:
+            histogram[round(jitter(received_at - previous, interval / speed) * 1000)] += 1
+
+    broker = LocalBroker(on_message=on_message).start()
+    config = soak_config(broker.port, devices, sensors, interval, speed, read_delay=read_delay, rollup=rollup,
+                         compact=compact)
+    topics.update(state_topics(config))
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    stop_event = asyncio.Event()
+    # A fixed number of samples, so a longer run does not grow the harness either
+    taken = []
+    # Samples read /proc and walk every object, off the event loop the container runs on
+    loop = asyncio.get_running_loop()
+    sampler = ThreadPoolExecutor(max_workers=1, thread_name_prefix='soak-sample')
+    try:
+        start = time.perf_counter()
+        container = asyncio.create_task(run(config, stop_event=stop_event))
+        for index in range(1, samples + 1):
+            await asyncio.sleep(max(0.0, start + index * real_duration / samples - time.perf_counter()))
+            taken.append(await loop.run_in_executor(sampler, sample, start))
+        stop_event.set()
+        queue_stats = await container
+    finally:
+        sampler.shutdown()
+        broker.stop()
+        if not tracing:
+            tracemalloc.stop()
+
+    measured = [entry for entry in taken if entry[0] >= warmup * real_duration]
+    return {
+        'sensors': devices * sensors,
+        'simulated_seconds': duration,
+        'duration': real_duration,
+        'readings': readings,
+        'samples': [dict(zip(('elapsed',) + METRICS, entry)) for entry in taken],
+        'start': dict(zip(METRICS, measured[0][1:])) if measured else None,
+        'growth': {metric: growth(measured, index) for index, metric in enumerate(METRICS, start=1)},
+        'peak_threads_growth': max((entry[4] for entry in measured), default=0) - (measured[0][4] if measured else 0),
+        'jitter_ms': {name: histogram_percentile(histogram, percent)
+                      for name, percent in (('p50', 50), ('p99', 99), ('max', 100))},
+        'queue': queue_stats,
+    }
+
+
+def check(result, thresholds=None):
+    """Descriptions of the thresholds the result exceeds, empty when the soak test passed"""
+    thresholds = {**THRESHOLDS, **(thresholds or {})}
+    failures = []
+    for metric in ('rss_mb', 'traced_kb', 'objects'):
+        if result['growth'][metric] > thresholds[metric]:
+            failures.append(f"{metric} grew by {result['growth'][metric]:.1f}, limit {thresholds[metric]}")
+    threads = max(result['growth']['threads'], result['peak_threads_growth'])
+    if threads > thresholds['threads']:
+        failures.append(f"threads grew by {threads:.0f}, limit {thresholds['threads']}")
+    p99 = result['jitter_ms']['p99']
+    if p99 is None:
+        failures.append("no readings arrived after the warm-up")
+    elif p99 > thresholds['p99_jitter_ms']:
+        failures.append(f"p99 publish jitter {p99} ms, limit {thresholds['p99_jitter_ms']} ms")
+    return failures
+
+
+def format_report(result, failures):
+    grown = result['growth']
+    start = result['start'] or dict.fromkeys(METRICS, 0)
+    jitter_ms = result['jitter_ms']
+    lines = [
+        (f"Sensors:      {result['sensors']} over {result['simulated_seconds'] / 3600:.1f} simulated hours "
+         f"({result['duration']:.1f} s), {result['readings']} state messages"),
+        f"RSS:          {start['rss_mb']:.1f} MB, grew {grown['rss_mb']:+.2f} MB",
+        f"Traced:       {start['traced_kb']:.0f} KB, grew {grown['traced_kb']:+.1f} KB",
+        f"Objects:      {start['objects']}, grew {grown['objects']:+.0f}",
+        f"Threads:      {start['threads']}, grew {max(grown['threads'], result['peak_threads_growth']):+.0f}",
+    ]
+    if jitter_ms['p50'] is not None:
+        lines.append(f"Jitter:       p50 {jitter_ms['p50']} ms, p99 {jitter_ms['p99']} ms, max {jitter_ms['max']} ms")
+    lines.append(f"Queue:        {result['queue']['dropped']} dropped, {result['queue']['failed']} refused")
+    lines += [f"FAILED:       {failure}" for failure in failures] or ["Passed"]
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Soak test the sensor container against a local broker")
+    parser.add_argument('--devices', type=int, default=10, help="number of devices")
+    parser.add_argument('--sensors', type=int, default=4, help="sensors per device")
+    parser.add_argument('--interval', type=float, default=60.0, help="simulated seconds between readings")
+    parser.add_argument('--duration', type=float, default=21600.0, help="simulated seconds to run")
+    parser.add_argument('--speed', type=float, default=360.0, help="simulated seconds per real second")
+    parser.add_argument('--warmup', type=float, default=0.2, help="fraction of the run that is not measured")
+    parser.add_argument('--samples', type=int, default=60, help="number of resource samples over the run")
+    parser.add_argument('--rollup', type=float, default=300.0, help="simulated rollup window, 0 disables rollups")
+    parser.add_argument('--compact', action='store_true', help="publish compact JSON state")
+    parser.add_argument('--max-rss-growth', type=float, default=THRESHOLDS['rss_mb'], help="MB")
+    parser.add_argument('--max-traced-growth', type=float, default=THRESHOLDS['traced_kb'], help="KB")
+    parser.add_argument('--max-object-growth', type=int, default=THRESHOLDS['objects'], help="live objects")
+    parser.add_argument('--max-thread-growth', type=int, default=THRESHOLDS['threads'], help="threads")
+    parser.add_argument('--max-jitter', type=float, default=THRESHOLDS['p99_jitter_ms'], help="p99 jitter in ms")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    parser.add_argument('--log-level', default='WARNING', help="level of the container's own log messages")
+    args = parser.parse_args(argv)
+
+    thresholds = {'rss_mb': args.max_rss_growth, 'traced_kb': args.max_traced_growth,
+                  'objects': args.max_object_growth, 'threads': args.max_thread_growth,
+                  'p99_jitter_ms': args.max_jitter}
+    # Container logs go to stderr so they do not mix with the report
+    listener = setup_logging(LoggingConfig(level=args.log_level.upper(), format='text'), stream=sys.stderr)
+    try:
+        result = asyncio.run(soak(args.devices, args.sensors, args.interval, args.duration, args.speed,
+                                  warmup=args.warmup, samples=args.samples,
+                                  rollup=args.rollup, compact=args.compact))
+    finally:
+        listener.stop()
+    failures = check(result, thresholds)
+    print(json.dumps({**result, 'failures': failures}, indent=2) if args.json else format_report(result, failures))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,333 @@
+import asyncio
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+SpoolRecord = namedtuple('SpoolRecord', 'timestamp topic payload qos retain')
+
+MAGIC = b'SCSPOOL1'
+VERSION = 1
+# magic, version, capacity, head, tail, count, header crc
+HEADER = struct.Struct('<8sIIQQQI')
+HEADER_SIZE = 64
+# length of everything after the crc, crc, timestamp, qos, retain, topic length
+RECORD = struct.Struct('<IIdBBH')
+# Length value marking that the rest of the data region is unused
+WRAP = 0xFFFFFFFF
+
+
+class Spool:
+    """
+    Append-only ring buffer of MQTT messages in a memory-mapped file
+
+    The file never grows beyond its capacity; when full the oldest records
+    are dropped. Positions in the header are logical byte offsets that only
+    grow, the physical offset is the position modulo capacity. Records never
+    straddle the end of the data region.
+
+    Writes go to the page cache and are only flushed to disk every
+    sync_interval seconds, so an SD card is not worn out by one fsync per
+    reading. Each record carries a CRC; after a crash the spool is recovered
+    up to the last intact record.
+    """
+
+    def __init__(self, path, capacity=4 * 1024 * 1024, sync_interval=5.0, clock=time.monotonic):
+        if capacity < RECORD.size * 2:
+            raise ValueError(f"Spool capacity must be at least {RECORD.size * 2} bytes")
+        self.path = path
+        self.capacity = capacity
+        self.sync_interval = sync_interval
+        self.clock = clock
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._last_sync = clock()
+        self._dirty = False
+
+        exists = os.path.exists(path) and os.path.getsize(path) == HEADER_SIZE + capacity
+        # The mapping keeps its own reference to the file
+        with open(path, 'r+b' if exists else 'w+b') as file:
+            if not exists:
+                file.truncate(HEADER_SIZE + capacity)
+            self._map = mmap.mmap(file.fileno(), HEADER_SIZE + capacity)
+
+        self.head = self.tail = self.count = 0
+        if not (exists and self._load_header()):
+            self._write_header()
+        self._recover()
+
+    @classmethod
+    def from_config(cls, options):
+        """Create a spool from the spool section (a SpoolConfig), None when spooling is disabled"""
+        if options.path is None:
+            return None
+        return cls(
+            options.path,
+            capacity=int(options.max_size_mb * 1024 * 1024),
+            sync_interval=options.sync_interval,
+        )
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def used(self):
+        """Bytes of the data region in use"""
+        return self.head - self.tail
+
+    def _load_header(self):
+        magic, version, capacity, head, tail, count, crc = HEADER.unpack_from(self._map, 0)
+        fields = HEADER.pack(magic, version, capacity, head, tail, count, 0)
+        if magic != MAGIC or version != VERSION or capacity != self.capacity or zlib.crc32(fields) != crc:
+            return False
+        if not tail <= head <= tail + capacity:
+            return False
+        self.head, self.tail, self.count = head, tail, count
+        return True
+
+    def _write_header(self):
+        fields = HEADER.pack(MAGIC, VERSION, self.capacity, self.head, self.tail, self.count, 0)
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, self.capacity, self.head, self.tail, self.count,
+                         zlib.crc32(fields))
+
+    def _read_at(self, position):
+        """Return (bytes to advance, record), record is None for skipped space"""
+        offset = position % self.capacity
+        remaining = self.capacity - offset
+        if remaining < RECORD.size:
+            return remaining, None
+        start = HEADER_SIZE + offset
+        length = struct.unpack_from('<I', self._map, start)[0]
+        if length == WRAP:
+            return remaining, None
+
+        size = 8 + length
+        if size < RECORD.size or size > remaining:
+            raise ValueError(f"Corrupt spool record at {position}")
+        _, crc, timestamp, qos, retain, topic_length = RECORD.unpack_from(self._map, start)
+        if zlib.crc32(self._map[start + 8:start + size]) != crc:
+            raise ValueError(f"Spool record at {position} failed its checksum")
+        body = start + RECORD.size
+        topic = self._map[body:body + topic_length].decode()
+        payload = self._map[body + topic_length:start + size]
+        return size, SpoolRecord(timestamp, topic, payload, qos, bool(retain))
+
+    def _recover(self):
+        """Walk the spool and cut it off at the first damaged record"""
+        position, count = self.tail, 0
+        while position < self.head:
+            try:
+                size, record = self._read_at(position)
+            except (ValueError, UnicodeDecodeError):
+                break
+            position += size
+            if record is not None:
+                count += 1
+        position = min(position, self.head)
+        if (position, count) != (self.head, self.count):
+            self.head, self.count = position, count
+            self._write_header()
+
+    def _drop_oldest(self):
+        size, record = self._read_at(self.tail)
+        self.tail += size
+        if record is not None:
+            self.count -= 1
+            self.dropped += 1
+
+    def append(self, topic, payload, timestamp=None, qos=0, retain=False):
+        """Add a message, dropping the oldest messages if the spool is full"""
+        if isinstance(payload, str):
+            payload = payload.encode()
+        elif payload is None:
+            payload = b''
+        topic_bytes = topic.encode()
+        size = RECORD.size + len(topic_bytes) + len(payload)
+        if size > self.capacity // 2:
+            raise ValueError(f"Message of {size} bytes does not fit in the spool")
+        timestamp = time.time() if timestamp is None else timestamp
+
+        with self._lock:
+            offset = self.head % self.capacity
+            remaining = self.capacity - offset
+            skip = remaining if remaining < size else 0
+            while self.capacity - self.used < skip + size:
+                self._drop_oldest()
+
+            if skip:
+                if remaining >= 4:
+                    struct.pack_into('<I', self._map, HEADER_SIZE + offset, WRAP)
+                self.head += skip
+                offset = 0
+
+            start = HEADER_SIZE + offset
+            body = start + RECORD.size
+            self._map[body:body + len(topic_bytes)] = topic_bytes
+            self._map[body + len(topic_bytes):start + size] = payload
+            RECORD.pack_into(self._map, start, size - 8, 0, timestamp, qos, int(retain), len(topic_bytes))
+            struct.pack_into('<I', self._map, start + 4, zlib.crc32(self._map[start + 8:start + size]))
+
+            self.head += size
+            self.count += 1
+            self._write_header()
+            self._dirty = True
+            self._maybe_sync()
+
+    def peek(self, limit):
+        """Return up to limit of the oldest messages without removing them"""
+        records = []
+        with self._lock:
+            position = self.tail
+            while position < self.head and len(records) < limit:
+                size, record = self._read_at(position)
+                position += size
+                if record is not None:
+                    records.append(record)
+        return records
+
+    def pop(self, limit):
+        """Remove and return up to limit of the oldest messages"""
+        records = []
+        with self._lock:
+            while self.tail < self.head and len(records) < limit:
+                size, record = self._read_at(self.tail)
+                self.tail += size
+                if record is not None:
+                    self.count -= 1
+                    records.append(record)
+            if self.tail == self.head:
+                # Start over at the beginning of the file so records rarely need to wrap
+                self.head = self.tail = self.head + (self.capacity - self.head % self.capacity) % self.capacity
+            self._write_header()
+            self._dirty = True
+        return records
+
+    def maybe_sync(self):
+        """Flush changes to disk if sync_interval has passed since the last flush"""
+        with self._lock:
+            self._maybe_sync()
+
+    def _maybe_sync(self):
+        if self._dirty and self.clock() - self._last_sync >= self.sync_interval:
+            self._map.flush()
+            self._dirty = False
+            self._last_sync = self.clock()
+
+    def flush(self):
+        with self._lock:
+            self._map.flush()
+            self._dirty = False
+            self._last_sync = self.clock()
+
+    def close(self):
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+
+
+def add_timestamp(payload, timestamp):
+    """
+    Attach the original reading time to a replayed payload where the entity allows it
+
+    JSON object payloads (compact state, read through a value_template)
+    gain a timestamp key. Any other payload is the plain state of an entity
+    and is returned unchanged, Home Assistant would reject anything else.
+    """
+    text = payload.decode() if isinstance(payload, bytes) else payload
+    if not text.startswith('{'):
+        return payload
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return payload
+    if not isinstance(data, dict):
+        return payload
+    data['timestamp'] = round(timestamp, 3)
+    return json.dumps(data)
+
+
+class StoreAndForward:
+    """
+    Spool state messages while the broker is unreachable and replay them afterwards
+
+    publish() mirrors client.publish(). While connected, messages go
+    straight to the publish queue, otherwise they are appended to the
+    spool. replay() moves the backlog to the queue at replay_rate messages
+    per second alongside the live readings, so the spool empties however
+    busy the node is. Replayed messages carry their original time: as the
+    MQTT 5 timestamp user property when enabled, and as a timestamp key of
+    compact JSON payloads. Once the spool is empty, every topic whose
+    latest live reading was followed by replayed ones gets that reading
+    again, once, so no entity is left on an older value.
+    """
+
+    def __init__(self, queue, spool, replay_rate=10, interval=0.5, clock=time.monotonic):
+        self.queue = queue
+        self.spool = spool
+        self.replay_rate = replay_rate
+        self.interval = interval
+        self.clock = clock
+        self.connected = False
+        self._last_replay = clock()
+        # topic -> latest live (payload, qos, retain) while a backlog is being replayed
+        self._live = {}
+        # Topics with replayed messages sent after their latest live one
+        self._stale = set()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if not self.connected:
+            self.spool.append(topic, payload, qos=qos, retain=retain)
+            return (0, None)
+        if len(self.spool):
+            self._live[topic] = (payload, qos, retain)
+            self._stale.discard(topic)
+        return self.queue.publish(topic, payload, qos=qos, retain=retain)
+
+    def set_connected(self, connected):
+        self.connected = connected
+        self._last_replay = self.clock()
+
+    def replay(self):
+        """Move the next batch of spooled messages to the queue, returns the number moved"""
+        now = self.clock()
+        if not self.connected or not len(self.spool):
+            self._last_replay = now
+            self._live.clear()
+            self._stale.clear()
+            return 0
+
+        # Leave room in the queue for live readings
+        room = max(0, self.queue.max_size // 2 - self.queue.depth)
+        budget = min(int((now - self._last_replay) * self.replay_rate), room)
+        if budget <= 0:
+            return 0
+        self._last_replay = now
+
+        records = self.spool.pop(budget)
+        for record in records:
+            self.queue.publish(record.topic, add_timestamp(record.payload, record.timestamp),
+                               qos=record.qos, retain=record.retain, timestamp=record.timestamp)
+            if record.topic in self._live:
+                self._stale.add(record.topic)
+        if not len(self.spool):
+            # Backlog done, restore the live state of the topics it overwrote
+            for topic in sorted(self._stale):
+                payload, qos, retain = self._live[topic]
+                self.queue.publish(topic, payload, qos=qos, retain=retain)
+            self._live.clear()
+            self._stale.clear()
+        return len(records)
+
+    async def run(self):
+        """Replay spooled messages until cancelled"""
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                self.replay()
+                self.spool.maybe_sync()
+        finally:
+            self.spool.flush()
@@ -4,6 +4,7 @@ import time
 from unittest.mock import Mock, patch, MagicMock
 import paho.mqtt.client as mqtt
 import sensor_container
+from config import parse_config, parse_device, parse_devices
 
 
 class MockMQTTClient:
@@ -259,3 +260,539 @@ class TestMQTTIntegration:
         # In real scenario, the error would be logged/handled
         # Here we just verify the callback handles non-zero return codes
         assert True  # Callback should not raise exception
+
+    def test_multi_sensor_schedule(self, sample_config):
+        """Test every enabled sensor is read and published on its own interval"""
+        mock_client = MockMQTTClient()
+        sample_config['sensors'] = [
+            {'type': 'simulated', 'update_interval': 2},
+            {'type': 'simulated', 'name': 'outdoor', 'update_interval': 3},
+            {'type': 'dht22', 'enabled': False},
+        ]
+        now = [0.0]
+        scheduler = sensor_container.Scheduler(clock=lambda: now[0])
+        fleet = sensor_container.Fleet(mock_client, scheduler)
+        fleet.add_device(sensor_container.Device(parse_config(sample_config).devices[0], mock_client))
+
+        for step in range(7):
+            now[0] = float(step)
+            for job, driver in scheduler.pop_due():
+                fleet.on_result(job, driver.read())
+
+        topics = [msg['topic'] for msg in mock_client.published_messages]
+        assert topics.count("homeassistant/sensor/test_sensor/simulated_temperature/state") == 4
+        assert topics.count("homeassistant/sensor/test_sensor/outdoor_humidity/state") == 3
+
+    def test_read_pipeline_publishes_readings(self, sample_config):
+        """Test readings flow from the thread pool to MQTT state topics"""
+        mock_client = MockMQTTClient()
+        sample_config['sensors'] = [{'type': 'simulated'}, {'type': 'simulated', 'name': 'b'}]
+        fleet = sensor_container.Fleet(mock_client, sensor_container.Scheduler())
+        fleet.add_device(sensor_container.Device(parse_config(sample_config).devices[0], mock_client))
+        pipeline = sensor_container.ReadPipeline(
+            fleet.on_result,
+            sensor_container.on_read_error,
+            max_workers=2
+        )
+
+        pipeline(list(fleet.drivers.items()))
+        deadline = time.monotonic() + 2
+        while pipeline.busy() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        pipeline.shutdown()
+
+        assert len(mock_client.published_messages) == 4
+
+    def test_sensor_discovery_per_measurement(self):
+        """Test discovery is published for each measurement of a sensor"""
+        mock_client = MockMQTTClient()
+        driver = sensor_container.create_driver({'type': 'dht11'})
+
+        sensor_container.publish_sensor_discovery(mock_client, 'Test Sensor', 'dht11', driver)
+
+        topics = [msg['topic'] for msg in mock_client.published_messages]
+        assert topics == [
+            "homeassistant/sensor/test_sensor_dht11_temperature/config",
+            "homeassistant/sensor/test_sensor_dht11_humidity/config",
+        ]
+        payload = json.loads(mock_client.published_messages[0]['payload'])
+        assert payload['name'] == "Test Sensor dht11 Temperature"
+
+    def test_publish_queue_to_client(self):
+        """Test discovery and readings reach the client through the publish queue"""
+        mock_client = MockMQTTClient()
+        queue = sensor_container.PublishQueue()
+        driver = sensor_container.create_driver({'type': 'simulated'})
+
+        sensor_container.publish_sensor_discovery(queue, 'Test Sensor', 'simulated', driver)
+        sensor_container.make_result_handler(queue, 'Test Sensor')('simulated', driver.read())
+        assert mock_client.published_messages == []
+        assert queue.depth == 4
+
+        queue.flush(mock_client)
+
+        assert queue.depth == 0
+        assert [msg['retain'] for msg in mock_client.published_messages] == [True, True, False, False]
+
+    @pytest.mark.asyncio
+    async def test_publish_queue_task(self):
+        """Test the publisher task drains the queue once the client is ready"""
+        import asyncio
+
+        mock_client = MockMQTTClient()
+        queue = sensor_container.PublishQueue(interval=0.01)
+        ready = asyncio.Event()
+        task = asyncio.create_task(queue.run(mock_client, ready=ready))
+
+        queue.publish('topic', 'payload')
+        await asyncio.sleep(0.05)
+        assert mock_client.published_messages == []
+
+        ready.set()
+        await asyncio.sleep(0.05)
+        task.cancel()
+
+        assert mock_client.published_messages[0]['topic'] == 'topic'
+
+    @pytest.mark.asyncio
+    async def test_scheduler_task_reads_sensors(self, sample_config):
+        """Test the scheduler task reads simulated sensors on the event loop"""
+        import asyncio
+
+        mock_client = MockMQTTClient()
+        # The mock client never confirms messages, so do not limit in-flight messages
+        queue = sensor_container.PublishQueue(interval=0.01, max_inflight=0)
+        sample_config['sensors'] = [{'type': 'simulated', 'name': f's{index}', 'update_interval': 0.05}
+                                    for index in range(50)]
+        scheduler = sensor_container.Scheduler(tick=0.01)
+        fleet = sensor_container.Fleet(queue, scheduler)
+        fleet.add_device(sensor_container.Device(parse_config(sample_config).devices[0], queue))
+        pipeline = sensor_container.ReadPipeline(fleet.on_result, sensor_container.on_read_error)
+
+        tasks = [asyncio.create_task(scheduler.run(pipeline)), asyncio.create_task(queue.run(mock_client))]
+        await asyncio.sleep(0.12)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        pipeline.shutdown()
+
+        topics = {msg['topic'] for msg in mock_client.published_messages}
+        assert len(topics) == 100
+
+    def test_store_and_forward_outage(self, tmp_path):
+        """Test readings taken during an outage are replayed with their timestamps"""
+        mock_client = MockMQTTClient()
+        queue = sensor_container.PublishQueue()
+        spool = sensor_container.Spool(str(tmp_path / 'spool.bin'), capacity=65536)
+        now = [0.0]
+        store = sensor_container.StoreAndForward(queue, spool, replay_rate=100, clock=lambda: now[0])
+        on_result = sensor_container.make_result_handler(store, 'Test Sensor')
+
+        on_result('simulated', {'temperature': 20.5})
+        on_result('simulated', {'temperature': 21.0})
+        queue.flush(mock_client)
+        assert mock_client.published_messages == []
+
+        store.set_connected(True)
+        now[0] = 1.0
+        store.replay()
+        on_result('simulated', {'temperature': 21.5})
+        queue.flush(mock_client)
+
+        # Replayed readings keep the plain state payload of their entity, the live reading is not held back
+        payloads = [msg['payload'] for msg in mock_client.published_messages]
+        assert payloads == [b'20.5', b'21.0', '21.5']
+        spool.close()
+
+    def test_store_and_forward_compact_timestamps(self, tmp_path):
+        """Test replayed compact readings carry their original time next to the values"""
+        mock_client = MockMQTTClient()
+        queue = sensor_container.PublishQueue()
+        spool = sensor_container.Spool(str(tmp_path / 'spool.bin'), capacity=65536)
+        now = [0.0]
+        store = sensor_container.StoreAndForward(queue, spool, replay_rate=100, clock=lambda: now[0])
+        on_result = sensor_container.make_result_handler(store, 'Test Sensor', compact=True)
+
+        with patch('spool.time.time', return_value=1000.0):
+            on_result('simulated', {'temperature': 20.5, 'humidity': 40.0})
+        store.set_connected(True)
+        now[0] = 1.0
+        store.replay()
+        queue.flush(mock_client)
+
+        [message] = mock_client.published_messages
+        assert json.loads(message['payload']) == {'temperature': 20.5, 'humidity': 40.0, 'timestamp': 1000.0}
+        spool.close()
+
+    @pytest.mark.asyncio
+    async def test_discovery_republished_only_when_needed(self, tmp_path):
+        """Test restarts skip unchanged discovery configs unless the broker lost them"""
+        mock_client = MockMQTTClient()
+        devices = [sensor_container.Device(parse_device({'name': 'Test Sensor', 'sensors': [{'type': 'simulated'}]}),
+                                           mock_client)]
+        path = str(tmp_path / 'cache.json')
+
+        async def start(retained):
+            queue = sensor_container.PublishQueue()
+            cache = sensor_container.DiscoveryCache(path, verify_retained=True)
+            with patch('sensor_container.fetch_retained', return_value=retained):
+                published = await sensor_container.publish_all_discovery(
+                    mock_client, queue, devices, cache=cache)
+            queue.flush(mock_client)
+            return published
+
+        assert await start({}) == 2
+        retained = {msg['topic']: msg['payload'] for msg in mock_client.published_messages}
+
+        assert await start(retained) == 0
+
+        # The broker lost one retained config, only that one is sent again
+        retained.popitem()
+        assert await start(retained) == 1
+        assert len(mock_client.published_messages) == 3
+
+    def test_fleet_devices_share_one_client(self):
+        """Test every device of a fleet publishes its own discovery and state through one client"""
+        mock_client = MockMQTTClient()
+        config = {'devices': [
+            {'name': 'Living Room', 'sensors': [{'type': 'simulated', 'seed': 1}]},
+            {'name': 'Kitchen', 'compact_state': True, 'sensors': [{'type': 'simulated', 'seed': 2}]},
+        ]}
+        scheduler = sensor_container.Scheduler(clock=lambda: 0.0)
+        fleet = sensor_container.Fleet(mock_client, scheduler)
+        for device in parse_devices(config):
+            fleet.add_device(sensor_container.Device(device, mock_client))
+
+        for job, driver in scheduler.pop_due(0.0):
+            fleet.on_result(job, driver.read())
+
+        topics = {msg['topic'] for msg in mock_client.published_messages}
+        assert topics == {
+            'homeassistant/sensor/living_room/simulated_temperature/state',
+            'homeassistant/sensor/living_room/simulated_humidity/state',
+            'homeassistant/sensor/kitchen/simulated/state',
+        }
+
+        queue = sensor_container.PublishQueue(max_inflight=0)
+        for device in fleet:
+            for name, driver in device.drivers.items():
+                sensor_container.publish_sensor_discovery(queue, device.name, name, driver, compact=device.compact)
+        queue.flush(mock_client)
+        configs = [json.loads(msg['payload']) for msg in mock_client.published_messages
+                   if msg['topic'].endswith('/config')]
+        assert {config['device']['identifiers'][0] for config in configs} == {'living_room', 'kitchen'}
+
+    @pytest.mark.asyncio
+    async def test_benchmark_against_local_broker(self):
+        """Test the benchmark drives readings through paho to the local broker and measures them"""
+        import benchmark
+
+        result = await benchmark.benchmark(devices=2, sensors=2, rate=10, duration=1.0)
+
+        assert result['readings'] > 0
+        assert result['broker_messages'] > result['readings']
+        assert 0 <= result['latency_ms']['p50'] <= result['latency_ms']['max']
+        assert result['queue']['dropped'] == 0
+        assert result['max_rss_mb'] > 0
+
+    @pytest.mark.asyncio
+    async def test_mqtt5_topic_aliases(self):
+        """Test readings reach an MQTT v5 broker under their topic with fewer bytes than MQTT 3.1.1"""
+        import benchmark
+
+        v3 = await benchmark.benchmark(devices=1, sensors=2, rate=20, duration=1.0)
+        v5 = await benchmark.benchmark(devices=1, sensors=2, rate=20, duration=1.0, protocol='5')
+
+        assert v5['readings'] > 0
+        assert v5['queue']['dropped'] == 0
+        assert v5['broker_bytes'] / v5['broker_messages'] < v3['broker_bytes'] / v3['broker_messages']
+
+    @pytest.mark.asyncio
+    async def test_soak(self):
+        """Test a time compressed soak run samples memory and threads and measures publish jitter"""
+        import tracemalloc
+        import soak
+
+        result = await soak.soak(devices=1, sensors=4, interval=60, duration=1200, speed=600, samples=8)
+
+        assert len(result['samples']) == 8
+        assert result['readings'] > 100
+        assert result['growth']['threads'] == 0
+        assert 0 <= result['jitter_ms']['p50'] <= result['jitter_ms']['p99'] <= result['jitter_ms']['max']
+        assert result['queue']['dropped'] == 0
+        assert not tracemalloc.is_tracing()
+
+    @pytest.mark.asyncio
+    async def test_soak_detects_leak(self, monkeypatch):
+        """Test the soak gates fail when every sensor read leaks memory"""
+        import drivers
+        import soak
+
+        leaked = []
+        read = drivers.SimulatedDriver.read
+
+        def leaking_read(self):
+            leaked.append(bytearray(20000))
+            return read(self)
+
+        monkeypatch.setattr(drivers.SimulatedDriver, 'read', leaking_read)
+        result = await soak.soak(devices=1, sensors=4, interval=60, duration=1200, speed=600, samples=8)
+
+        assert result['growth']['traced_kb'] > 512
+        assert any(failure.startswith('traced_kb grew') for failure in soak.check(result, {'traced_kb': 512}))
+
+    @pytest.mark.asyncio
+    async def test_record_and_replay(self, tmp_path):
+        """Test recorded readings are published again by a replay, which stops when the trace is done"""
+        import asyncio
+        from benchmark import LocalBroker
+
+        states = []
+        broker = LocalBroker(on_message=lambda topic, payload, received_at:
+                             topic.endswith('/state') and states.append(payload)).start()
+        config = {
+            'mqtt': {'broker': '127.0.0.1', 'port': broker.port},
+            'device': {'name': 'Test Sensor'},
+            'sensors': [{'type': 'simulated', 'update_interval': 0.05}],
+        }
+        trace = str(tmp_path / 'trace.bin')
+        try:
+            stop_event = asyncio.Event()
+            container = asyncio.create_task(sensor_container.run(config, stop_event=stop_event, record=trace))
+            await asyncio.sleep(0.5)
+            stop_event.set()
+            await container
+            recorded, states[:] = list(states), []
+
+            stats = await asyncio.wait_for(sensor_container.run(config, replay=trace, replay_speed=0,
+                                                                stop_event=asyncio.Event()), timeout=10)
+        finally:
+            broker.stop()
+
+        assert recorded and stats['dropped'] == 0
+        assert states[:len(recorded)] == recorded
+
+    @pytest.mark.asyncio
+    async def test_stops_when_a_task_ends(self, monkeypatch):
+        """Test the container stops with an error instead of running on without its scheduler"""
+        import asyncio
+        from benchmark import LocalBroker
+
+        async def crash(self, dispatch, housekeeping=None):
+            raise TypeError("Type is not JSON serializable")
+
+        monkeypatch.setattr(sensor_container.Scheduler, 'run', crash)
+        broker = LocalBroker().start()
+        config = {
+            'mqtt': {'broker': '127.0.0.1', 'port': broker.port},
+            'device': {'name': 'Test Sensor'},
+            'sensors': [{'type': 'simulated', 'update_interval': 0.05}],
+        }
+        try:
+            with pytest.raises(RuntimeError, match="The scheduler task ended") as raised:
+                await asyncio.wait_for(sensor_container.run(config, stop_event=asyncio.Event()), timeout=10)
+        finally:
+            broker.stop()
+
+        assert isinstance(raised.value.__cause__, TypeError)
+
+    @pytest.mark.asyncio
+    async def test_broker_fanout(self):
+        """Test fan-out publishes discovery and readings to every broker"""
+        import asyncio
+        from benchmark import LocalBroker
+
+        topics = [[], []]
+        brokers = [LocalBroker(on_message=lambda topic, payload, received_at, received=received:
+                               received.append(topic)).start() for received in topics]
+        config = {
+            'mqtt': {'broker': '127.0.0.1', 'port': brokers[0].port, 'mode': 'fanout',
+                     'brokers': [{'broker': '127.0.0.1', 'port': brokers[1].port}]},
+            'device': {'name': 'Test Sensor'},
+            'sensors': [{'type': 'simulated', 'update_interval': 0.05}],
+        }
+        try:
+            stop_event = asyncio.Event()
+            container = asyncio.create_task(sensor_container.run(config, stop_event=stop_event))
+            await asyncio.sleep(0.5)
+            stop_event.set()
+            await container
+        finally:
+            for broker in brokers:
+                broker.stop()
+
+        for received in topics:
+            assert 'homeassistant/sensor/test_sensor_simulated_temperature/config' in received
+            assert received.count('homeassistant/sensor/test_sensor/simulated_temperature/state') > 2
+
+    @pytest.mark.asyncio
+    async def test_broker_failover(self):
+        """Test the standby takes over when the active broker is lost and only then gets discovery"""
+        import asyncio
+        from benchmark import LocalBroker
+
+        topics = [[], []]
+        brokers = [LocalBroker(on_message=lambda topic, payload, received_at, received=received:
+                               received.append(topic)).start() for received in topics]
+        config = {
+            'mqtt': {'broker': '127.0.0.1', 'port': brokers[0].port,
+                     'brokers': [{'broker': '127.0.0.1', 'port': brokers[1].port}]},
+            'device': {'name': 'Test Sensor'},
+            'sensors': [{'type': 'simulated', 'update_interval': 0.05}],
+        }
+        config_topic = 'homeassistant/sensor/test_sensor_simulated_temperature/config'
+        state_topic = 'homeassistant/sensor/test_sensor/simulated_temperature/state'
+        try:
+            stop_event = asyncio.Event()
+            container = asyncio.create_task(sensor_container.run(config, stop_event=stop_event))
+            await asyncio.sleep(0.5)
+            standby_before = list(topics[1])
+            brokers[0].stop()
+            await asyncio.sleep(0.5)
+            stop_event.set()
+            await container
+        finally:
+            brokers[1].stop()
+
+        assert config_topic in topics[0] and state_topic in topics[0]
+        assert config_topic not in standby_before and state_topic not in standby_before
+        assert config_topic in topics[1]
+        assert topics[1].count(state_topic) > 2
+
+    @pytest.mark.asyncio
+    async def test_isolated_driver(self):
+        """Test readings of a driver in a worker process are published like any other"""
+        import asyncio
+        from benchmark import LocalBroker
+
+        states = []
+        broker = LocalBroker(on_message=lambda topic, payload, received_at:
+                             topic.endswith('/state') and states.append(topic)).start()
+        config = {
+            'mqtt': {'broker': '127.0.0.1', 'port': broker.port},
+            'device': {'name': 'Test Sensor'},
+            'sensors': [{'type': 'simulated', 'name': 'isolated', 'update_interval': 0.05, 'isolation': True},
+                        {'type': 'simulated', 'name': 'local', 'update_interval': 0.05}],
+        }
+        try:
+            stop_event = asyncio.Event()
+            container = asyncio.create_task(sensor_container.run(config, stop_event=stop_event))
+            await asyncio.sleep(1.0)
+            stop_event.set()
+            await container
+        finally:
+            broker.stop()
+
+        assert states.count('homeassistant/sensor/test_sensor/isolated_temperature/state') > 2
+        assert states.count('homeassistant/sensor/test_sensor/local_temperature/state') > 2
+
+    @pytest.mark.asyncio
+    async def test_sensor_bus(self, tmp_path):
+        """Test a local process reads the container's readings from the bus without the broker"""
+        import asyncio
+        from benchmark import LocalBroker
+        from bus import BusReader
+
+        broker = LocalBroker().start()
+        path = str(tmp_path / 'sensor.bus')
+        config = {
+            'mqtt': {'broker': '127.0.0.1', 'port': broker.port},
+            'device': {'name': 'Test Sensor'},
+            'sensors': [{'type': 'simulated', 'update_interval': 0.05}],
+            'bus': {'path': path},
+        }
+        try:
+            stop_event = asyncio.Event()
+            container = asyncio.create_task(sensor_container.run(config, stop_event=stop_event))
+            await asyncio.sleep(0.5)
+            with BusReader(path) as reader:
+                latest = reader.latest()
+                recent = reader.recent()
+            stop_event.set()
+            await container
+        finally:
+            broker.stop()
+
+        assert set(latest) == {'test_sensor/simulated'}
+        assert set(latest['test_sensor/simulated'].values) == {'temperature', 'humidity'}
+        assert len(recent) > 2 and recent[-1] == latest['test_sensor/simulated']
+
+    @pytest.mark.asyncio
+    async def test_config_reload_keeps_connection(self, tmp_path):
+        """Test a sensor added to config.yml is announced and read without reconnecting"""
+        import asyncio
+        import yaml
+        from benchmark import LocalBroker
+
+        topics = []
+        broker = LocalBroker(on_message=lambda topic, payload, received_at: topics.append(topic)).start()
+        config = {
+            'mqtt': {'broker': '127.0.0.1', 'port': broker.port, 'username': None, 'password': None},
+            'device': {'name': 'Test Sensor'},
+            'sensors': [{'type': 'simulated', 'name': 'first'}],
+            'reload_interval': 0.05,
+        }
+        path = tmp_path / 'config.yml'
+        path.write_text(yaml.safe_dump(config))
+        stop_event = asyncio.Event()
+        container = asyncio.create_task(sensor_container.run(config, stop_event=stop_event, config_path=str(path)))
+        try:
+            await asyncio.sleep(0.3)
+            config['sensors'].append({'type': 'simulated', 'name': 'second', 'update_interval': 0.1})
+            path.write_text(yaml.safe_dump(config))
+            for _ in range(100):
+                if 'homeassistant/sensor/test_sensor/second_temperature/state' in topics:
+                    break
+                await asyncio.sleep(0.05)
+        finally:
+            stop_event.set()
+            await container
+            broker.stop()
+
+        assert 'homeassistant/sensor/test_sensor_second_temperature/config' in topics
+        assert 'homeassistant/sensor/test_sensor/second_temperature/state' in topics
+        # Discovery of the unchanged sensor was only published once, on connect
+        assert topics.count('homeassistant/sensor/test_sensor_first_temperature/config') == 1
+
+    def test_filtered_readings(self, sample_config):
+        """Test readings inside the deadband are not published"""
+        mock_client = MockMQTTClient()
+        sample_config['sensors'] = [{'type': 'simulated', 'filter': {'deadband': 100, 'max_interval': 3600}}]
+        device = sensor_container.Device(parse_config(sample_config).devices[0], mock_client)
+
+        for _ in range(10):
+            device.on_result('simulated', device.drivers['simulated'].read())
+
+        assert len(mock_client.published_messages) == 2
+
+    def test_compact_state(self):
+        """Test compact mode publishes one JSON message per reading, referenced by discovery"""
+        mock_client = MockMQTTClient()
+        driver = sensor_container.create_driver({'type': 'simulated'})
+
+        sensor_container.publish_sensor_discovery(mock_client, 'Test Sensor', 'simulated', driver, compact=True)
+        on_result = sensor_container.make_result_handler(mock_client, 'Test Sensor', compact=True)
+        on_result('simulated', {'temperature': 21.5, 'humidity': 40.0})
+
+        discovery = [json.loads(msg['payload']) for msg in mock_client.published_messages[:2]]
+        state = mock_client.published_messages[2]
+        assert len(mock_client.published_messages) == 3
+        assert {config['state_topic'] for config in discovery} == {state['topic']}
+        assert state['topic'] == "homeassistant/sensor/test_sensor/simulated/state"
+        assert [config['value_template'] for config in discovery] == [
+            "{{ value_json.temperature }}", "{{ value_json.humidity }}"
+        ]
+        assert json.loads(state['payload']) == {'temperature': 21.5, 'humidity': 40.0}
+
+    def test_compact_state_with_filter(self):
+        """Test compact messages carry every measurement once any of them changed"""
+        mock_client = MockMQTTClient()
+        filters = {'simulated': sensor_container.SensorFilter({'deadband': 1})}
+        on_result = sensor_container.make_result_handler(mock_client, 'Test Sensor', filters, compact=True)
+
+        on_result('simulated', {'temperature': 21.0, 'humidity': 40.0})
+        on_result('simulated', {'temperature': 21.2, 'humidity': 40.2})
+        on_result('simulated', {'temperature': 21.3, 'humidity': 45.0})
+
+        payloads = [json.loads(msg['payload']) for msg in mock_client.published_messages]
+        assert payloads == [{'temperature': 21.0, 'humidity': 40.0}, {'temperature': 21.0, 'humidity': 45.0}]
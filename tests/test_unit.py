@@ -1,8 +1,36 @@
 import pytest
 import json
+import logging
 import yaml
 from unittest.mock import Mock, patch, MagicMock
+import asyncio
+import threading
+import time
+from decimal import Decimal
 import sensor_container
+import drivers
+from adaptive import AdaptiveInterval, LoadMonitor
+from brokers import BrokerLink, Failover, FanOut, QueueGroup
+from bus import BUSY, HEADER, SEQUENCE, BusReader, SensorBus
+from calibration import CalibratedDriver, Calibration, absolute_humidity, conversion, dew_point
+from config import (BrokerConfig, ConfigError, DiscoveryConfig, LoggingConfig, PublishConfig, SpoolConfig, parse_config,
+                    parse_device, parse_devices)
+from filters import MeasurementFilter, RingBuffer, SensorFilter
+from isolation import IsolatedDriver
+from logs import DroppingQueueHandler, JsonFormatter, RateLimitFilter, TextFormatter, setup_logging
+from metrics import Metrics, Registry
+from mqtt5 import PublishProperties, session_properties
+from discovery import DiscoveryCache, digest, fetch_retained
+from publisher import Message, PublishQueue
+from recording import RECORD, TraceWriter, read_trace, replay_trace
+from reload import ConfigWatcher
+from rollup import RollupWindow, SensorRollup
+from runtime import Backoff, MqttConnection
+from spool import HEADER_SIZE, Spool, StoreAndForward, add_timestamp
+from scheduler import Scheduler
+import serialization
+import soak
+from serialization import StateSerializer, StateTemplate
 
 
 class TestLoadConfig:
@@ -32,11 +60,119 @@ class TestLoadConfig:
             sensor_container.load_config(str(invalid_file))
 
 
+class TestParseConfig:
+    """Test validation of the configuration into a Config"""
+
+    def test_defaults(self, sample_config):
+        """Test options missing from the file get the documented defaults"""
+        del sample_config['mqtt']['port']
+        config = parse_config(sample_config, environ={})
+
+        assert config.mqtt.port == 1883
+        assert config.mqtt.client_id == 'Test Sensor_sensor_container'
+        assert config.publish == PublishConfig()
+        assert config.spool.path is None
+        assert config.metrics.port is None
+        assert config.logging.format == 'json'
+        assert config.reload_interval == 2.0
+        sensor = config.devices[0].sensors[0]
+        assert (sensor.name, sensor.update_interval) == ('dht11', 60)
+        assert sensor.options['GPIO_pin_RPI'] == 4
+
+    def test_sections_enable_features(self, sample_config):
+        """Test empty spool and metrics sections enable them with default settings"""
+        sample_config.update(spool={}, metrics={})
+        config = parse_config(sample_config, environ={})
+
+        assert config.spool.path == 'spool.bin'
+        assert config.metrics.port == 9100
+
+    def test_numbers_as_strings(self, sample_config):
+        """Test unquoted numbers are accepted where strings are expected"""
+        sample_config['mqtt'].update(username=1001, password=123456, protocol=5)
+        config = parse_config(sample_config, environ={})
+
+        assert (config.mqtt.username, config.mqtt.password, config.mqtt.protocol) == ('1001', '123456', '5')
+
+    @pytest.mark.parametrize('change, error', [
+        ({'mqtt': {'port': 1883}}, "mqtt.broker: required"),
+        ({'mqtt': {'broker': 'host', 'port': '1883'}}, "mqtt.port: expected int, got '1883'"),
+        ({'mqtt': {'broker': 'host', 'brokers': [{'port': 1884}]}}, r"mqtt.brokers\[0\].broker: required"),
+        ({'mqtt': {'broker': 'host', 'brokers': [{'broker': 'host'}]}}, r"mqtt.brokers\[0\]: duplicate broker"),
+        ({'mqtt': {'broker': 'host', 'mode': 'mirror'}}, "mqtt.mode: must be one of failover, fanout"),
+        ({'publish': {'policy': 'drop_newest'}}, "publish.policy: must be one of drop_oldest, coalesce"),
+        ({'publish': {'max_que': 10}}, "publish: unknown option max_que"),
+        ({'device': {}}, "device.name: required"),
+        ({'sensors': [{'type': 'dht11', 'update_interval': 0}]}, r"sensors\[0\].update_interval: must be positive"),
+        ({'sensors': [{'type': 'dht11', 'read_timeout': 0}]}, r"sensors\[0\].read_timeout: must be positive"),
+        ({'sensors': [{'type': 'dht11', 'filter': {'smoothing': 'mode'}}]}, r"sensors\[0\].filter.smoothing"),
+        ({'sensors': [{'type': 'dht11', 'rollup': {'aggregates': ['p95']}}]}, r"sensors\[0\].rollup.aggregates"),
+        ({'sensors': [{'type': 'dht11', 'calibration': {'temperature': {'unit': 'F'}}}]},
+         r"sensors\[0\].calibration.temperature.unit: must be one of"),
+        ({'sensors': [{'type': 'dht11', 'derived': ['heat_index']}]}, r"sensors\[0\].derived"),
+        ({'sensors': [{'type': 'dht11', 'adaptive': {'min_interval': 10, 'max_interval': 5}}]},
+         r"sensors\[0\].adaptive.max_interval: must be at least 10"),
+        ({'sensors': [{'type': 'dht11', 'isolation': {'cpu_time': 0}}]},
+         r"sensors\[0\].isolation.cpu_time: must be positive"),
+        ({'sampling': {'max_backoff': 0.5}}, "sampling.max_backoff: must be at least 1"),
+        ({'logging': {'level': 'LOUD'}}, "logging.level: must be one of"),
+        ({'read_workers': 0}, "read_workers: must be at least 1"),
+        ({'mqtt': {'broker': 'host', 'password': True}}, "mqtt.password: expected str, got True"),
+    ])
+    def test_errors_name_the_option(self, sample_config, change, error):
+        """Test invalid options are reported with their path"""
+        sample_config.update(change)
+
+        with pytest.raises(ConfigError, match=error):
+            parse_config(sample_config, environ={})
+
+    def test_bus(self, sample_config):
+        """Test an empty bus section enables the bus in shared memory"""
+        assert parse_config(sample_config, environ={}).bus.path is None
+        sample_config['bus'] = None
+
+        assert parse_config(sample_config, environ={}).bus.path == '/dev/shm/sensor_container.bus'
+
+    def test_brokers(self, sample_config):
+        """Test further brokers use the mqtt credentials unless they have their own"""
+        sample_config['mqtt'].update(mode='fanout', brokers=[{'broker': 'historian', 'port': 1884},
+                                                             {'broker': 'cloud', 'username': 'node'}])
+        config = parse_config(sample_config, environ={})
+
+        assert config.mqtt.mode == 'fanout'
+        assert config.mqtt.brokers == (BrokerConfig('historian', 1884, 'test_user', 'test_pass'),
+                                       BrokerConfig('cloud', 1883, 'node', 'test_pass'))
+
+    def test_environment_overrides(self, sample_config):
+        """Test SENSOR_CONTAINER_ variables override the file with typed values"""
+        environ = {
+            'SENSOR_CONTAINER_MQTT__PASSWORD': '1234',
+            'SENSOR_CONTAINER_MQTT__PORT': '8883',
+            'SENSOR_CONTAINER_DISCOVERY__VERIFY_RETAINED': 'false',
+            'SENSOR_CONTAINER_RELOAD_INTERVAL': '0',
+            'OTHER': 'ignored',
+        }
+        config = parse_config(sample_config, environ=environ)
+
+        assert config.mqtt.password == '1234'
+        assert config.mqtt.port == 8883
+        assert config.mqtt.username == 'test_user'
+        assert config.discovery.verify_retained is False
+        assert config.reload_interval == 0
+        assert sample_config['mqtt']['password'] == 'test_pass'
+
+    def test_invalid_environment_override(self, sample_config):
+        """Test overrides are validated like the file"""
+        with pytest.raises(ConfigError, match="mqtt.port: expected int, got 'tls'"):
+            parse_config(sample_config, environ={'SENSOR_CONTAINER_MQTT__PORT': 'tls'})
+
+
 class TestOnConnect:
     """Test the on_connect callback function"""
 
-    def test_on_connect_success(self, capsys):
+    def test_on_connect_success(self, caplog):
         """Test successful connection callback"""
+        caplog.set_level(logging.INFO)
         mock_client = Mock()
         mock_userdata = None
         mock_flags = {}
@@ -44,10 +180,9 @@ class TestOnConnect:
 
         sensor_container.on_connect(mock_client, mock_userdata, mock_flags, rc)
 
-        captured = capsys.readouterr()
-        assert "Connected to MQTT Broker successfully!" in captured.out
+        assert "Connected to MQTT Broker successfully!" in caplog.text
 
-    def test_on_connect_failure(self, capsys):
+    def test_on_connect_failure(self, caplog):
         """Test failed connection callback"""
         mock_client = Mock()
         mock_userdata = None
@@ -56,8 +191,7 @@ class TestOnConnect:
 
         sensor_container.on_connect(mock_client, mock_userdata, mock_flags, rc)
 
-        captured = capsys.readouterr()
-        assert "Failed to connect, return code 5" in captured.out
+        assert "Failed to connect, return code 5" in caplog.text
 
 
 class TestPublishDiscoveryConfig:
@@ -121,8 +255,23 @@ class TestPublishDiscoveryConfig:
         assert device['name'] == "Test Device"
         assert device['model'] == "humidity Sensor"
         assert device['manufacturer'] == "Custom"
-        assert device['unit_of_measurement'] == "%"
-        assert device['device_class'] == "humidity"
+        assert 'unit_of_measurement' not in device
+        assert 'device_class' not in device
+        # Unit and device class belong to the entity
+        assert payload['unit_of_measurement'] == "%"
+        assert payload['device_class'] == "humidity"
+
+    def test_publish_discovery_config_availability(self):
+        """Test the availability topic is announced only when given"""
+        mock_client = Mock()
+        mock_client.publish.return_value = (0, 1)
+
+        sensor_container.publish_discovery_config(mock_client, "Test Device", "humidity")
+        assert 'availability_topic' not in json.loads(mock_client.publish.call_args[0][1])
+
+        sensor_container.publish_discovery_config(mock_client, "Test Device", "humidity",
+                                                  availability_topic="node/availability")
+        assert json.loads(mock_client.publish.call_args[0][1])['availability_topic'] == "node/availability"
 
     def test_publish_discovery_config_device_id_formatting(self):
         """Test device ID formatting (lowercase, spaces to underscores)"""
@@ -144,7 +293,7 @@ class TestPublishDiscoveryConfig:
         # Verify device_id is lowercase with underscores
         assert "my_test_device" in topic
 
-    def test_publish_discovery_config_failure(self, capsys):
+    def test_publish_discovery_config_failure(self, caplog):
         """Test publishing failure handling"""
         mock_client = Mock()
         mock_client.publish.return_value = (1, 1)  # Failure
@@ -155,11 +304,11 @@ class TestPublishDiscoveryConfig:
             "temperature"
         )
 
-        captured = capsys.readouterr()
-        assert "Failed to publish discovery config" in captured.out
+        assert "Failed to publish discovery config" in caplog.text
 
-    def test_publish_discovery_config_success_message(self, capsys):
+    def test_publish_discovery_config_success_message(self, caplog):
         """Test success message on publish"""
+        caplog.set_level(logging.INFO)
         mock_client = Mock()
         mock_client.publish.return_value = (0, 1)  # Success
 
@@ -169,8 +318,7 @@ class TestPublishDiscoveryConfig:
             "humidity"
         )
 
-        captured = capsys.readouterr()
-        assert "Published discovery config for humidity" in captured.out
+        assert "Published discovery config for humidity" in caplog.text
 
     def test_publish_discovery_config_different_sensor_types(self):
         """Test publishing configs for different sensor types"""
@@ -204,3 +352,2250 @@ class TestPublishDiscoveryConfig:
         humidity_call = mock_client.publish.call_args_list[1]
         humidity_payload = json.loads(humidity_call[0][1])
         assert "Humidity" in humidity_payload['name']
+
+
+class FakeClock:
+    """Manually advanced monotonic clock"""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestScheduler:
+    """Test the interval scheduler"""
+
+    def test_jobs_run_on_their_own_interval(self):
+        """Test each job is due on its own interval"""
+        clock = FakeClock()
+        scheduler = Scheduler(clock=clock)
+        scheduler.add('fast', 1, 'fast_job')
+        scheduler.add('slow', 3, 'slow_job')
+
+        runs = []
+        for step in range(7):
+            clock.now = float(step)
+            runs.append(sorted(name for name, _ in scheduler.pop_due()))
+
+        assert runs == [
+            ['fast', 'slow'], ['fast'], ['fast'], ['fast', 'slow'],
+            ['fast'], ['fast'], ['fast', 'slow']
+        ]
+
+    def test_schedule_does_not_drift(self):
+        """Test late runs do not shift later due times"""
+        clock = FakeClock()
+        scheduler = Scheduler(clock=clock)
+        scheduler.add('sensor', 10, 'job')
+
+        scheduler.pop_due()
+        clock.now = 10.4  # ran late
+        assert scheduler.pop_due() == [('sensor', 'job')]
+        assert scheduler.time_until_next() == pytest.approx(9.6)
+
+    def test_missed_intervals_are_skipped(self):
+        """Test a job that fell far behind runs once, not once per missed slot"""
+        clock = FakeClock()
+        scheduler = Scheduler(clock=clock)
+        scheduler.add('sensor', 1, 'job')
+
+        scheduler.pop_due()
+        clock.now = 5.5
+        assert len(scheduler.pop_due()) == 1
+        assert scheduler.pop_due() == []
+        assert scheduler.time_until_next() == pytest.approx(0.5)
+
+    def test_jobs_within_one_tick_are_coalesced(self):
+        """Test jobs due within the same tick are returned as one batch"""
+        clock = FakeClock()
+        scheduler = Scheduler(tick=0.1, clock=clock)
+        scheduler.add('a', 5, 'job_a', delay=1.0)
+        scheduler.add('b', 5, 'job_b', delay=1.05)
+        scheduler.add('c', 5, 'job_c', delay=2.0)
+
+        clock.now = 1.0
+        assert sorted(name for name, _ in scheduler.pop_due()) == ['a', 'b']
+
+    def test_set_interval_and_scale(self):
+        """Test a changed interval moves the next run, scale stretches every interval"""
+        clock = FakeClock()
+        scheduler = Scheduler(clock=clock)
+        scheduler.add('sensor', 10, 'job')
+        scheduler.pop_due()
+
+        scheduler.set_interval('sensor', 4)
+        assert scheduler.time_until_next() == pytest.approx(4)
+        scheduler.scale = 2
+        clock.now = 4
+        assert scheduler.pop_due() == [('sensor', 'job')]
+        assert scheduler.time_until_next() == pytest.approx(8)
+
+    def test_remove_job(self):
+        """Test removed jobs are no longer returned"""
+        clock = FakeClock()
+        scheduler = Scheduler(clock=clock)
+        scheduler.add('sensor', 1, 'job')
+
+        assert scheduler.remove('sensor') is True
+        assert scheduler.remove('sensor') is False
+        assert 'sensor' not in scheduler
+        assert scheduler.pop_due() == []
+        assert scheduler.time_until_next() is None
+
+    def test_invalid_interval(self):
+        """Test non-positive intervals are rejected"""
+        with pytest.raises(ValueError):
+            Scheduler().add('sensor', 0, 'job')
+
+
+class TestEnabledSensors:
+    """Test sensor selection from the configuration"""
+
+    def test_disabled_sensors_are_skipped(self, sample_config):
+        """Test only enabled sensors are returned"""
+        sample_config['sensors'].append({'type': 'dht22', 'enabled': False})
+
+        sensors = parse_config(sample_config, environ={}).devices[0].sensors
+
+        assert [sensor.name for sensor in sensors] == ['dht11']
+
+    def test_duplicate_names_are_rejected(self, sample_config):
+        """Test two sensors of the same type need explicit names"""
+        sample_config['sensors'].append({'type': 'dht11'})
+
+        with pytest.raises(ConfigError, match=r"sensors\[1\]: duplicate sensor name 'dht11'"):
+            parse_config(sample_config, environ={})
+
+    def test_explicit_names(self, sample_config):
+        """Test an explicit name overrides the type"""
+        sample_config['sensors'].append({'type': 'dht11', 'name': 'outdoor'})
+
+        sensors = parse_config(sample_config, environ={}).devices[0].sensors
+
+        assert [sensor.name for sensor in sensors] == ['dht11', 'outdoor']
+
+
+class TestLoadDevices:
+    """Test device selection from the configuration"""
+
+    def test_single_device(self, sample_config):
+        """Test the device: and sensors: form is one device"""
+        devices = parse_devices(sample_config)
+
+        assert len(devices) == 1
+        assert devices[0].name == sample_config['device']['name']
+        assert devices[0].id == 'test_sensor'
+        assert [sensor.options for sensor in devices[0].sensors] == sample_config['sensors']
+
+    def test_devices_list(self):
+        """Test a devices: list is used as is"""
+        config = {'devices': [{'name': 'Living Room', 'sensors': []}, {'name': 'Kitchen', 'sensors': []}]}
+
+        assert [device.name for device in parse_devices(config)] == ['Living Room', 'Kitchen']
+
+    def test_duplicate_devices_are_rejected(self):
+        """Test two devices mapping to the same id are rejected"""
+        config = {'devices': [{'name': 'Kitchen'}, {'name': 'kitchen'}]}
+
+        with pytest.raises(ConfigError, match="duplicate device"):
+            parse_devices(config)
+
+    def test_routes_results_to_owning_device(self):
+        """Test readings of equally named sensors reach their own device"""
+        client = RecordingClient()
+        fleet = sensor_container.Fleet(client, Scheduler())
+        for name in ('Living Room', 'Kitchen'):
+            fleet.add_device(sensor_container.Device(parse_device({'name': name, 'sensors': [{'type': 'simulated'}]}),
+                                                     client))
+
+        fleet.on_result('kitchen/simulated', {'temperature': 20.0})
+
+        assert [topic for topic, _ in client.published] == ['homeassistant/sensor/kitchen/simulated_temperature/state']
+
+
+def simulated_device(name='Kitchen', **options):
+    sensors = options.pop('sensors', [{'type': 'simulated', 'name': 'a'}, {'type': 'simulated', 'name': 'b'}])
+    return parse_device(dict({'name': name, 'sensors': sensors}, **options))
+
+
+class TestFleetUpdate:
+    """Test applying configuration changes while running"""
+
+    def make_fleet(self, *devices):
+        client = RecordingClient()
+        fleet = sensor_container.Fleet(client, Scheduler(clock=FakeClock()))
+        for device in devices:
+            fleet.add_device(sensor_container.Device(device, client))
+        return fleet
+
+    def test_rollup_replaces_raw_entities(self):
+        """Test a rollup without raw readings announces its aggregates and clears the raw entities"""
+        fleet = self.make_fleet(simulated_device())
+        queue = PublishQueue(max_inflight=0)
+        sensors = [{'type': 'simulated', 'name': 'a', 'rollup': {'aggregates': ['mean'], 'raw': False}},
+                   {'type': 'simulated', 'name': 'b'}]
+
+        summary = fleet.update([simulated_device(sensors=sensors)], queue)
+
+        assert summary == {'added': 0, 'removed': 0, 'changed': 1}
+        client = RecordingClient()
+        queue.flush(client)
+        published = dict(client.published)
+        assert published['homeassistant/sensor/kitchen_a_temperature/config'] == b''
+        assert json.loads(published['homeassistant/sensor/kitchen_a_temperature_mean/config'])['state_topic'] == \
+            'homeassistant/sensor/kitchen/a_temperature_mean/state'
+
+    def test_changes_published_to_every_target(self):
+        """Test with several brokers every broker's queue gets the discovery changes"""
+        fleet = self.make_fleet(simulated_device())
+        queues = [PublishQueue(), PublishQueue()]
+        sensors = [{'type': 'simulated', 'name': 'a'}, {'type': 'simulated', 'name': 'c'}]
+
+        fleet.update([simulated_device(sensors=sensors)], queues[0], targets=[(queue, None) for queue in queues])
+
+        assert queues[0].depth == queues[1].depth > 0
+
+    def test_standby_caches_forget_changes(self, tmp_path):
+        """Test failover standbys forget changed configs, so they get them once they become active"""
+        fleet = self.make_fleet(simulated_device())
+        caches = [DiscoveryCache(str(tmp_path / 'active.json')), DiscoveryCache(str(tmp_path / 'standby.json'))]
+        device = fleet.devices['kitchen']
+        for cache in caches:
+            for name, driver in device.drivers.items():
+                sensor_container.publish_sensor_discovery(RecordingClient(), device.name, name, driver, cache=cache)
+        sensors = [{'type': 'simulated', 'name': 'a', 'seed': 7}, {'type': 'simulated', 'name': 'c'}]
+
+        fleet.update([simulated_device(sensors=sensors)], PublishQueue(), cache=caches[0], standby_caches=caches[1:])
+
+        active, standby = ({topic.split('/')[2] for topic in cache.hashes} for cache in caches)
+        assert active == {'kitchen_a_temperature', 'kitchen_a_humidity', 'kitchen_c_temperature', 'kitchen_c_humidity'}
+        assert standby == set()
+
+    def test_unchanged_config(self):
+        """Test an identical configuration changes nothing"""
+        fleet = self.make_fleet(simulated_device())
+        drivers_before = dict(fleet.drivers)
+        queue = PublishQueue()
+
+        summary = fleet.update([simulated_device()], queue)
+
+        assert summary == {'added': 0, 'removed': 0, 'changed': 0}
+        assert fleet.drivers == drivers_before
+        assert queue.depth == 0
+
+    def test_add_and_remove_sensors(self):
+        """Test only added sensors are announced and removed sensors have their discovery cleared"""
+        fleet = self.make_fleet(simulated_device())
+        queue = PublishQueue(max_inflight=0)
+        sensors = [{'type': 'simulated', 'name': 'a'}, {'type': 'simulated', 'name': 'c'}]
+
+        summary = fleet.update([simulated_device(sensors=sensors)], queue)
+
+        assert summary == {'added': 1, 'removed': 1, 'changed': 0}
+        assert set(fleet.drivers) == {'kitchen/a', 'kitchen/c'}
+        assert 'kitchen/b' not in fleet.scheduler
+        client = RecordingClient()
+        queue.flush(client)
+        published = dict(client.published)
+        assert published['homeassistant/sensor/kitchen_b_temperature/config'] == b''
+        assert published['homeassistant/sensor/kitchen_c_temperature/config']
+        assert 'homeassistant/sensor/kitchen_a_temperature/config' not in published
+
+    def test_interval_change_keeps_driver(self):
+        """Test a changed update_interval only reschedules the sensor"""
+        fleet = self.make_fleet(simulated_device())
+        driver = fleet.drivers['kitchen/a']
+        queue = PublishQueue()
+        sensors = [{'type': 'simulated', 'name': 'a', 'update_interval': 5}, {'type': 'simulated', 'name': 'b'}]
+
+        summary = fleet.update([simulated_device(sensors=sensors)], queue)
+
+        assert summary == {'added': 0, 'removed': 0, 'changed': 1}
+        assert fleet.drivers['kitchen/a'] is driver
+        assert fleet.devices['kitchen'].sensors['a'].update_interval == 5
+        assert queue.depth == 0
+
+    def test_interval_change_moves_adaptive_bounds(self):
+        """Test adaptive bounds derived from update_interval follow a changed interval"""
+        sensors = [{'type': 'simulated', 'name': 'a', 'update_interval': 10, 'adaptive': {'threshold': 1}}]
+        fleet = self.make_fleet(simulated_device(sensors=sensors))
+        sensors = [{'type': 'simulated', 'name': 'a', 'update_interval': 200, 'adaptive': {'threshold': 1}}]
+
+        fleet.update([simulated_device(sensors=sensors)], PublishQueue())
+
+        adaptive = fleet.devices['kitchen'].adaptive['a']
+        assert (adaptive.min_interval, adaptive.max_interval, adaptive.interval) == (200, 2000, 200)
+
+    def test_option_change_replaces_driver(self):
+        """Test any other sensor change creates a new driver"""
+        fleet = self.make_fleet(simulated_device())
+        driver = fleet.drivers['kitchen/a']
+        sensors = [{'type': 'simulated', 'name': 'a', 'seed': 7}, {'type': 'simulated', 'name': 'b'}]
+
+        summary = fleet.update([simulated_device(sensors=sensors)], PublishQueue())
+
+        assert summary == {'added': 0, 'removed': 0, 'changed': 1}
+        assert fleet.drivers['kitchen/a'] is not driver
+
+    def test_device_changes(self):
+        """Test devices are added, removed and replaced when their settings change"""
+        fleet = self.make_fleet(simulated_device('Kitchen'), simulated_device('Hall'))
+        queue = PublishQueue(max_inflight=0)
+
+        summary = fleet.update([simulated_device('Kitchen', compact_state=True), simulated_device('Attic')], queue)
+
+        assert summary == {'added': 2, 'removed': 2, 'changed': 2}
+        assert set(fleet.devices) == {'kitchen', 'attic'}
+        assert fleet.devices['kitchen'].compact
+        client = RecordingClient()
+        queue.flush(client)
+        published = dict(client.published)
+        assert published['homeassistant/sensor/hall_a_temperature/config'] == b''
+        # Replaced sensors keep their entities, their configs are updated rather than cleared
+        assert b'value_template' in published['homeassistant/sensor/kitchen_a_temperature/config']
+
+    def test_invalid_config_changes_nothing(self):
+        """Test an invalid configuration is rejected before anything is changed"""
+        fleet = self.make_fleet(simulated_device())
+        drivers_before = dict(fleet.drivers)
+        sensors = [{'type': 'simulated', 'name': 'c'}, {'type': 'nope', 'name': 'd'}]
+
+        with pytest.raises(ValueError, match="Unknown sensor type"):
+            fleet.update([simulated_device(sensors=sensors)], PublishQueue())
+
+        assert fleet.drivers == drivers_before
+
+    def test_removed_sensor_results_are_dropped(self):
+        """Test a reading finishing after its sensor was removed is not published"""
+        fleet = self.make_fleet(simulated_device())
+        fleet.update([simulated_device(sensors=[{'type': 'simulated', 'name': 'a'}])], PublishQueue())
+
+        fleet.on_result('kitchen/b', {'temperature': 20.0})
+
+        assert fleet.client.published == []
+
+
+class TestConfigWatcher:
+    """Test reloading the configuration file"""
+
+    def test_detects_changes(self, tmp_path):
+        """Test a modified file is loaded and applied"""
+        path = tmp_path / 'config.yml'
+        path.write_text('a: 1\n')
+        applied = []
+        watcher = ConfigWatcher(str(path), sensor_container.load_config, applied.append)
+
+        assert watcher.changed() is False
+        path.write_text('a: 22\n')
+        assert watcher.changed() is True
+        assert watcher.reload() is True
+        assert applied == [{'a': 22}]
+
+    def test_errors_keep_running_config(self, tmp_path, caplog):
+        """Test unreadable files and rejected configurations are logged"""
+        path = tmp_path / 'config.yml'
+        path.write_text('a: [\n')
+
+        def reject(config):
+            raise ValueError("bad")
+
+        watcher = ConfigWatcher(str(path), sensor_container.load_config, reject)
+        assert watcher.reload() is False
+        path.write_text('a: 1\n')
+        assert watcher.reload() is False
+        assert "keeping the current configuration: bad" in caplog.text
+
+    def test_invalid_driver_options(self, tmp_path, caplog):
+        """Test driver options the driver rejects with any error keep the running configuration"""
+        path = tmp_path / 'config.yml'
+        path.write_text("sensors: [{type: simulated, read_delay: fast}]\n")
+
+        def apply(raw):
+            drivers.create_driver(raw['sensors'][0]).read()
+
+        watcher = ConfigWatcher(str(path), sensor_container.load_config, apply)
+        assert watcher.reload() is False
+        assert "Failed to apply" in caplog.text
+
+    @pytest.mark.asyncio
+    async def test_reload_on_request(self, tmp_path):
+        """Test request() (the SIGHUP handler) reloads an unchanged file"""
+        path = tmp_path / 'config.yml'
+        path.write_text('a: 1\n')
+        applied = []
+        watcher = ConfigWatcher(str(path), sensor_container.load_config, applied.append, interval=0)
+        task = asyncio.create_task(watcher.run())
+        await asyncio.sleep(0)
+        watcher.request()
+        for _ in range(100):
+            if applied:
+                break
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+        assert applied == [{'a': 1}]
+
+
+class TestDriverRegistry:
+    """Test sensor driver lookup"""
+
+    def test_builtin_drivers(self):
+        """Test built-in sensor types are registered"""
+        assert isinstance(drivers.create_driver({'type': 'dht11'}), drivers.DHT11Driver)
+        assert isinstance(drivers.create_driver({'type': 'dht22'}), drivers.DHT22Driver)
+        assert isinstance(drivers.create_driver({'type': 'simulated'}), drivers.SimulatedDriver)
+
+    def test_unknown_type(self):
+        """Test an unknown sensor type raises a helpful error"""
+        with pytest.raises(ValueError, match="Unknown sensor type 'nope'"):
+            drivers.create_driver({'type': 'nope'})
+
+    def test_entry_point_drivers(self, monkeypatch):
+        """Test drivers are loaded from installed entry points"""
+        class ThirdPartyDriver(drivers.SensorDriver):
+            pass
+
+        entry_point = Mock()
+        entry_point.name = 'third_party'
+        entry_point.load.return_value = ThirdPartyDriver
+        monkeypatch.setattr(drivers, 'entry_points', lambda group: [entry_point])
+        monkeypatch.setattr(drivers, '_entry_points_loaded', False)
+        monkeypatch.setattr(drivers, 'DRIVERS', dict(drivers.DRIVERS))
+
+        driver = drivers.create_driver({'type': 'third_party'})
+
+        assert isinstance(driver, ThirdPartyDriver)
+
+    def test_read_timeout_override(self):
+        """Test the per-sensor read_timeout overrides the driver default"""
+        assert drivers.create_driver({'type': 'dht22'}).timeout == 10.0
+        assert drivers.create_driver({'type': 'dht22', 'read_timeout': 3}).timeout == 3
+
+
+class TestSimulatedDriver:
+    """Test the simulated sensor driver"""
+
+    def test_readings_are_deterministic(self):
+        """Test the same seed produces the same readings"""
+        first = drivers.SimulatedDriver({'type': 'simulated', 'seed': 7})
+        second = drivers.SimulatedDriver({'type': 'simulated', 'seed': 7})
+
+        assert [first.read() for _ in range(5)] == [second.read() for _ in range(5)]
+
+    def test_reading_contains_measurements(self):
+        """Test a reading has a value for every declared measurement"""
+        driver = drivers.SimulatedDriver({'type': 'simulated'})
+
+        assert set(driver.read()) == {m for m, _, _ in driver.measurements}
+
+
+class TestDHTDriver:
+    """Test DHT retry handling without GPIO hardware"""
+
+    def test_retries_failed_reads(self, monkeypatch):
+        """Test checksum errors are retried until a reading succeeds"""
+        device = Mock()
+        type(device).temperature = property(Mock(side_effect=[RuntimeError("Checksum did not validate"), 22.0]))
+        device.humidity = 40.0
+        driver = drivers.DHT11Driver({'type': 'dht11'})
+        monkeypatch.setattr(driver, '_open', lambda: device)
+        monkeypatch.setattr(drivers.time, 'sleep', lambda seconds: None)
+
+        assert driver.read() == {'temperature': 22.0, 'humidity': 40.0}
+        assert driver.retries == 1
+
+    def test_gives_up_within_timeout(self, monkeypatch):
+        """Test the last error is raised once the timeout is used up"""
+        device = Mock()
+        type(device).temperature = property(Mock(side_effect=RuntimeError("Timed out")))
+        driver = drivers.DHT11Driver({'type': 'dht11', 'read_timeout': 0})
+        monkeypatch.setattr(driver, '_open', lambda: device)
+
+        with pytest.raises(RuntimeError, match="Timed out"):
+            driver.read()
+
+
+class BlockingDriver(drivers.SensorDriver):
+    """Driver whose reads block until released"""
+
+    def __init__(self, timeout=5.0):
+        super().__init__({'read_timeout': timeout})
+        self.release = threading.Event()
+
+    def read(self):
+        self.release.wait(5)
+        return {'value': 1}
+
+
+class TestIsolatedDriver:
+    """Test drivers running in worker processes"""
+
+    def test_reads_in_worker(self):
+        """Test an isolated driver returns the readings of the driver in its worker process"""
+        import os
+        sensor = {'type': 'simulated', 'seed': 3, 'derived': ['dew_point']}
+        driver = drivers.create_driver({**sensor, 'isolation': True})
+        reference = drivers.create_driver(sensor)
+        try:
+            assert isinstance(driver, IsolatedDriver) and driver.blocking
+            assert driver.pid != os.getpid()
+            assert [measurement[0] for measurement in driver.measurements] == ['temperature', 'humidity', 'dew_point']
+            assert [driver.read(), driver.read()] == [reference.read(), reference.read()]
+        finally:
+            driver.close()
+
+    def test_crashed_worker_restarts(self, caplog):
+        """Test a worker that died is restarted after the backoff delay"""
+        import os
+        import signal
+        driver = drivers.create_driver({'type': 'simulated', 'isolation': {'restart_delay': 0.2}})
+        try:
+            driver.read()
+            os.kill(driver.pid, signal.SIGKILL)
+
+            with pytest.raises(RuntimeError, match="was killed by SIGKILL"):
+                driver.read()
+            with pytest.raises(RuntimeError, match="is restarting"):
+                driver.read()
+            time.sleep(0.2)
+            assert set(driver.read()) == {'temperature', 'humidity'}
+            assert driver.restarts == 1
+            assert "Worker of simulated was killed by SIGKILL, restarting it" in caplog.text
+        finally:
+            driver.close()
+
+    def test_hung_read_is_killed(self):
+        """Test a read exceeding the timeout kills its worker instead of leaving it hanging"""
+        driver = drivers.create_driver({'type': 'simulated', 'read_delay': 10, 'read_timeout': 0.5,
+                                        'isolation': {'restart_delay': 0.1}})
+        try:
+            start = time.monotonic()
+            with pytest.raises(TimeoutError, match="its worker was killed"):
+                driver.read()
+
+            assert time.monotonic() - start < 2
+            assert driver.pid is None
+        finally:
+            driver.close()
+
+    def test_errors_are_passed_on(self):
+        """Test an exception raised by the driver in the worker is raised by read()"""
+        # A period of 0 makes the simulated driver divide by zero
+        driver = drivers.create_driver({'type': 'simulated', 'period': 0, 'isolation': True})
+        try:
+            with pytest.raises(ZeroDivisionError):
+                driver.read()
+            assert driver.restarts == 0
+        finally:
+            driver.close()
+
+
+class TestReadPipeline:
+    """Test the threaded read pipeline"""
+
+    def test_results_and_errors(self):
+        """Test results and exceptions reach their callbacks"""
+        results, errors = {}, {}
+        done = threading.Event()
+
+        class FailingDriver(drivers.SensorDriver):
+            def read(self):
+                raise RuntimeError("broken")
+
+        def on_error(name, error):
+            errors[name] = error
+            done.set()
+
+        pipeline = drivers.ReadPipeline(results.__setitem__, on_error, max_workers=1)
+        pipeline([('ok', drivers.SimulatedDriver({})), ('bad', FailingDriver({}))])
+
+        assert done.wait(1)
+        pipeline.shutdown()
+        assert 'temperature' in results['ok']
+        assert str(errors['bad']) == "broken"
+
+    def test_busy_sensor_is_skipped(self, caplog):
+        """Test a sensor still being read is not read a second time"""
+        pipeline = drivers.ReadPipeline(Mock(), Mock(), max_workers=2)
+        driver = BlockingDriver()
+
+        assert pipeline.submit('slow', driver) is True
+        assert pipeline.submit('slow', driver) is False
+        driver.release.set()
+        pipeline.shutdown()
+
+        assert "slow is still being read" in caplog.text
+
+    def test_slow_read_does_not_block_others(self):
+        """Test other sensors are read while one read hangs"""
+        done = threading.Event()
+        pipeline = drivers.ReadPipeline(lambda name, values: done.set(), Mock(), max_workers=2)
+        slow = BlockingDriver()
+
+        pipeline([('slow', slow), ('fast', drivers.SimulatedDriver({}))])
+
+        assert done.wait(1)
+        slow.release.set()
+        pipeline.shutdown()
+
+    def test_timeout_is_reported_once(self):
+        """Test a hung read is reported as a timeout and its late result dropped"""
+        clock = FakeClock()
+        on_result, on_error = Mock(), Mock()
+        pipeline = drivers.ReadPipeline(on_result, on_error, max_workers=1, clock=clock)
+        driver = BlockingDriver(timeout=2)
+
+        pipeline.submit('hung', driver)
+        clock.now = 1.0
+        pipeline.check_timeouts()
+        assert not on_error.called
+
+        clock.now = 2.0
+        pipeline.check_timeouts()
+        pipeline.check_timeouts()
+        assert on_error.call_count == 1
+        assert isinstance(on_error.call_args[0][1], TimeoutError)
+        assert 'hung' in pipeline.busy()
+
+        driver.release.set()
+        deadline = time.monotonic() + 1
+        while pipeline.busy() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        pipeline.shutdown()
+        assert not on_result.called
+        assert pipeline.busy() == set()
+
+    def test_metrics(self):
+        """Test read durations and failures are recorded per sensor"""
+        class FailingDriver(drivers.SensorDriver):
+            blocking = False
+
+            def read(self):
+                raise RuntimeError("broken")
+
+        metrics = Metrics()
+        pipeline = drivers.ReadPipeline(Mock(), Mock(), clock=FakeClock(), metrics=metrics)
+        pipeline([('ok', drivers.SimulatedDriver({})), ('bad', FailingDriver({}))])
+        pipeline.shutdown()
+
+        assert metrics.read_duration.labels('ok').count == 1
+        assert metrics.read_failures.labels('bad', 'error').value == 1
+
+    def test_handler_errors_are_reported(self):
+        """Test a reading the result handler cannot publish is reported instead of raised into the scheduler"""
+        class DecimalDriver(drivers.SensorDriver):
+            blocking = False
+
+            def read(self):
+                return {'temperature': Decimal('21.5')}
+
+        on_error = Mock()
+        on_result = sensor_container.make_result_handler(RecordingClient(), 'Test Sensor', compact=True)
+        pipeline = drivers.ReadPipeline(on_result, on_error)
+
+        assert pipeline.submit('decimal', DecimalDriver({})) is True
+        pipeline.shutdown()
+        assert isinstance(on_error.call_args[0][1], TypeError)
+
+    def test_resize(self):
+        """Test a resized pool reads on the new pool while running reads finish on the old one"""
+        done = threading.Event()
+        results = {}
+
+        def on_result(name, values):
+            results[name] = values
+            if len(results) == 2:
+                done.set()
+
+        pipeline = drivers.ReadPipeline(on_result, Mock(), max_workers=1)
+        slow = BlockingDriver()
+        pipeline.submit('slow', slow)
+
+        pipeline.resize(2)
+        pipeline.resize(2)
+        pipeline.submit('fast', drivers.SimulatedDriver({}))
+        assert pipeline.max_workers == 2
+        # The old pool's only worker is still busy, the read ran on the new pool
+        deadline = time.monotonic() + 1
+        while 'fast' not in results and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert 'fast' in results
+
+        slow.release.set()
+        assert done.wait(1)
+        pipeline.shutdown()
+
+
+class RecordingClient:
+    """Minimal client recording publishes, optionally refusing them"""
+
+    def __init__(self, result_code=0):
+        self.result_code = result_code
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if self.result_code == 0:
+            self.published.append((topic, payload))
+        return (self.result_code, len(self.published))
+
+
+class TestPublishQueue:
+    """Test the batched publish queue"""
+
+    def test_drop_oldest_policy(self):
+        """Test the oldest message is dropped when the queue is full"""
+        queue = PublishQueue(max_size=2)
+        for value in range(3):
+            queue.publish('topic', str(value))
+
+        client = RecordingClient()
+        queue.flush(client)
+
+        assert client.published == [('topic', '1'), ('topic', '2')]
+        assert queue.dropped == 1
+
+    def test_coalesce_policy(self):
+        """Test only the latest message per topic is kept"""
+        queue = PublishQueue(policy='coalesce')
+        queue.publish('a', '1')
+        queue.publish('b', '1')
+        queue.publish('a', '2')
+
+        assert queue.depth == 2
+        client = RecordingClient()
+        queue.flush(client)
+
+        assert client.published == [('b', '1'), ('a', '2')]
+
+    def test_coalesce_drops_oldest_topic_when_full(self):
+        """Test coalescing still bounds the number of topics"""
+        queue = PublishQueue(policy='coalesce', max_size=2)
+        for topic in 'abc':
+            queue.publish(topic, '1')
+
+        client = RecordingClient()
+        queue.flush(client)
+
+        assert [topic for topic, _ in client.published] == ['b', 'c']
+
+    def test_batch_limited_by_inflight(self):
+        """Test no more than max_inflight unconfirmed messages are handed out"""
+        queue = PublishQueue(max_inflight=3)
+        for value in range(5):
+            queue.publish('topic', str(value))
+
+        client = RecordingClient()
+        assert queue.flush(client) == 3
+        assert queue.flush(client) == 0
+
+        queue.on_publish(client, None, 1)
+        assert queue.flush(client) == 1
+        assert queue.depth == 1
+
+    def test_confirmation_wakes_blocked_queue(self):
+        """Test a confirmation notifies the run loop when messages wait for in-flight room"""
+        queue = PublishQueue(max_inflight=1)
+        queue.notify = Mock()
+        queue.publish('topic', '1')
+        queue.publish('topic', '2')
+        queue.notify.reset_mock()
+
+        client = RecordingClient()
+        queue.flush(client)
+        queue.on_publish(client, None, 1)
+        queue.notify.assert_called_once()
+
+        queue.flush(client)
+        queue.on_publish(client, None, 2)
+        queue.notify.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_cancel_with_wakeup(self):
+        """Test the run loop stops when it is cancelled while a wakeup is being delivered"""
+        queue = PublishQueue(interval=10)
+        queue.publish('topic', '1')
+        task = asyncio.create_task(queue.run(RecordingClient(result_code=4)))
+        await asyncio.sleep(0.01)
+
+        queue.notify()
+        for _ in range(2):
+            await asyncio.sleep(0)
+        task.cancel()
+        done, _ = await asyncio.wait([task], timeout=1)
+        assert done
+
+    def test_metrics(self):
+        """Test publish latency is measured until the client confirms a message"""
+        clock = FakeClock()
+        metrics = Metrics()
+        queue = PublishQueue(clock=clock, metrics=metrics)
+        queue.publish('topic', b'12345')
+
+        client = RecordingClient()
+        queue.flush(client)
+        clock.now = 0.25
+        queue.on_publish(client, None, 1)
+
+        assert metrics.bytes_sent.labels().value == len('topic') + 5
+        assert metrics.publish_duration.labels().count == 1
+        assert metrics.publish_duration.labels().sum == 0.25
+
+    def test_rate_limit(self):
+        """Test the token bucket limits messages per second"""
+        clock = FakeClock()
+        queue = PublishQueue(rate=10, batch_size=5, max_inflight=0, clock=clock)
+        for value in range(20):
+            queue.publish('topic', str(value))
+
+        client = RecordingClient()
+        assert queue.flush(client) == 5
+        assert queue.flush(client) == 0
+        clock.now = 0.3
+        assert queue.flush(client) == 3
+
+    def test_refused_messages_are_requeued(self):
+        """Test messages the client refuses stay queued in order"""
+        queue = PublishQueue()
+        queue.publish('a', '1')
+        queue.publish('b', '1')
+
+        assert queue.flush(RecordingClient(result_code=4)) == 0
+        assert queue.failed == 1
+        assert queue.inflight == 0
+
+        client = RecordingClient()
+        queue.flush(client)
+        assert client.published == [('a', '1'), ('b', '1')]
+
+    def test_publish_mirrors_client(self):
+        """Test publish returns a client style result tuple"""
+        assert PublishQueue().publish('topic', 'payload')[0] == 0
+
+    def test_from_config(self):
+        """Test queue options are read from the publish section"""
+        queue = PublishQueue.from_config(PublishConfig(max_queue=10, policy='coalesce', rate_limit=5))
+
+        assert queue.max_size == 10
+        assert queue.policy == 'coalesce'
+        assert queue.rate == 5
+
+    def test_invalid_policy(self):
+        """Test unknown policies are rejected"""
+        with pytest.raises(ValueError):
+            PublishQueue(policy='drop_newest')
+
+
+class PropertiesClient:
+    """Client recording publishes with their MQTT v5 properties"""
+
+    def __init__(self, result_code=0):
+        self.result_code = result_code
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.published.append((topic, payload, properties))
+        return (self.result_code, len(self.published))
+
+
+class TestPublishProperties:
+    """Test MQTT v5 topic aliases, message expiry and timestamps"""
+
+    def test_topic_aliases(self):
+        """Test a reading's topic is sent once with its alias, then only the alias"""
+        properties = PublishProperties(topic_aliases=1)
+        properties.reset(broker_maximum=10)
+        client = PropertiesClient()
+        queue = PublishQueue(max_inflight=0, properties=properties)
+        queue.publish('a/config', '{}', retain=True)
+        for topic in ('a/state', 'a/state', 'b/state'):
+            queue.publish(topic, '1')
+        queue.flush(client)
+
+        assert [topic for topic, _, _ in client.published] == ['a/config', 'a/state', '', 'b/state']
+        assert [getattr(props, 'TopicAlias', None) for _, _, props in client.published] == [None, 1, 1, None]
+
+    def test_aliases_need_broker_support(self):
+        """Test no aliases are used before a connect or when the broker allows none"""
+        properties = PublishProperties()
+        client = PropertiesClient()
+        queue = PublishQueue(max_inflight=0, properties=properties)
+        queue.publish('a/state', '1')
+        queue.publish('a/state', '2')
+        queue.flush(client)
+
+        assert [topic for topic, _, _ in client.published] == ['a/state', 'a/state']
+
+    def test_reset_and_refused_messages(self):
+        """Test aliases are only registered when the message was sent and start over on reset"""
+        properties = PublishProperties()
+        properties.reset(broker_maximum=10)
+        message = Message('a/state', '1')
+
+        properties.publish(PropertiesClient(result_code=4), message)
+        client = PropertiesClient()
+        properties.publish(client, message)
+        properties.publish(client, message)
+        properties.reset(broker_maximum=10)
+        properties.publish(client, message)
+
+        assert [topic for topic, _, _ in client.published] == ['a/state', '', 'a/state']
+
+    def test_expiry_and_timestamps(self):
+        """Test readings expire and carry their queue time, retained configs do not expire"""
+        properties = PublishProperties(message_expiry=300, timestamps=True)
+        clock = FakeClock()
+        queue = PublishQueue(max_inflight=0, clock=clock, properties=properties)
+        queue.publish('a/state', '1')
+        queue.publish('a/config', '{}', retain=True)
+        clock.now = 5
+        client = PropertiesClient()
+        with patch('publisher.time.time', return_value=1000.0):
+            queue.flush(client)
+
+        reading, config = (props for _, _, props in client.published)
+        assert reading.MessageExpiryInterval == 300
+        assert reading.UserProperty == [('timestamp', '995.000')]
+        assert not hasattr(config, 'MessageExpiryInterval')
+
+    def test_replayed_timestamp(self):
+        """Test a message published with the time of an earlier reading carries that time"""
+        queue = PublishQueue(max_inflight=0, properties=PublishProperties(timestamps=True))
+        queue.publish('a/state', '21.5', timestamp=500.25)
+        client = PropertiesClient()
+        queue.flush(client)
+
+        [(_, payload, props)] = client.published
+        assert payload == '21.5'
+        assert props.UserProperty == [('timestamp', '500.250')]
+
+    def test_plain_messages(self):
+        """Test messages without any property are published without properties"""
+        client = PropertiesClient()
+        PublishProperties(message_expiry=300).publish(client, Message('a/config', '{}', retain=True))
+
+        assert client.published == [('a/config', '{}', None)]
+
+    def test_session_properties(self):
+        """Test the session expiry is sent with CONNECT"""
+        assert session_properties(60).SessionExpiryInterval == 60
+
+
+class TestSpool:
+    """Test the memory-mapped store-and-forward spool"""
+
+    def test_append_and_pop(self, tmp_path):
+        """Test messages come back in order with their metadata"""
+        spool = Spool(str(tmp_path / 'spool.bin'), capacity=4096)
+        spool.append('a/state', '21.5', timestamp=100.0)
+        spool.append('b/state', b'50', timestamp=101.0, qos=1, retain=True)
+
+        assert len(spool) == 2
+        first, second = spool.pop(10)
+        assert (first.topic, first.payload, first.timestamp) == ('a/state', b'21.5', 100.0)
+        assert (second.qos, second.retain) == (1, True)
+        assert len(spool) == 0
+        spool.close()
+
+    def test_oldest_messages_dropped_when_full(self, tmp_path):
+        """Test the spool never grows past its capacity"""
+        spool = Spool(str(tmp_path / 'spool.bin'), capacity=1024)
+        for value in range(100):
+            spool.append('sensor/state', str(value))
+
+        assert spool.dropped > 0
+        assert spool.used <= 1024
+        values = [int(record.payload) for record in spool.pop(100)]
+        assert values == list(range(100 - len(values), 100))
+        assert (tmp_path / 'spool.bin').stat().st_size == HEADER_SIZE + 1024
+        spool.close()
+
+    def test_wraps_around(self, tmp_path):
+        """Test records wrap to the start of the file without being split"""
+        spool = Spool(str(tmp_path / 'spool.bin'), capacity=200)
+        for value in range(20):
+            spool.append('t', str(value))
+            assert int(spool.pop(1)[0].payload) == value
+            spool.append('t', str(value))
+            spool.append('t', str(value))
+            assert len(spool.pop(2)) == 2
+        spool.close()
+
+    def test_survives_reopen(self, tmp_path):
+        """Test spooled messages persist across restarts"""
+        path = str(tmp_path / 'spool.bin')
+        spool = Spool(path, capacity=4096)
+        spool.append('topic', 'one')
+        spool.append('topic', 'two')
+        spool.pop(1)
+        spool.close()
+
+        spool = Spool(path, capacity=4096)
+        assert [record.payload for record in spool.pop(10)] == [b'two']
+        spool.close()
+
+    def test_recovers_from_torn_record(self, tmp_path):
+        """Test a damaged record and everything after it are discarded"""
+        path = tmp_path / 'spool.bin'
+        spool = Spool(str(path), capacity=4096)
+        spool.append('topic', 'good')
+        spool.append('topic', 'torn')
+        spool.close()
+
+        data = bytearray(path.read_bytes())
+        index = data.rindex(b'torn')
+        data[index] ^= 0xFF
+        path.write_bytes(bytes(data))
+
+        spool = Spool(str(path), capacity=4096)
+        assert [record.payload for record in spool.pop(10)] == [b'good']
+        spool.close()
+
+    def test_resets_invalid_header(self, tmp_path):
+        """Test a corrupt header starts an empty spool instead of failing"""
+        path = tmp_path / 'spool.bin'
+        path.write_bytes(b'\xff' * (HEADER_SIZE + 4096))
+
+        spool = Spool(str(path), capacity=4096)
+        assert len(spool) == 0
+        spool.close()
+
+    def test_syncs_only_after_interval(self, tmp_path):
+        """Test appends do not flush to disk every time"""
+        clock = FakeClock()
+        spool = Spool(str(tmp_path / 'spool.bin'), capacity=4096, sync_interval=5, clock=clock)
+
+        spool.append('topic', '1')
+        clock.now = 1
+        spool.append('topic', '2')
+        assert spool._dirty is True
+
+        clock.now = 5
+        spool.append('topic', '3')
+        assert spool._dirty is False
+        assert spool._last_sync == 5
+        spool.close()
+
+    def test_from_config(self, tmp_path):
+        """Test spooling is only enabled with a spool section"""
+        assert Spool.from_config(SpoolConfig()) is None
+        spool = Spool.from_config(SpoolConfig(path=str(tmp_path / 's.bin'), max_size_mb=0.01))
+        assert spool.capacity == 10485
+        spool.close()
+
+
+class TestAddTimestamp:
+    """Test timestamps added to replayed payloads"""
+
+    def test_plain_value(self):
+        """Test plain state payloads are kept as they are, their entities expect a bare value"""
+        assert add_timestamp(b'21.5', 100.0) == b'21.5'
+        assert add_timestamp('21.5', 100.0) == '21.5'
+
+    def test_json_object(self):
+        """Test JSON objects gain a timestamp key"""
+        payload = json.loads(add_timestamp('{"temperature": 20}', 100.0))
+        assert payload == {'temperature': 20, 'timestamp': 100.0}
+
+    def test_text_value(self):
+        """Test non JSON text is kept unchanged"""
+        assert add_timestamp(b'on', 1.0) == b'on'
+        assert add_timestamp(b'{not json', 1.0) == b'{not json'
+
+
+class TestStoreAndForward:
+    """Test spooling while disconnected and rate limited replay"""
+
+    def test_spools_while_disconnected(self, tmp_path):
+        """Test messages are spooled only while disconnected"""
+        queue = PublishQueue()
+        spool = Spool(str(tmp_path / 'spool.bin'), capacity=4096)
+        store = StoreAndForward(queue, spool)
+
+        store.publish('topic', '1')
+        assert (len(spool), queue.depth) == (1, 0)
+
+        store.set_connected(True)
+        store.publish('topic', '2')
+        # Live readings do not wait for the backlog
+        assert (len(spool), queue.depth) == (1, 1)
+        spool.close()
+
+    def test_backlog_drains_under_live_traffic(self, tmp_path):
+        """Test the spool empties while live readings arrive faster than the replay rate"""
+        clock = FakeClock()
+        queue = PublishQueue(max_size=1000, max_inflight=0, clock=clock)
+        spool = Spool(str(tmp_path / 'spool.bin'), capacity=65536)
+        store = StoreAndForward(queue, spool, replay_rate=10, clock=clock)
+        for value in range(100):
+            store.publish(f"sensor_{value % 40}/state", str(value))
+
+        store.set_connected(True)
+        client = RecordingClient()
+        # 40 live readings per second for a minute, replayed and flushed every half second
+        for tick in range(1, 121):
+            for sensor in range(20):
+                store.publish(f"sensor_{sensor}/state", f"live {tick}")
+            clock.now = tick * 0.5
+            store.replay()
+            queue.flush(client)
+
+        assert len(spool) == 0
+        assert spool.dropped == 0
+        assert queue.dropped == 0
+        # Only the 5 sensors of the last batch were replayed after their latest live reading
+        assert len(client.published) == 100 + 120 * 20 + 5
+        spool.close()
+
+    def test_live_value_published_after_backlog(self, tmp_path):
+        """Test a topic ends on its live reading when older readings of it are replayed later"""
+        clock = FakeClock()
+        queue = PublishQueue(max_inflight=0, clock=clock)
+        spool = Spool(str(tmp_path / 'spool.bin'), capacity=4096)
+        store = StoreAndForward(queue, spool, replay_rate=10, clock=clock)
+        store.publish('a/state', 'old')
+        store.publish('b/state', 'old')
+
+        store.set_connected(True)
+        store.publish('a/state', 'live')
+        clock.now = 1.0
+        store.replay()
+        client = RecordingClient()
+        queue.flush(client)
+
+        assert client.published == [('a/state', 'live'), ('a/state', b'old'), ('b/state', b'old'),
+                                     ('a/state', 'live')]
+        spool.close()
+
+    def test_live_value_sent_once_after_long_replay(self, tmp_path):
+        """Test a backlog replayed over many batches re-sends the live reading once, after the last batch"""
+        clock = FakeClock()
+        queue = PublishQueue(max_inflight=0, clock=clock)
+        spool = Spool(str(tmp_path / 'spool.bin'), capacity=4096)
+        store = StoreAndForward(queue, spool, replay_rate=2, clock=clock)
+        for value in range(6):
+            store.publish('a/state', f"old {value}")
+
+        store.set_connected(True)
+        store.publish('a/state', 'live')
+        client = RecordingClient()
+        for tick in range(1, 4):
+            clock.now = tick
+            store.replay()
+            queue.flush(client)
+
+        assert [payload for _, payload in client.published] == ['live'] + [f"old {value}".encode()
+                                                                          for value in range(6)] + ['live']
+        spool.close()
+
+    def test_replay_rate(self, tmp_path):
+        """Test the backlog is replayed at replay_rate messages per second"""
+        clock = FakeClock()
+        queue = PublishQueue()
+        spool = Spool(str(tmp_path / 'spool.bin'), capacity=4096)
+        store = StoreAndForward(queue, spool, replay_rate=10, clock=clock)
+        for value in range(30):
+            store.publish('topic', str(value))
+
+        store.set_connected(True)
+        clock.now = 0.5
+        assert store.replay() == 5
+        clock.now = 1.5
+        assert store.replay() == 10
+        assert queue.depth == 15
+        assert len(spool) == 15
+        spool.close()
+
+
+class TestSchedulerTask:
+    """Test the asyncio scheduler loop"""
+
+    @pytest.mark.asyncio
+    async def test_wakes_for_new_jobs(self):
+        """Test adding a job wakes a scheduler with nothing to do"""
+        scheduler = Scheduler(tick=0.01)
+        batches = []
+        task = asyncio.create_task(scheduler.run(batches.append))
+        await asyncio.sleep(0.01)
+
+        scheduler.add('sensor', 10, 'job')
+        await asyncio.sleep(0.02)
+        task.cancel()
+
+        assert batches == [[('sensor', 'job')]]
+
+    @pytest.mark.asyncio
+    async def test_housekeeping_runs(self):
+        """Test housekeeping is called while waiting"""
+        scheduler = Scheduler()
+        housekeeping = Mock()
+        task = asyncio.create_task(scheduler.run(Mock(), housekeeping=housekeeping))
+        await asyncio.sleep(0.01)
+        task.cancel()
+
+        assert housekeeping.called
+
+
+class FakePahoClient:
+    """paho client stand-in whose connection attempts can be scripted"""
+
+    def __init__(self, failures=0, session_present=False):
+        self.failures = failures
+        self.session_present = session_present
+        self.attempts = 0
+        self.on_connect = None
+        self.on_disconnect = None
+        self.will = None
+        self.published = []
+        self.subscribed = []
+
+    def _connect(self):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise ConnectionRefusedError("Connection refused")
+        self.on_connect(self, None, {'session present': int(self.session_present)}, 0)
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        self.will = (topic, payload, qos, retain)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload, qos, retain))
+
+    def subscribe(self, topic, qos=0):
+        self.subscribed.append(topic)
+
+    def connect(self, host, port=1883, keepalive=60):
+        self._connect()
+
+    def reconnect(self):
+        self._connect()
+
+    def disconnect(self):
+        pass
+
+
+class TestMqttConnection:
+    """Test connecting on the event loop"""
+
+    @pytest.mark.asyncio
+    async def test_connected_event(self):
+        """Test the connected event is set once the broker accepts the connection"""
+        client = FakePahoClient()
+        on_connect = Mock()
+        connection = MqttConnection(client, 'broker', on_connect=on_connect)
+
+        await connection.start()
+
+        assert await connection.wait_connected(timeout=1) is True
+        assert on_connect.called
+
+    @pytest.mark.asyncio
+    async def test_retries_unreachable_broker(self, caplog):
+        """Test failed connection attempts are retried in the background"""
+        client = FakePahoClient(failures=2)
+        connection = MqttConnection(client, 'broker', backoff=Backoff(0.01, 0.05))
+
+        await connection.start()
+        assert not connection.connected.is_set()
+
+        assert await connection.wait_connected(timeout=1) is True
+        assert client.attempts == 3
+        assert "Connection refused" in caplog.text
+
+    @pytest.mark.asyncio
+    async def test_reconnects_after_disconnect(self):
+        """Test a lost connection is reopened"""
+        client = FakePahoClient()
+        connection = MqttConnection(client, 'broker', backoff=Backoff(0.01, 0.05))
+        await connection.start()
+        await connection.wait_connected(timeout=1)
+
+        client.on_disconnect(client, None, 7)
+        await asyncio.sleep(0)
+        assert not connection.connected.is_set()
+
+        assert await connection.wait_connected(timeout=1) is True
+        assert client.attempts == 2
+        await connection.stop()
+
+    @pytest.mark.asyncio
+    async def test_availability(self):
+        """Test offline is the last will, online is published on connect and offline on a clean stop"""
+        client = FakePahoClient()
+        connection = MqttConnection(client, 'broker', availability_topic='node/availability')
+        assert client.will == ('node/availability', 'offline', 1, True)
+
+        await connection.start()
+        await connection.wait_connected(timeout=1)
+        connection.helper.closed.clear()
+        await connection.stop(timeout=0)
+
+        assert client.published == [('node/availability', 'online', 1, True),
+                                    ('node/availability', 'offline', 1, True)]
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize('session_present, resubscribed', [(False, 2), (True, 1)])
+    async def test_resubscribe_and_hooks(self, session_present, resubscribed):
+        """Test subscriptions are restored unless the broker kept the session, hooks run on every connect"""
+        client = FakePahoClient(session_present=session_present)
+        connection = MqttConnection(client, 'broker', backoff=Backoff(0.01, 0.05))
+        hook = Mock()
+        connection.add_connect_hook(hook)
+        connection.subscribe('commands/#', 1)
+        await connection.start()
+        await connection.wait_connected(timeout=1)
+
+        client.on_disconnect(client, None, 7)
+        await asyncio.sleep(0)
+        await connection.wait_connected(timeout=1)
+        await asyncio.sleep(0)
+
+        assert len(client.subscribed) == resubscribed
+        assert hook.call_args_list == [((session_present,),)] * 2
+        await connection.stop()
+
+
+class TestBackoff:
+    """Test reconnect delays"""
+
+    def test_grows_to_maximum(self):
+        """Test the delay ceiling doubles up to the maximum"""
+        backoff = Backoff(1, 10, random=lambda: 1.0)
+
+        assert [backoff.next() for _ in range(6)] == [1, 2, 4, 8, 10, 10]
+
+    def test_jitter_and_reset(self):
+        """Test delays are spread between 0 and the ceiling and start over after reset"""
+        backoff = Backoff(1, 10, random=lambda: 0.25)
+        backoff.next()
+        backoff.next()
+
+        assert backoff.next() == 1.0
+        backoff.reset()
+        assert backoff.next() == 0.25
+
+    def test_long_outage(self):
+        """Test many attempts do not overflow"""
+        backoff = Backoff(1, 120, random=lambda: 1.0)
+        backoff.attempts = 10000
+
+        assert backoff.next() == 120
+
+    def test_invalid(self):
+        """Test a maximum below the initial delay is rejected"""
+        with pytest.raises(ValueError):
+            Backoff(10, 1)
+
+
+class TestBrokers:
+    """Test publishing to several brokers"""
+
+    @staticmethod
+    def link(name, connected=False):
+        connection = Mock(client=RecordingClient(), connected=asyncio.Event())
+        if connected:
+            connection.connected.set()
+        return BrokerLink(name, connection, PublishQueue())
+
+    def test_fanout_shares_payload(self):
+        """Test every broker's queue gets the same payload object"""
+        queues = [PublishQueue(), PublishQueue()]
+        payload = json.dumps({'temperature': 21.5})
+
+        FanOut(queues).publish('kitchen/state', payload)
+
+        assert [queue.depth for queue in queues] == [1, 1]
+        assert queues[0]._queue[0].payload is queues[1]._queue[0].payload is payload
+
+    def test_queue_group(self):
+        """Test the load monitor sees the queues of every broker, not only the first"""
+        queues = [PublishQueue(max_size=10, track_latency=True), PublishQueue(max_size=10, track_latency=True)]
+        group = QueueGroup(queues)
+        for value in range(10):
+            queues[1].publish('a/state', value)
+        queues[1].latency = 3.0
+
+        assert (group.depth, group.max_size, group.latency) == (10, 20, 1.5)
+        assert group.stats() == {'depth': 10, 'inflight': 0, 'sent': 0, 'dropped': 0, 'failed': 0}
+        assert LoadMonitor(group, max_backoff=4, queue_threshold=0.25, latency_threshold=1.0).update() == 2.5
+
+    def test_failover_prefers_first_reachable_broker(self, caplog):
+        """Test the next broker takes over when the active one is lost, and the first one takes over again"""
+        primary, standby = self.link('primary', connected=True), self.link('standby', connected=True)
+        switched = []
+        failover = Failover([primary, standby], on_switch=switched.append)
+
+        assert failover.update() is True
+        assert failover.active is primary and failover.connected.is_set()
+        primary.connection.connected.clear()
+        failover.update()
+        assert failover.active is standby
+        assert "Switched MQTT broker from primary to standby" in caplog.text
+        primary.connection.connected.set()
+        failover.update()
+
+        assert switched == [primary, standby, primary]
+        assert failover.switches == 2
+
+    def test_failover_publishes_to_active_client(self):
+        """Test the shared queue flushes to the active broker only"""
+        primary, standby = self.link('primary'), self.link('standby', connected=True)
+        failover = Failover([primary, standby])
+        queue = PublishQueue()
+        queue.publish('kitchen/state', '1')
+
+        failover.update()
+        queue.flush(failover)
+
+        assert standby.client.published == [('kitchen/state', '1')]
+        assert primary.client.published == []
+
+    def test_failover_without_reachable_broker(self):
+        """Test publishing is refused while no broker is connected"""
+        failover = Failover([self.link('primary')])
+
+        assert failover.update() is False
+        assert not failover.connected.is_set()
+        assert failover.publish('kitchen/state', '1')[0] != 0
+
+
+class TestDiscoveryCache:
+    """Test the discovery payload cache"""
+
+    def test_is_current(self):
+        """Test only the exact published payload counts as current"""
+        cache = DiscoveryCache()
+        cache.update('topic', '{"a": 1}')
+
+        assert cache.is_current('topic', '{"a": 1}')
+        assert not cache.is_current('topic', '{"a": 2}')
+        assert not cache.is_current('other', '{"a": 1}')
+
+    def test_persists(self, tmp_path):
+        """Test hashes survive a restart"""
+        path = str(tmp_path / 'cache.json')
+        cache = DiscoveryCache(path, scope='broker:1883')
+        cache.update('topic', 'payload')
+        cache.save()
+
+        assert DiscoveryCache(path, scope='broker:1883').is_current('topic', 'payload')
+
+    def test_other_scope_is_ignored(self, tmp_path):
+        """Test a cache written for another broker is not used"""
+        path = str(tmp_path / 'cache.json')
+        cache = DiscoveryCache(path, scope='old:1883')
+        cache.update('topic', 'payload')
+        cache.save()
+
+        assert DiscoveryCache(path, scope='new:1883').hashes == {}
+
+    def test_unreadable_file(self, tmp_path, caplog):
+        """Test a corrupt cache file starts an empty cache"""
+        path = tmp_path / 'cache.json'
+        path.write_text('{not json')
+
+        assert DiscoveryCache(str(path)).hashes == {}
+        assert "Ignoring unreadable discovery cache" in caplog.text
+
+    def test_reconcile(self):
+        """Test configs missing or different on the broker are forgotten"""
+        cache = DiscoveryCache()
+        for topic in ('same', 'changed', 'missing'):
+            cache.update(topic, 'payload')
+
+        cache.reconcile({'same': b'payload', 'changed': b'other'})
+
+        assert list(cache.hashes) == ['same']
+
+    def test_from_config(self, tmp_path):
+        """Test the cache is only enabled with a cache file"""
+        assert DiscoveryCache.from_config(DiscoveryConfig()) is None
+        cache = DiscoveryCache.from_config(DiscoveryConfig(cache_file=str(tmp_path / 'c.json'), verify_retained=False))
+        assert cache.verify_retained is False
+
+    def test_digest_accepts_bytes(self):
+        """Test str and bytes payloads hash the same"""
+        assert digest('payload') == digest(b'payload')
+
+
+class TestPublishDiscoveryCached:
+    """Test discovery publishing with a cache"""
+
+    def test_unchanged_config_is_skipped(self):
+        """Test a config is published once while it does not change"""
+        mock_client = Mock()
+        mock_client.publish.return_value = (0, 1)
+        cache = DiscoveryCache()
+
+        first = sensor_container.publish_discovery_config(mock_client, "Test", "temperature", cache=cache)
+        second = sensor_container.publish_discovery_config(mock_client, "Test", "temperature", cache=cache)
+        sensor_container.publish_discovery_config(mock_client, "Test", "temperature", "°F", cache=cache)
+
+        assert first == (0, 1)
+        assert second is None
+        assert mock_client.publish.call_count == 2
+
+    def test_failed_publish_is_not_cached(self):
+        """Test a refused publish is retried next time"""
+        mock_client = Mock()
+        mock_client.publish.return_value = (1, 1)
+        cache = DiscoveryCache()
+
+        sensor_container.publish_discovery_config(mock_client, "Test", "temperature", cache=cache)
+
+        assert cache.hashes == {}
+
+
+class TestFetchRetained:
+    """Test reading retained discovery configs back from the broker"""
+
+    @pytest.mark.asyncio
+    async def test_collects_retained_messages(self):
+        """Test retained messages of the subscribed topics are returned"""
+        client = Mock()
+        callbacks = {}
+        client.message_callback_add.side_effect = callbacks.__setitem__
+
+        def subscribe(topics):
+            for topic, _ in topics:
+                callbacks[topic](client, None, Mock(topic=topic, payload=b'config', retain=True))
+            callbacks['a'](client, None, Mock(topic='a', payload=b'live', retain=False))
+
+        client.subscribe.side_effect = subscribe
+
+        retained = await fetch_retained(client, ['a', 'b'], settle=0)
+
+        assert retained == {'a': b'config', 'b': b'config'}
+        client.unsubscribe.assert_called_once_with(['a', 'b'])
+        assert client.message_callback_remove.call_count == 2
+
+
+class TestRingBuffer:
+    """Test the fixed-size ring buffer"""
+
+    def test_keeps_last_values(self):
+        """Test only the last size values are kept"""
+        buffer = RingBuffer(3)
+        for value in range(5):
+            buffer.append(value)
+
+        assert len(buffer) == 3
+        assert sorted(buffer.values()) == [2, 3, 4]
+
+    def test_partially_filled(self):
+        """Test a buffer that is not yet full only returns appended values"""
+        buffer = RingBuffer(3)
+        buffer.append(1.5)
+
+        assert buffer.values() == [1.5]
+
+
+class TestMeasurementFilter:
+    """Test report-by-exception filtering"""
+
+    def test_absolute_deadband(self):
+        """Test changes within the deadband are suppressed"""
+        measurement_filter = MeasurementFilter(deadband=0.5)
+
+        results = [measurement_filter.update(value, now) for now, value in enumerate([20.0, 20.3, 20.6, 20.7])]
+
+        assert results == [20.0, None, 20.6, None]
+
+    def test_percent_deadband(self):
+        """Test the percent deadband is relative to the last published value"""
+        measurement_filter = MeasurementFilter(deadband_percent=10)
+
+        results = [measurement_filter.update(value, now) for now, value in enumerate([50, 54, 56, 60])]
+
+        assert results == [50, None, 56, None]
+
+    def test_unchanged_values_suppressed(self):
+        """Test repeated values are not published without a deadband"""
+        measurement_filter = MeasurementFilter()
+
+        assert measurement_filter.update('on', 0) == 'on'
+        assert measurement_filter.update('on', 1) is None
+        assert measurement_filter.update('off', 2) == 'off'
+
+    def test_min_interval(self):
+        """Test changes are not published more often than min_interval"""
+        measurement_filter = MeasurementFilter(min_interval=10)
+
+        assert measurement_filter.update(1, 0) == 1
+        assert measurement_filter.update(2, 5) is None
+        assert measurement_filter.update(3, 10) == 3
+
+    def test_heartbeat(self):
+        """Test unchanged values are republished after max_interval"""
+        measurement_filter = MeasurementFilter(deadband=1, max_interval=60)
+
+        assert measurement_filter.update(20.0, 0) == 20.0
+        assert measurement_filter.update(20.0, 30) is None
+        assert measurement_filter.update(20.1, 60) == 20.1
+
+    def test_mean_smoothing(self):
+        """Test values are averaged over the window"""
+        measurement_filter = MeasurementFilter(smoothing='mean', window=2)
+
+        assert [measurement_filter.update(value, now) for now, value in enumerate([10, 20, 30])] == [10, 15, 25]
+
+    def test_median_smoothing(self):
+        """Test the median rejects single outliers"""
+        measurement_filter = MeasurementFilter(smoothing='median', window=3)
+
+        results = [measurement_filter.update(value, now) for now, value in enumerate([20, 20, 85, 20])]
+
+        assert results == [20, None, None, None]
+
+    def test_invalid_smoothing(self):
+        """Test unknown smoothing methods are rejected"""
+        with pytest.raises(ValueError):
+            MeasurementFilter(smoothing='kalman')
+
+
+class TestSensorFilter:
+    """Test per-sensor filter configuration"""
+
+    def test_filters_each_measurement(self):
+        """Test every measurement is filtered independently"""
+        clock = FakeClock()
+        sensor_filter = SensorFilter.from_config({'filter': {'deadband': 1}}, clock=clock)
+
+        assert sensor_filter.apply({'temperature': 20.0, 'humidity': 50.0}) == {'temperature': 20.0, 'humidity': 50.0}
+        clock.now = 1
+        assert sensor_filter.apply({'temperature': 20.5, 'humidity': 52.0}) == {'humidity': 52.0}
+
+    def test_no_filter_section(self):
+        """Test sensors without a filter section are not filtered"""
+        assert SensorFilter.from_config({'type': 'dht11'}) is None
+
+    def test_invalid_options_fail_early(self):
+        """Test configuration errors are raised when the filter is created"""
+        with pytest.raises(ValueError):
+            SensorFilter.from_config({'filter': {'smoothing': 'mode'}})
+
+
+class TestRollup:
+    """Test downsampling readings into rollup aggregates"""
+
+    def test_window_aggregates(self):
+        """Test min, max, mean and count of the samples, starting over after every aggregate"""
+        window = RollupWindow(2)
+        for value in (3, 1.5, 4.5):
+            window.append(value)
+
+        assert len(window) == 3
+        assert window.aggregate() == {'min': 1.5, 'max': 4.5, 'mean': 3.0, 'count': 3}
+        assert window.aggregate() is None
+
+    def test_windows_are_aligned(self):
+        """Test a reading after the end of the interval closes the window"""
+        clock = FakeClock()
+        clock.now = 55
+        rollup = SensorRollup(60, aggregates=('mean', 'count'), clock=clock)
+
+        assert rollup.add({'temperature': 20.0, 'status': 'ok'}) is None
+        clock.now = 59
+        assert rollup.add({'temperature': 21.0}) is None
+        clock.now = 61
+        assert rollup.add({'temperature': 30.0}) == {'temperature': {'mean': 20.5, 'count': 2}}
+        clock.now = 200
+        assert rollup.add({'temperature': 0.0}) == {'temperature': {'mean': 30.0, 'count': 1}}
+
+    def test_from_config(self):
+        """Test the window holds one interval of readings"""
+        rollup = SensorRollup.from_config({'update_interval': 2, 'rollup': {'interval': 60, 'raw': False}})
+
+        assert rollup.size == 31
+        assert rollup.aggregates == ('min', 'max', 'mean', 'count')
+        assert not rollup.raw
+        assert SensorRollup.from_config({'type': 'dht11'}) is None
+
+    def test_result_handler(self):
+        """Test aggregates are published to their own topics, raw readings only when enabled"""
+        client = RecordingClient()
+        clock = FakeClock()
+        rollups = {'simulated': SensorRollup(10, aggregates=('max',), raw=False, clock=clock)}
+        on_result = sensor_container.make_result_handler(client, 'Test Sensor', rollups=rollups)
+
+        on_result('simulated', {'temperature': 20.0})
+        on_result('simulated', {'temperature': 22.0})
+        clock.now = 10
+        on_result('simulated', {'temperature': 21.0})
+
+        assert client.published == [('homeassistant/sensor/test_sensor/simulated_temperature_max/state', '22.0')]
+
+    def test_count_discovery(self):
+        """Test count entities are announced without the unit and device class of their measurement"""
+        client = RecordingClient()
+        rollup = SensorRollup(10, aggregates=('mean', 'count'))
+        sensor_container.publish_sensor_discovery(client, 'Test Sensor', 'simulated',
+                                                  drivers.create_driver({'type': 'simulated'}), rollup=rollup)
+        configs = {json.loads(payload)['unique_id']: json.loads(payload) for _, payload in client.published}
+
+        count = configs['test_sensor_simulated_temperature_count']
+        assert 'unit_of_measurement' not in count
+        assert 'device_class' not in count
+        assert 'unit_of_measurement' not in count['device']
+        mean = configs['test_sensor_simulated_temperature_mean']
+        assert (mean['unit_of_measurement'], mean['device_class']) == ('°C', 'temperature')
+
+    def test_compact_rollup(self):
+        """Test compact mode publishes the aggregates as one JSON message referenced by discovery"""
+        client = RecordingClient()
+        clock = FakeClock()
+        rollup = SensorRollup(10, aggregates=('min', 'max'), clock=clock)
+        on_result = sensor_container.make_result_handler(client, 'Test Sensor', compact=True,
+                                                         rollups={'simulated': rollup})
+        sensor_container.publish_sensor_discovery(client, 'Test Sensor', 'simulated',
+                                                  drivers.create_driver({'type': 'simulated'}), compact=True,
+                                                  rollup=rollup)
+        on_result('simulated', {'temperature': 20.0})
+        clock.now = 10
+        on_result('simulated', {'temperature': 21.0})
+
+        configs = {json.loads(payload)['unique_id']: json.loads(payload) for topic, payload in client.published
+                   if topic.endswith('/config')}
+        assert len(configs) == 6
+        assert configs['test_sensor_simulated_temperature_min']['value_template'] == \
+            "{{ value_json.temperature_min }}"
+        assert configs['test_sensor_simulated_humidity_max']['state_topic'] == \
+            'homeassistant/sensor/test_sensor/simulated_rollup/state'
+        assert json.loads(client.published[-2][1]) == {'temperature_min': 20.0, 'temperature_max': 20.0}
+
+
+class TestAdaptiveSampling:
+    """Test adaptive read intervals and the global backoff"""
+
+    def test_interval_follows_volatility(self):
+        """Test stable readings stretch the interval, a fast change shrinks it"""
+        adaptive = AdaptiveInterval(10, 5, 20, threshold={'temperature': 1.0})
+
+        assert adaptive.update({'temperature': 20.0, 'humidity': 40}) == 12.5
+        assert adaptive.update({'temperature': 20.1, 'humidity': 80}) == 15.625
+        assert adaptive.update({'temperature': 20.8}) is None
+        assert adaptive.update({'temperature': 22.0}) == 7.8125
+        assert adaptive.update({'temperature': 25.0}) == 5
+        for _ in range(10):
+            adaptive.update({'temperature': 25.0})
+        assert adaptive.interval == 20
+
+    def test_from_config(self):
+        """Test the range defaults to update_interval up to ten times as long"""
+        adaptive = AdaptiveInterval.from_config({'update_interval': 30, 'adaptive': {'threshold': 0.5}})
+
+        assert (adaptive.interval, adaptive.min_interval, adaptive.max_interval) == (30, 30, 300)
+        assert AdaptiveInterval.from_config({'update_interval': 30}) is None
+
+    def test_fleet_reschedules_adaptive_sensors(self):
+        """Test readings of an adaptive sensor change its scheduled interval"""
+        client = RecordingClient()
+        clock = FakeClock()
+        fleet = sensor_container.Fleet(client, Scheduler(clock=clock))
+        sensors = [{'type': 'simulated', 'name': 'a', 'update_interval': 10, 'adaptive': {'threshold': 100}}]
+        fleet.add_device(sensor_container.Device(simulated_device(sensors=sensors), client))
+        fleet.scheduler.pop_due()
+
+        fleet.on_result('kitchen/a', {'temperature': 20.0})
+
+        assert fleet.scheduler.time_until_next() == pytest.approx(12.5)
+
+    def test_backoff_follows_queue_and_latency(self):
+        """Test intervals back off as the queue fills or publishing slows down, and recover"""
+        queue = PublishQueue(max_size=10, track_latency=True)
+        monitor = LoadMonitor(queue, max_backoff=4, queue_threshold=0.5, latency_threshold=1.0)
+        assert monitor.update() == 1
+
+        for value in range(10):
+            queue.publish('a/state', value)
+        assert monitor.update() == 4
+        queue._take(3)
+        assert monitor.update() == pytest.approx(2.2)
+        queue._take(7)
+        queue.latency = 1.5
+        assert monitor.update() == 2.5
+        queue.latency = 0.2
+        assert monitor.update() == 1
+
+    def test_queue_latency(self):
+        """Test the queue averages the time from queueing to the client's confirmation"""
+        clock = FakeClock()
+        queue = PublishQueue(clock=clock, track_latency=True)
+        queue.publish('a/state', '1')
+        client = RecordingClient()
+        queue.flush(client)
+        clock.now = 2.0
+        queue.on_publish(client, None, 1)
+
+        assert queue.latency == pytest.approx(0.4)
+
+
+class TestCalibration:
+    """Test sensor calibration, unit conversion and derived values"""
+
+    MEASUREMENTS = (('temperature', "°C", 'temperature'), ('humidity', "%", 'humidity'))
+
+    def test_conversion(self):
+        """Test units of the same quantity convert into each other"""
+        scale, offset = conversion('°C', '°F')
+        assert 100 * scale + offset == pytest.approx(212)
+        scale, offset = conversion('inHg', 'hPa')
+        assert 29.92 * scale + offset == pytest.approx(1013.2, abs=0.1)
+        with pytest.raises(ValueError):
+            conversion('°C', 'hPa')
+
+    def test_derived_formulas(self):
+        """Test dew point and absolute humidity against reference values"""
+        assert dew_point(20.0, 50.0) == pytest.approx(9.3, abs=0.05)
+        assert absolute_humidity(20.0, 50.0) == pytest.approx(8.6, abs=0.05)
+
+    def test_correct_convert_and_derive(self):
+        """Test corrections apply in the driver's unit, derived values use the corrected readings"""
+        calibration = Calibration(self.MEASUREMENTS, {
+            'temperature': {'offset': -1.0, 'unit': "°F", 'precision': 1},
+            'humidity': {'polynomial': [2.0, 0.5]},
+        }, derived=['dew_point'])
+
+        values = calibration.apply({'temperature': 21.0, 'humidity': 96.0, 'status': 'ok'})
+
+        assert values == {'temperature': 68.0, 'humidity': 50.0, 'dew_point': 9.26, 'status': 'ok'}
+        assert calibration.measurements == (
+            ('temperature', "°F", 'temperature'), ('humidity', "%", 'humidity'), ('dew_point', "°C", 'temperature'))
+
+    @pytest.mark.parametrize('options, derived', [
+        ({'pressure': {'offset': 1}}, ()),
+        ({'temperature': {'unit': 'hPa'}}, ()),
+        ({'temperature': {'polynomial': [0, 1], 'offset': 1}}, ()),
+        ({}, ['heat_index']),
+    ])
+    def test_invalid_calibration(self, options, derived):
+        """Test calibrations the sensor cannot provide fail when the driver is created"""
+        with pytest.raises(ValueError):
+            Calibration(self.MEASUREMENTS, options, derived)
+
+    def test_calibrated_driver(self):
+        """Test create_driver wraps calibrated sensors and discovery announces the converted unit"""
+        driver = drivers.create_driver({'type': 'simulated', 'calibration': {'temperature': {'unit': 'K'}},
+                                        'derived': ['absolute_humidity']})
+        client = RecordingClient()
+        sensor_container.publish_sensor_discovery(client, 'Test Sensor', 'simulated', driver)
+
+        assert isinstance(driver, CalibratedDriver)
+        assert 290 < driver.read()['temperature'] < 300
+        units = {json.loads(payload)['unique_id']: json.loads(payload)['unit_of_measurement']
+                 for _, payload in client.published}
+        assert units == {'test_sensor_simulated_temperature': 'K', 'test_sensor_simulated_humidity': '%',
+                         'test_sensor_simulated_absolute_humidity': 'g/m³'}
+        assert not isinstance(drivers.create_driver({'type': 'simulated'}), CalibratedDriver)
+
+
+class SensorFault(Exception):
+    """Driver specific error, replayed as a RuntimeError"""
+
+
+class TestRecording:
+    """Test recording and replaying sensor traces"""
+
+    def record(self, path):
+        clock = FakeClock()
+        writer = TraceWriter(str(path), clock=clock)
+        on_result, on_error = writer.tap(lambda name, values: None, lambda name, error: None)
+        for step, values in enumerate([{'temperature': 21.5, 'humidity': 40}, {'temperature': 21.25, 'humidity': 41},
+                                       {'status': 'ok', 'level': None}]):
+            clock.now = step * 0.5
+            on_result('kitchen/dht22', values)
+        on_error('kitchen/dht22', TimeoutError("Read of kitchen/dht22 timed out"))
+        on_error('kitchen/custom', SensorFault("Bus error"))
+        writer.close()
+        return writer
+
+    def test_round_trip(self, tmp_path):
+        """Test readings come back with their names, types and timing, errors with their type"""
+        writer = self.record(tmp_path / 'trace.bin')
+        records = list(read_trace(str(tmp_path / 'trace.bin')))
+
+        assert writer.records == len(records) == 5
+        assert [(record.time, record.values) for record in records[:3]] == [
+            (0.0, {'temperature': 21.5, 'humidity': 40}),
+            (0.5, {'temperature': 21.25, 'humidity': 41}),
+            (1.0, {'status': 'ok', 'level': None}),
+        ]
+        assert type(records[0].values['humidity']) is int
+        assert isinstance(records[3].error, TimeoutError)
+        assert str(records[4].error) == "SensorFault: Bus error"
+        assert records[4].name == 'kitchen/custom'
+
+    def test_compact_readings(self, tmp_path):
+        """Test a numeric reading only stores its packed values after the first one"""
+        path = tmp_path / 'trace.bin'
+        with TraceWriter(str(path)) as writer:
+            writer.reading('kitchen/dht22', {'temperature': 21.5, 'humidity': 40.0})
+            writer._file.flush()
+            size = path.stat().st_size
+            writer.reading('kitchen/dht22', {'temperature': 21.6, 'humidity': 40.0})
+        assert writer._file.closed
+
+        assert path.stat().st_size - size == RECORD.size + 16
+
+    def test_truncated_trace(self, tmp_path):
+        """Test a recording cut off mid-record is read up to the last complete record"""
+        path = tmp_path / 'trace.bin'
+        self.record(path)
+        path.write_bytes(path.read_bytes()[:-3])
+
+        assert len(list(read_trace(str(path)))) == 4
+
+    def test_not_a_trace(self, tmp_path):
+        path = tmp_path / 'config.yml'
+        path.write_text('mqtt: {}\n')
+
+        with pytest.raises(ValueError):
+            list(read_trace(str(path)))
+
+    @pytest.mark.asyncio
+    async def test_replay(self, tmp_path):
+        """Test a replay keeps the recorded order, as fast as possible with speed 0"""
+        self.record(tmp_path / 'trace.bin')
+        results, errors = [], []
+
+        count = await replay_trace(str(tmp_path / 'trace.bin'), lambda name, values: results.append(values),
+                                   lambda name, error: errors.append(error), speed=0)
+
+        assert count == 5
+        assert results[0] == {'temperature': 21.5, 'humidity': 40}
+        assert len(results) == 3 and len(errors) == 2
+
+
+class TestSensorBus:
+    """Test the shared memory bus for local consumers"""
+
+    def test_latest_and_recent(self, tmp_path):
+        """Test readers see the latest reading of every sensor and the recent readings in order"""
+        path = str(tmp_path / 'bus')
+        bus = SensorBus(path, slots=4, clock=FakeClock(1000.0))
+        bus.publish('kitchen/a', {'temperature': 20.5})
+        bus.publish('kitchen/b', {'humidity': 40})
+        bus.publish('kitchen/a', {'temperature': 21.0, 'state': 'ok'})
+
+        with BusReader(path) as reader:
+            latest = reader.latest()
+            assert reader.sequence == 3
+            assert latest['kitchen/a'].values == {'temperature': 21.0, 'state': 'ok'}
+            assert latest['kitchen/b'] == (2, 1000.0, 'kitchen/b', {'humidity': 40})
+            assert [record.sequence for record in reader.recent()] == [1, 2, 3]
+            assert [record.sequence for record in reader.recent(1)] == [3]
+        bus.close()
+
+    def test_ring_wraps(self, tmp_path):
+        """Test only the last slots readings are kept and since() follows new ones"""
+        path = str(tmp_path / 'bus')
+        bus = SensorBus(path, slots=3, sensors=1)
+        reader = BusReader(path)
+        for value in range(5):
+            bus.publish(f"sensor{value % 2}", {'value': value})
+
+        records = reader.since(0)
+        assert [record.values['value'] for record in records] == [2, 3, 4]
+        bus.publish('sensor0', {'value': 5})
+        assert [record.values['value'] for record in reader.since(records[-1].sequence)] == [5]
+        # The latest table only has room for the first sensor
+        assert set(reader.latest()) == {'sensor0'}
+        reader.close()
+        bus.close()
+
+    def test_oversized_reading(self, tmp_path):
+        """Test readings that do not fit a record are skipped and counted"""
+        bus = SensorBus(str(tmp_path / 'bus'), record_size=64)
+
+        assert bus.publish('kitchen/a', {'text': 'x' * 100}) is False
+        assert bus.oversized == 1 and bus.sequence == 0
+        bus.close()
+        assert bus.publish('kitchen/a', {'temperature': 20.0}) is False
+
+    def test_busy_record_is_retried(self, tmp_path):
+        """Test a record that is being rewritten is not returned half written"""
+        path = str(tmp_path / 'bus')
+        bus = SensorBus(path, slots=2, sensors=1)
+        bus.publish('kitchen/a', {'temperature': 20.0})
+        reader = BusReader(path)
+        # The latest reading of the first sensor directly follows the header
+        SEQUENCE.pack_into(bus._map, HEADER.size, BUSY)
+
+        assert reader.latest() == {}
+        SEQUENCE.pack_into(bus._map, HEADER.size, 1)
+        assert reader.latest()['kitchen/a'].values == {'temperature': 20.0}
+        reader.close()
+        bus.close()
+
+    def test_not_a_bus(self, tmp_path):
+        """Test other files are rejected"""
+        path = tmp_path / 'other'
+        path.write_bytes(b'x' * 64)
+
+        with pytest.raises(ValueError, match="not a sensor bus"):
+            BusReader(str(path))
+
+
+class TestMetrics:
+    """Test the Prometheus metrics registry and endpoint"""
+
+    def test_counter_and_gauge(self):
+        """Test counters and gauges render in the text exposition format"""
+        registry = Registry()
+        registry.counter('reads_total', 'Reads', ('sensor',)).labels('a"b').inc(2)
+        registry.gauge('depth', 'Depth').set(3)
+
+        text = registry.render()
+
+        assert '# TYPE reads_total counter' in text
+        assert 'reads_total{sensor="a\\"b"} 2' in text
+        assert 'depth 3' in text
+
+    def test_histogram(self):
+        """Test histogram buckets are cumulative with sum and count"""
+        registry = Registry()
+        histogram = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 5.0):
+            histogram.observe(value)
+
+        lines = registry.render().splitlines()
+
+        assert 'latency_seconds_bucket{le="0.1"} 1' in lines
+        assert 'latency_seconds_bucket{le="1.0"} 2' in lines
+        assert 'latency_seconds_bucket{le="+Inf"} 3' in lines
+        assert 'latency_seconds_sum 5.55' in lines
+        assert 'latency_seconds_count 3' in lines
+
+    def test_callback_metrics(self):
+        """Test values owned by other components are read when scraped"""
+        queue = PublishQueue(max_inflight=0)
+        metrics = Metrics()
+        metrics.watch_queue(queue)
+        metrics.watch_drivers({'living_room/dht11': drivers.DHT11Driver({})})
+        queue.publish('topic', 'value')
+
+        text = metrics.render()
+
+        assert 'sensor_container_queue_depth 1' in text
+        assert 'sensor_container_read_retries_total{sensor="living_room/dht11"} 0' in text
+
+    def test_duplicate_metric(self):
+        """Test a metric name can only be registered once"""
+        registry = Registry()
+        registry.counter('reads_total', 'Reads')
+
+        with pytest.raises(ValueError):
+            registry.counter('reads_total', 'Reads')
+
+    @pytest.mark.asyncio
+    async def test_endpoint(self):
+        """Test /metrics is served over HTTP"""
+        metrics = Metrics(host='127.0.0.1', port=0)
+        metrics.reconnects.inc()
+        await metrics.start()
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', metrics.port)
+            writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            response = await reader.read()
+            writer.close()
+        finally:
+            await metrics.stop()
+
+        assert response.startswith(b"HTTP/1.1 200 OK")
+        assert b"sensor_container_reconnects_total 1" in response
+
+    @pytest.mark.asyncio
+    async def test_monitor_loop(self):
+        """Test the loop lag task records how late sleeps wake up"""
+        metrics = Metrics()
+        task = asyncio.create_task(metrics.monitor_loop(interval=0.01))
+        await asyncio.sleep(0.05)
+        task.cancel()
+
+        assert metrics.loop_lag.labels().count >= 1
+
+
+def make_record(message, level=logging.WARNING, **extra):
+    record = logging.makeLogRecord({'name': 'drivers', 'levelno': level, 'levelname': logging.getLevelName(level),
+                                    'msg': message})
+    record.__dict__.update(extra)
+    return record
+
+
+class TestLogging:
+    """Test structured, queued and rate limited logging"""
+
+    def test_json_formatter(self):
+        """Test records become JSON objects including extra fields"""
+        entry = json.loads(JsonFormatter().format(make_record("Read failed", sensor='dht11', device='kitchen')))
+
+        assert entry['level'] == 'WARNING'
+        assert entry['logger'] == 'drivers'
+        assert entry['message'] == "Read failed"
+        assert entry['sensor'] == 'dht11'
+        assert entry['device'] == 'kitchen'
+
+    def test_text_formatter(self):
+        """Test extra fields are appended as key=value"""
+        line = TextFormatter().format(make_record("Read failed", sensor='dht11'))
+
+        assert line.endswith("WARNING drivers: Read failed sensor=dht11")
+
+    def test_rate_limit(self):
+        """Test identical messages are let through once per interval and report the suppressed count"""
+        clock = FakeClock()
+        rate_limit = RateLimitFilter(interval=60, clock=clock)
+
+        assert rate_limit.filter(make_record("Read failed")) is True
+        assert rate_limit.filter(make_record("Read failed")) is False
+        assert rate_limit.filter(make_record("Read failed")) is False
+        assert rate_limit.filter(make_record("Other error")) is True
+        assert rate_limit.filter(make_record("Read failed", sensor='dht22')) is True
+
+        clock.now = 60
+        record = make_record("Read failed")
+        assert rate_limit.filter(record) is True
+        assert record.suppressed == 2
+
+    def test_rate_limit_bounded(self):
+        """Test the filter forgets old messages instead of growing without bound"""
+        clock = FakeClock()
+        rate_limit = RateLimitFilter(interval=1, max_keys=10, clock=clock)
+        for index in range(100):
+            clock.now = index
+            rate_limit.filter(make_record(f"Message {index}"))
+
+        assert len(rate_limit._seen) <= 10
+
+    def test_full_queue_drops(self):
+        """Test records are dropped instead of blocking when the queue is full"""
+        import queue
+        handler = DroppingQueueHandler(queue.Queue(1))
+        handler.handle(make_record("first"))
+        handler.handle(make_record("second"))
+
+        assert handler.dropped == 1
+        assert handler.queue.get_nowait().getMessage() == "first"
+
+    def test_setup_logging(self):
+        """Test records are written as JSON by the listener and module levels are applied"""
+        import io
+        stream = io.StringIO()
+        root = logging.getLogger()
+        level = root.level
+        listener = setup_logging(LoggingConfig(level='INFO', levels={'test_quiet': 'ERROR'}), stream=stream)
+        try:
+            logging.getLogger('test_loud').info("visible %s", 1, extra={'sensor': 'dht11'})
+            logging.getLogger('test_quiet').warning("hidden")
+        finally:
+            listener.stop()
+            for handler in root.handlers[:]:
+                if isinstance(handler, DroppingQueueHandler):
+                    root.removeHandler(handler)
+            root.setLevel(level)
+            logging.getLogger('test_quiet').setLevel(logging.NOTSET)
+
+        entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert [entry['message'] for entry in entries] == ["visible 1"]
+        assert entries[0]['sensor'] == 'dht11'
+
+    def test_unknown_format(self):
+        """Test an unknown log format is rejected"""
+        with pytest.raises(ValueError, match="Unknown log format"):
+            setup_logging(LoggingConfig(format='xml'))
+
+
+class TestSerialization:
+    """Test the JSON serializers"""
+
+    @pytest.mark.parametrize('use_orjson', [True, False])
+    def test_dumps(self, monkeypatch, use_orjson):
+        """Test dumps produces compact JSON bytes with and without orjson"""
+        if not use_orjson:
+            monkeypatch.setattr(serialization, 'orjson', None)
+        elif serialization.orjson is None:
+            pytest.skip("orjson is not installed")
+
+        payload = serialization.dumps({'unit': "°C", 'value': 1})
+
+        assert isinstance(payload, bytes)
+        assert json.loads(payload) == {'unit': "°C", 'value': 1}
+        assert b' ' not in payload
+
+    def test_template_matches_json(self):
+        """Test the template renders the same document as json"""
+        template = StateTemplate(['temperature', 'humidity'])
+
+        payload = template.render({'temperature': 21.5, 'humidity': 40})
+
+        assert payload == b'{"temperature":21.5,"humidity":40}'
+
+    @pytest.mark.parametrize('values', [
+        {'temperature': float('nan'), 'humidity': 40},
+        {'temperature': 'error', 'humidity': 40},
+        {'temperature': 21.5},
+        {'temperature': 21.5, 'pressure': 1000},
+    ])
+    def test_template_falls_back(self, values):
+        """Test readings that do not fit the template are serialized normally"""
+        template = StateTemplate(['temperature', 'humidity'])
+
+        assert template.render(values) == serialization.dumps(values)
+
+    def test_template_escapes_keys(self):
+        """Test measurement names are escaped in the template"""
+        assert json.loads(StateTemplate(['100%"']).render({'100%"': 1})) == {'100%"': 1}
+
+    def test_serializer_reuses_templates(self):
+        """Test one template is built per sensor and measurement set"""
+        serializer = StateSerializer()
+        serializer.render('a', {'temperature': 1.0})
+        serializer.render('a', {'temperature': 2.0})
+        serializer.render('b', {'temperature': 1.0})
+
+        assert len(serializer._templates) == 2
+
+
+class TestSoak:
+    """Test the measurements and gates of the soak test"""
+
+    def test_jitter(self):
+        """Test jitter is the distance from the read grid, a missed reading is not counted as jitter"""
+        assert soak.jitter(1.02, 1.0) == pytest.approx(0.02)
+        assert soak.jitter(0.97, 1.0) == pytest.approx(0.03)
+        assert soak.jitter(2.01, 1.0) == pytest.approx(0.01)
+        assert soak.jitter(0.3, 1.0) == pytest.approx(0.7)
+
+    def test_histogram_percentile(self):
+        """Test the nearest-rank percentile of a histogram matches the one of the expanded values"""
+        from collections import Counter
+        from benchmark import percentile
+
+        values = [1, 1, 2, 3, 3, 3, 5, 8, 13, 40]
+        for percent in (50, 90, 99, 100):
+            assert soak.histogram_percentile(Counter(values), percent) == percentile(values, percent)
+        assert soak.histogram_percentile(Counter(), 99) is None
+
+    def test_growth_ignores_noise(self):
+        """Test growth follows the trend of the samples rather than their last value"""
+        flat = [(t, 10.0 + (0.5 if t % 2 else -0.5)) for t in range(10)]
+        rising = [(t, 10.0 + 2.0 * t) for t in range(10)]
+
+        assert abs(soak.growth(flat, 1)) < 0.5
+        assert soak.growth(rising, 1) == pytest.approx(18.0)
+        assert soak.growth(rising[:1], 1) == 0.0
+
+    def test_check(self):
+        """Test every exceeded threshold is reported"""
+        result = {
+            'growth': {'rss_mb': 1.0, 'traced_kb': 2048.0, 'objects': 10, 'threads': 0.0},
+            'peak_threads_growth': 2,
+            'jitter_ms': {'p50': 3, 'p99': 20, 'max': 30},
+        }
+
+        failures = soak.check(result)
+        assert [failure.split()[0] for failure in failures] == ['traced_kb', 'threads']
+        assert soak.check(result, {'traced_kb': 4096, 'threads': 2}) == []
+        assert soak.check({**result, 'jitter_ms': {'p50': None, 'p99': None, 'max': None}},
+                          {'traced_kb': 4096, 'threads': 2}) == ["no readings arrived after the warm-up"]